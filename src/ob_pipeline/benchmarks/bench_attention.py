@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+# Copyright 2023 Population Health Sciences and AI in Medical Imaging, German Center for Neurodegenerative Diseases (DZNE)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Benchmark of the full vs chunked Self_Attn inference path of AttFastSurferCNN.
+Every configuration runs in a fresh process so that the reported peak RSS belongs to that configuration only.
+
+Example: python -m ob_pipeline.benchmarks.bench_attention -size 96 -batch 4 -chunks 0 512 2048
+"""
+
+import argparse
+import multiprocessing as mp
+import time
+
+
+def run_attention(size, batch_size, chunk_size, seed, queue):
+    import torch
+    from ob_pipeline.models.AttFastSurferCNN import Self_Attn
+    from ob_pipeline.utils.misc import get_peak_rss
+
+    torch.manual_seed(seed)
+    layer = Self_Attn(in_dim=64, out_dim=64)
+    layer.gamma.data.fill_(1.0)
+    layer.chunk_size = chunk_size if chunk_size else None
+    layer.eval()
+
+    x = torch.randn(batch_size, 64, size, size)
+    base_rss = get_peak_rss()
+
+    with torch.no_grad():
+        start = time.time()
+        out = layer(x)
+        elapsed = time.time() - start
+
+    queue.put({'chunk': chunk_size, 'time': elapsed, 'base_rss': base_rss, 'peak_rss': get_peak_rss(),
+               'out': out.numpy()})
+
+
+def run_config(size, batch_size, chunk_size, seed=0):
+    ctx = mp.get_context('spawn')
+    queue = ctx.Queue()
+    proc = ctx.Process(target=run_attention, args=(size, batch_size, chunk_size, seed, queue))
+    proc.start()
+    result = queue.get()
+    proc.join()
+    return result
+
+
+def main():
+    import numpy as np
+
+    parser = argparse.ArgumentParser(description='Benchmark full vs chunked self-attention inference',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-size', '--size', type=int, default=96, help='feature map width/height')
+    parser.add_argument('-batch', '--batch_size', type=int, default=4, help='number of slices per batch')
+    parser.add_argument('-chunks', '--chunks', type=int, nargs='+', default=[0, 512, 2048],
+                        help='query chunk sizes to compare (0: full attention)')
+    args = parser.parse_args()
+
+    reference = None
+    print('{:>8} {:>10} {:>14} {:>16} {:>12}'.format('chunk', 'time [s]', 'peak RSS [MB]', 'attn delta [MB]',
+                                                       'max |diff|'))
+    for chunk in args.chunks:
+        result = run_config(args.size, args.batch_size, chunk)
+        if reference is None:
+            reference = result['out']
+        diff = np.max(np.abs(result['out'] - reference))
+        print('{:>8} {:>10.3f} {:>14.1f} {:>16.1f} {:>12.2e}'.format(chunk if chunk else 'full', result['time'],
+                                                                      result['peak_rss'],
+                                                                      result['peak_rss'] - result['base_rss'],
+                                                                      diff))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+# Copyright 2023 Population Health Sciences and AI in Medical Imaging, German Center for Neurodegenerative Diseases (DZNE)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Regression comparison of the one-step localization (--one_step_localization, input resampled once from the conformed
+image) against the default two-step localization (input resampled from the volume at 0.8 mm) on images that are not
+at 0.8 mm. For every image the crop center of both paths, its shift and the localization times are reported. Exits
+with an error if a crop center moves by more than the allowed shift.
+
+Example: python -m ob_pipeline.benchmarks.bench_crop_first -in_img sub1_T2.nii.gz sub2_T2.nii.gz -max_shift 1
+"""
+
+import argparse
+import os
+import tempfile
+import time
+from collections import namedtuple
+
+
+def crop_center(net, loc_img, grid_affine):
+    """
+    :param OBNet net: network wrapper
+    :param loc_img: input of the localization
+    :param np.ndarray grid_affine: affine of the 0.8 mm grid
+    :return tuple: voxel coordinate of the crop center on the 0.8 mm grid (None if nothing is localized) and time
+    """
+    import numpy as np
+
+    start = time.time()
+    t2_cm, _, resampled_img = net.run_localization(loc_img)
+    elapsed = time.time() - start
+
+    if t2_cm is None or not np.any(t2_cm):
+        return None, elapsed
+
+    # as OBNet.eval
+    coord = np.dot(np.linalg.inv(grid_affine), np.dot(resampled_img.affine, np.append(t2_cm, 1)))
+    return coord[:3].astype(int), elapsed
+
+
+def main():
+    import numpy as np
+    import nibabel as nib
+    from ob_pipeline.configoptions import seg_dir, loc_dir
+    from ob_pipeline.models.OBNet import OBNet
+    from ob_pipeline.ob_pipeline import set_up_model
+    from ob_pipeline.utils import conform, misc
+    from ob_pipeline.utils.lazy_volume import ArrayVolume
+
+    parser = argparse.ArgumentParser(description='Compare the crop-first localization with the two-step localization',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-in_img', '--in_img', nargs='+', required=True, help='T2 images (not at 0.8 mm)')
+    parser.add_argument('-model', '--model', type=int, default=5, help='model number')
+    parser.add_argument('-batch_size', '--batch_size', type=int, default=8, help='slices per batch')
+    parser.add_argument('-seg_dir', '--seg_dir', default=seg_dir, help='Segmentation weights directory')
+    parser.add_argument('-loc_dir', '--loc_dir', default=loc_dir, help='Localization weights directory')
+    parser.add_argument('-resample_engine', '--resample_engine', choices=['nibabel', 'separable'],
+                        default='nibabel', help='resampling engine')
+    parser.add_argument('-max_shift', '--max_shift', type=int, default=1,
+                        help='largest crop center shift allowed per axis, in voxels of 0.8 mm')
+    args = parser.parse_args()
+
+    logger = misc.setup_logger(os.path.join(tempfile.gettempdir(), 'ob_bench_crop_first.txt'))
+    flags = set_up_model(model=args.model, batch_size=args.batch_size, seg_dir=args.seg_dir,
+                         seg_arc='AttFastSurferCNN', loc_dir=args.loc_dir, loc_arc='FastSurferCNN',
+                         inference_opts={'resample_engine': args.resample_engine})
+
+    net_args = namedtuple('ArgNamespace', ['no_cuda', 'save_logits'])
+    net_args.no_cuda = True
+    net_args.save_logits = False
+    net = OBNet(net_args, flags, logger)
+
+    rows = []
+    failures = []
+    for in_img in args.in_img:
+        img = conform.conform(nib.load(in_img), flags, logger)
+        img = nib.Nifti1Image(np.asanyarray(img.dataobj).astype(np.float32, copy=False), img.affine, img.header)
+        if np.allclose(np.array(img.header.get_zooms()), np.array(flags['spacing']), rtol=0.05):
+            logger.info('{}: already at {} mm, both localizations are the same, skipped'.format(in_img,
+                                                                                               flags['spacing']))
+            continue
+
+        grid = ArrayVolume(img).resampled(flags['spacing'], engine=args.resample_engine)
+        two_step, two_step_time = crop_center(net, grid, grid.affine)
+        crop_first, crop_first_time = crop_center(net, img, grid.affine)
+
+        name = os.path.basename(in_img)
+        if two_step is None or crop_first is None:
+            shift = None
+            if (two_step is None) != (crop_first is None):
+                failures.append('{}: localized by one path only'.format(name))
+        else:
+            shift = crop_first - two_step
+            if np.max(np.abs(shift)) > args.max_shift:
+                failures.append('{}: crop center shifted by {} voxels'.format(name, shift.tolist()))
+        rows.append((name, img.header.get_zooms()[:3], two_step, crop_first, shift, two_step_time, crop_first_time))
+
+    print('{:>24} {:>18} {:>16} {:>16} {:>12} {:>12} {:>14}'.format('image', 'zooms', 'two-step center',
+                                                                      'crop-first', 'shift', 'two-step [s]',
+                                                                      'crop-first [s]'))
+    for name, zooms, two_step, crop_first, shift, two_step_time, crop_first_time in rows:
+        print('{:>24} {:>18} {:>16} {:>16} {:>12} {:>12.2f} {:>14.2f}'.format(
+            name[-24:], 'x'.join('{:g}'.format(zoom) for zoom in zooms), str(two_step), str(crop_first),
+            str(shift), two_step_time, crop_first_time))
+
+    for failure in failures:
+        print('SHIFT ' + failure)
+    if failures:
+        return 1
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main())
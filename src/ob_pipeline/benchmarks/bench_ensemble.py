@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+# Copyright 2023 Population Health Sciences and AI in Medical Imaging, German Center for Neurodegenerative Diseases (DZNE)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Benchmark of the sequential vs concurrent (--ensemble_workers) segmentation ensemble on random-weight models.
+Every (cores, workers) configuration runs in a fresh process limited to that number of torch threads.
+
+Example: python -m ob_pipeline.benchmarks.bench_ensemble -size 96 -splits 4 -cores 4 16 64 -workers 1 2 4 8
+"""
+
+import argparse
+import multiprocessing as mp
+import os
+import shutil
+import tempfile
+import time
+from collections import namedtuple
+
+
+def run_ensemble(model_dir, size, batch_size, cores, workers, repeats, queue):
+    import logging
+    import torch
+    from ob_pipeline.models.OBNet import OBNet
+    from ob_pipeline.benchmarks.synthetic import synthetic_volume
+    from ob_pipeline.ob_pipeline import read_config, get_full_paths
+    from ob_pipeline.utils.ensemble import EnsembleAccumulator
+
+    torch.set_num_threads(cores)
+
+    args = namedtuple('ArgNamespace', ['no_cuda', 'save_logits'])
+    args.no_cuda = True
+    args.save_logits = False
+
+    arc = 'AttFastSurferCNN'
+    models = get_full_paths(read_config(os.path.join(model_dir, arc, arc + '_weights.yml')), model_dir)
+    flags = {'batch_size': batch_size, 'thickness': 1, 'ensemble_workers': workers, 'model_cache_size': len(models)}
+
+    logger = logging.getLogger('bench_ensemble')
+    net = OBNet(args, flags, logger)
+    params = net.seg_params_network
+    arr = synthetic_volume((size, size, size))
+
+    times = []
+    # the first run loads the models into the cache
+    for _ in range(repeats + 1):
+        ensemble = EnsembleAccumulator(arr.shape + (params['num_classes'],), len(models))
+        start = time.time()
+        net.run_ensemble(arr, models, arc, params, [size, size], ensemble)
+        times.append(time.time() - start)
+
+    queue.put({'cores': cores, 'workers': workers, 'time': min(times[1:])})
+
+
+def run_config(model_dir, size, batch_size, cores, workers, repeats):
+    ctx = mp.get_context('spawn')
+    queue = ctx.Queue()
+    proc = ctx.Process(target=run_ensemble, args=(model_dir, size, batch_size, cores, workers, repeats, queue))
+    proc.start()
+    result = queue.get()
+    proc.join()
+    return result
+
+
+def main():
+    from ob_pipeline.benchmarks.synthetic import random_checkpoints
+    from ob_pipeline.models.OBNet import OBNet
+
+    parser = argparse.ArgumentParser(description='Benchmark sequential vs concurrent ensemble execution',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-size', '--size', type=int, default=96, help='segmentation crop size')
+    parser.add_argument('-splits', '--splits', type=int, default=4, help='checkpoints per plane')
+    parser.add_argument('-batch', '--batch_size', type=int, default=16, help='number of slices per batch')
+    parser.add_argument('-cores', '--cores', type=int, nargs='+', default=[1, 2, 4], help='torch threads')
+    parser.add_argument('-workers', '--workers', type=int, nargs='+', default=[1, 2, 4],
+                        help='concurrent models (1: sequential)')
+    parser.add_argument('-repeats', '--repeats', type=int, default=2, help='timed runs per configuration')
+    args = parser.parse_args()
+
+    model_dir = tempfile.mkdtemp()
+    try:
+        random_checkpoints(model_dir, 'AttFastSurferCNN', OBNet.seg_params_network, num_splits=args.splits)
+
+        print('{:>6} {:>8} {:>10} {:>9}'.format('cores', 'workers', 'time [s]', 'speedup'))
+        for cores in args.cores:
+            sequential = None
+            for workers in args.workers:
+                result = run_config(model_dir, args.size, args.batch_size, cores, workers, args.repeats)
+                if workers == 1:
+                    sequential = result['time']
+                speedup = '{:.2f}'.format(sequential / result['time']) if sequential else '-'
+                print('{:>6} {:>8} {:>10.3f} {:>9}'.format(cores, workers, result['time'], speedup))
+    finally:
+        shutil.rmtree(model_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+
+# Copyright 2023 Population Health Sciences and AI in Medical Imaging, German Center for Neurodegenerative Diseases (DZNE)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Micro-benchmarks of the pipeline hot paths on synthetic volumes and random-weight networks (no model weights needed).
+For every function the best and median time over the repeats and the peak memory of one call are reported: numpy /
+python allocations (tracemalloc) and torch CPU allocations (autograd profiler) are measured separately.
+The results can be saved as json and compared with a previous run to catch performance regressions.
+
+Example: python -m ob_pipeline.benchmarks.bench_hotpaths -size 256 -crop 96 -repeats 5 -save bench.json
+         python -m ob_pipeline.benchmarks.bench_hotpaths -compare bench.json -tolerance 0.2
+"""
+
+import argparse
+import json
+import logging
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import namedtuple
+
+import numpy as np
+
+
+def measure(fn, repeats):
+    """
+    :param fn: function without arguments
+    :param int repeats: timed calls (after one warm-up call)
+    :return dict: best and median time in s, numpy and torch peak memory in bytes (None if not measurable)
+    """
+    import torch
+    from ob_pipeline.models.batch_tuner import cpu_peak_memory
+
+    fn()
+
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        fn()
+        numpy_peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    with torch.no_grad():
+        torch_peak = cpu_peak_memory(fn)
+
+    return {'best': min(times), 'median': float(np.median(times)), 'numpy_peak': numpy_peak,
+            'torch_peak': torch_peak}
+
+
+def hotpaths(size, crop, zoom, batch_size, num_models, tmp_dir, loc_batch_size=None, seg_batch_size=None,
+             memory_budget=0):
+    """
+    Benchmarked functions on synthetic inputs
+    :param int size: edge of the synthetic T2 volume
+    :param int crop: edge of the segmentation crop (segmentation network input size)
+    :param float zoom: voxel size of the synthetic T2
+    :param int batch_size: slices per forward pass of OBNet.predict, None: as --auto_batch_size of the pipeline, the
+                           largest batch fitting the memory budget
+    :param int num_models: ensemble members of the probabilities given to calculate_stats
+    :param str tmp_dir: output directory of the stats and QC images
+    :param int loc_batch_size: batch size of the localization network (default: batch_size)
+    :param int seg_batch_size: batch size of the segmentation network (default: batch_size)
+    :param float memory_budget: memory budget of the tuned batch sizes in MB (0: 80% of the free memory)
+    :return tuple: list of (name, function without arguments), {arc: batch size of OBNet.predict}
+    """
+    import os
+    import nibabel as nib
+    import torch
+    from ob_pipeline.benchmarks.synthetic import synthetic_image, synthetic_volume
+    from ob_pipeline.models.OBNet import OBNet, select_model
+    from ob_pipeline.utils import conform, stats, visualization
+    from ob_pipeline.utils.image_utils import plane_swap, map_size, get_thick_slices, clean_seg
+    from ob_pipeline.utils.resample import ENGINES, resample_to_output
+
+    logger = logging.getLogger('bench_hotpaths')
+    # the batch sizes are resolved as in the pipeline (OBNet.stage_batch_size), 16 is the fallback of
+    # run_ob_pipeline when the memory cannot be measured
+    flags = {'base_ornt': np.array([[0, -1], [1, 1], [2, 1]]), 'thickness': 1, 'batch_size': batch_size or 16,
+             'localization_batch_size': loc_batch_size, 'segmentation_batch_size': seg_batch_size,
+             'auto_batch_size': batch_size is None, 'memory_budget': memory_budget,
+             'localization': {'imgSize': [192, 192], 'spacing': [1.6, 1.6, 1.6]}}
+
+    img = synthetic_image((size,) * 3, zooms=(zoom,) * 3)
+    arr = synthetic_volume((size,) * 3)
+
+    args = namedtuple('ArgNamespace', ['no_cuda', 'save_logits', 'sub_id', 'in_img'])
+    args.no_cuda = True
+    args.save_logits = False
+    args.sub_id = 'synthetic'
+    args.in_img = os.path.join(tmp_dir, 'synthetic_T2.nii.gz')
+    net = OBNet(args, flags, logger)
+
+    # segmentation crop with a bulb on each side of the center
+    crop_img = nib.Nifti1Image(synthetic_volume((crop,) * 3, seed=1), np.diag([0.8, 0.8, 0.8, 1.0]))
+    grid = np.meshgrid(*[np.linspace(-1, 1, crop)] * 3, indexing='ij')
+    labels = np.zeros((crop,) * 3)
+    for label, side in ((1, -0.3), (2, 0.3)):
+        labels[((grid[0] - side) / 0.15) ** 2 + (grid[1] / 0.4) ** 2 + (grid[2] / 0.2) ** 2 < 1] = label
+    pred_img = nib.MGHImage(labels.astype(np.int16), crop_img.affine, crop_img.header)
+    ras_cm = np.dot(crop_img.affine, np.array([crop // 2] * 3 + [1]))
+
+    rng = np.random.RandomState(0)
+    probs = rng.uniform(size=(crop,) * 3 + (2, num_models))
+    probs[..., 1, :] = np.clip(probs[..., 1, :] * 0.2 + (labels > 0)[..., None] * 0.7, 0, 1)
+    probs[..., 0, :] = 1 - probs[..., 1, :]
+    cm = {'xyz': np.array([size // 2] * 3), 'ras': ras_cm, 'zero_xyz': np.array([size // 2 - crop // 2] * 3),
+          'num_models': num_models}
+    heatmap = (synthetic_volume((size // 2,) * 3, seed=2) > 150) * 0.9
+
+    for folder in ('stats', 'QC'):
+        os.makedirs(os.path.join(tmp_dir, folder))
+
+    # thick slices views as given by OBNet.prepare_plane, predict normalizes them batch by batch: the localization
+    # network sees the volume at 1.6 mm in 192 x 192 slices, the segmentation network the crop at 0.8 mm
+    loc_size = flags['localization']['imgSize']
+    loc_slices = max(1, int(round(size * zoom / flags['localization']['spacing'][0])))
+    stages = [('localization', 'FastSurferCNN', OBNet.loc_params_network, (loc_slices, loc_size[0], loc_size[1])),
+              ('segmentation', 'AttFastSurferCNN', OBNet.seg_params_network, (size, crop, crop))]
+    networks = []
+    batch_sizes = {}
+    for stage, arc, params, shape in stages:
+        thick = get_thick_slices(map_size(plane_swap(arr, 'coronal'), shape, verbose=0), flags['thickness'])
+        inputs = thick.transpose((0, 3, 1, 2))
+        torch.manual_seed(0)
+        model = select_model(arc, params).eval()
+        batch_sizes[arc] = net.stage_batch_size(stage, arc, model, inputs)
+        networks.append((arc, model, inputs))
+
+    functions = [
+        ('conform.conform', lambda: conform.conform(img, flags, logger)),
+    ]
+    for engine in ENGINES:
+        functions.append(('resample_to_output {}'.format(engine),
+                          (lambda engine: lambda: resample_to_output(img, 1.6, engine=engine))(engine)))
+    functions += [
+        ('image_utils.plane_swap', lambda: plane_swap(arr, 'coronal')),
+        ('image_utils.map_size', lambda: map_size(arr, (size, crop, crop), verbose=0)),
+        ('image_utils.get_thick_slices', lambda: get_thick_slices(arr, 3)),
+    ]
+    for arc, model, inputs in networks:
+        functions.append(('OBNet.predict {}'.format(arc),
+                          (lambda model, inputs, batch: lambda: net.predict(inputs, batch, model))(
+                              model, inputs, batch_sizes[arc])))
+    functions += [
+        ('image_utils.clean_seg', lambda: clean_seg(pred_img, ras_cm)),
+        ('stats.calculate_stats', lambda: stats.calculate_stats(args, tmp_dir, image=crop_img, prediction=pred_img,
+                                                                logits=probs, cm=cm, cm_logits=heatmap,
+                                                                logger=logger)),
+    ]
+
+    try:
+        import nilearn
+    except ImportError:
+        logger.warning('nilearn not installed, visualization.plot_qc_images not benchmarked')
+    else:
+        functions.append(('visualization.plot_qc_images',
+                          lambda: visualization.plot_qc_images(tmp_dir, crop_img, pred_img)))
+
+    return functions, batch_sizes
+
+
+def regressions(results, baseline, tolerance):
+    """
+    :param dict results: {name: measure}
+    :param dict baseline: {name: measure} of a previous run
+    :param float tolerance: relative slowdown of the best time allowed
+    :return list: (name, baseline time, time) of the functions slower than the tolerance
+    """
+    slower = []
+    for name, result in results.items():
+        if name in baseline and result['best'] > baseline[name]['best'] * (1 + tolerance):
+            slower.append((name, baseline[name]['best'], result['best']))
+    return slower
+
+
+def main():
+    import torch
+
+    parser = argparse.ArgumentParser(description='Time and peak memory of the pipeline hot paths',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-size', '--size', type=int, default=256, help='edge of the synthetic T2 volume')
+    parser.add_argument('-crop', '--crop', type=int, default=96, help='edge of the segmentation crop')
+    parser.add_argument('-zoom', '--zoom', type=float, default=0.8, help='voxel size of the synthetic T2 in mm')
+    parser.add_argument('-batch', '--batch_size', type=int,
+                        help='slices per forward pass of the networks (default: the largest batch fitting the memory '\
+                        'budget, as --auto_batch_size of the pipeline)')
+    parser.add_argument('-loc_batch', '--loc_batch_size', type=int,
+                        help='slices per forward pass of the localization network (default: --batch_size)')
+    parser.add_argument('-seg_batch', '--seg_batch_size', type=int,
+                        help='slices per forward pass of the segmentation network (default: --batch_size)')
+    parser.add_argument('-mem_budget', '--memory_budget', type=float, default=0,
+                        help='memory budget of the tuned batch sizes in MB (0: 80%% of the free memory)')
+    parser.add_argument('-models', '--num_models', type=int, default=12,
+                        help='ensemble members of the calculate_stats probabilities')
+    parser.add_argument('-repeats', '--repeats', type=int, default=3, help='timed calls per function')
+    parser.add_argument('-threads', '--threads', type=int, default=0, help='torch threads (0: torch default)')
+    parser.add_argument('-only', '--only', nargs='+', help='benchmark only the functions containing these names')
+    parser.add_argument('-save', '--save', help='write the results to this json file')
+    parser.add_argument('-compare', '--compare', help='json results of a previous run')
+    parser.add_argument('-tolerance', '--tolerance', type=float, default=0.2,
+                        help='relative slowdown reported as a regression')
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    tmp_dir = tempfile.mkdtemp()
+    results = {}
+    try:
+        functions, batch_sizes = hotpaths(args.size, args.crop, args.zoom, args.batch_size, args.num_models, tmp_dir,
+                                          loc_batch_size=args.loc_batch_size, seg_batch_size=args.seg_batch_size,
+                                          memory_budget=args.memory_budget)
+        print('batch sizes: {}'.format(', '.join('{} {}'.format(arc, size) for arc, size in batch_sizes.items())))
+        if args.only:
+            functions = [(name, fn) for name, fn in functions if any(key in name for key in args.only)]
+
+        print('{:>32} {:>10} {:>12} {:>14} {:>14}'.format('function', 'best [s]', 'median [s]', 'numpy [MB]',
+                                                           'torch [MB]'))
+        for name, fn in functions:
+            result = measure(fn, args.repeats)
+            results[name] = result
+            torch_peak = '{:.1f}'.format(result['torch_peak'] / 2.0 ** 20) if result['torch_peak'] is not None \
+                else '-'
+            print('{:>32} {:>10.4f} {:>12.4f} {:>14.1f} {:>14}'.format(name, result['best'], result['median'],
+                                                                       result['numpy_peak'] / 2.0 ** 20,
+                                                                       torch_peak))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    config = {'size': args.size, 'crop': args.crop, 'zoom': args.zoom, 'batch_sizes': batch_sizes,
+              'num_models': args.num_models, 'threads': torch.get_num_threads()}
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'config': config, 'results': results}, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline['config'] != config:
+            print('Baseline configuration {} differs from {}'.format(baseline['config'], config))
+
+        slower = regressions(results, baseline['results'], args.tolerance)
+        for name, before, after in slower:
+            print('REGRESSION {}: {:.4f} s -> {:.4f} s ({:+.0%})'.format(name, before, after, after / before - 1))
+        if slower:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
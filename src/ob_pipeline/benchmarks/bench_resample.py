@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+# Copyright 2023 Population Health Sciences and AI in Medical Imaging, German Center for Neurodegenerative Diseases (DZNE)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Parity and speed of the resampling engines (--resample_engine) against nibabel.processing.resample_to_output on
+synthetic T2 volumes of different voxel sizes, resampled to the segmentation (0.8 mm) and localization (1.6 mm)
+resolutions. The voxel mappings are first checked on their own against scipy.ndimage.affine_transform (the nibabel
+engine) for downsampling, upsampling and samples on, inside and outside of the edges of the input, where the constant
+mode of scipy changed across versions. Exits with an error if an engine differs by more than the tolerance.
+
+Example: python -m ob_pipeline.benchmarks.bench_resample -zooms 0.8,0.8,0.8 0.6,0.6,1.2 -threads 4
+"""
+
+import argparse
+import sys
+import time
+
+
+def best_time(fn, repeats):
+    """
+    :return tuple: output of fn and its best time in s over repeats calls
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        out = fn()
+        times.append(time.perf_counter() - start)
+    return out, min(times)
+
+
+def edge_cases(shape=(9, 10, 11), seed=0):
+    """
+    :return list: (name, data, rzs, trans, output shape) of diagonal voxel mappings
+    """
+    import numpy as np
+
+    data = np.random.RandomState(seed).uniform(0, 255, shape)
+    last = np.array(shape, dtype=float) - 1
+    cases = [('downsample', np.diag([2.0, 2.0, 2.0]), np.zeros(3), (5, 5, 6)),
+             ('upsample', np.diag([0.5, 0.4, 0.75]), np.zeros(3), (17, 23, 14)),
+             ('anisotropic', np.diag([1.333, 0.75, 1.5]), np.array([0.25, 0.5, 0.1]), (7, 13, 7)),
+             ('below edge', np.eye(3), np.array([-1.5, -0.25, -1e-7]), shape),
+             ('on edges', np.diag(last / 5.0), np.zeros(3), (6, 6, 6)),
+             ('above edge', np.eye(3), np.array([0.3, 1e-7, 1.0]), shape),
+             ('outside', np.eye(3), np.array([-20.0, 0.0, 0.0]), shape)]
+    return [(name, data, rzs, trans, out_shape) for name, rzs, trans, out_shape in cases]
+
+
+def main():
+    import numpy as np
+    import torch
+    from ob_pipeline.benchmarks.synthetic import synthetic_image
+    from ob_pipeline.utils.resample import ENGINES, affine_resample, resample_to_output
+
+    parser = argparse.ArgumentParser(description='Parity and speed of the resampling engines',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-fov', '--fov', type=float, default=192.0, help='field of view of the volumes in mm')
+    parser.add_argument('-zooms', '--zooms', nargs='+', default=['0.8,0.8,0.8', '0.6,0.6,1.2', '0.7,0.75,0.9'],
+                        help='voxel sizes of the input volumes (x,y,z in mm)')
+    parser.add_argument('-spacing', '--spacing', type=float, nargs='+', default=[0.8, 1.6],
+                        help='output voxel sizes in mm')
+    parser.add_argument('-repeats', '--repeats', type=int, default=3, help='timed calls per engine')
+    parser.add_argument('-threads', '--threads', type=int, default=0, help='torch threads (0: torch default)')
+    parser.add_argument('-tolerance', '--tolerance', type=float, default=1e-3,
+                        help='largest absolute difference to nibabel allowed (intensities in 0-255)')
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    engines = [engine for engine in ENGINES if engine != 'nibabel']
+    failures = []
+
+    print('{:>16} {:>12} {:>12}'.format('voxel mapping', 'engine', 'max diff'))
+    for name, data, rzs, trans, out_shape in edge_cases():
+        reference = affine_resample(data, rzs, trans, out_shape, engine='nibabel')
+        for engine in engines:
+            output = affine_resample(data, rzs, trans, out_shape, engine=engine)
+            diff = np.max(np.abs(output - reference)) if output.shape == reference.shape else np.inf
+            print('{:>16} {:>12} {:>12.2e}'.format(name, engine, diff))
+            if not diff <= args.tolerance:
+                failures.append('{} {}: max difference {:.2e} to scipy'.format(engine, name, diff))
+    print()
+
+    print('{:>16} {:>8} {:>12} {:>14} {:>10} {:>10} {:>12}'.format('input zooms', 'spacing', 'engine',
+                                                                   'nibabel [s]', 'engine [s]', 'speedup',
+                                                                   'max diff'))
+    for zooms in args.zooms:
+        zooms = tuple(float(zoom) for zoom in zooms.split(','))
+        shape = tuple(int(round(args.fov / zoom)) for zoom in zooms)
+        img = synthetic_image(shape, zooms=zooms)
+
+        for spacing in args.spacing:
+            reference, ref_time = best_time(lambda: resample_to_output(img, spacing, engine='nibabel'), args.repeats)
+            reference = np.asanyarray(reference.dataobj)
+
+            for engine in engines:
+                output, engine_time = best_time(lambda: resample_to_output(img, spacing, engine=engine),
+                                                args.repeats)
+                output = np.asanyarray(output.dataobj)
+                diff = np.max(np.abs(output - reference)) if output.shape == reference.shape else np.inf
+
+                print('{:>16} {:>8.2f} {:>12} {:>14.4f} {:>10.4f} {:>9.1f}x {:>12.2e}'.format(
+                    'x'.join('{:g}'.format(zoom) for zoom in zooms), spacing, engine, ref_time, engine_time,
+                    ref_time / engine_time, diff))
+                if not diff <= args.tolerance:
+                    failures.append('{} {} -> {} mm: max difference {:.2e} to nibabel'.format(engine, zooms, spacing,
+                                                                                              diff))
+
+    for failure in failures:
+        print('PARITY ' + failure)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+# Copyright 2023 Population Health Sciences and AI in Medical Imaging, German Center for Neurodegenerative Diseases (DZNE)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Regression comparison of the ROI-aware segmentation (--roi_pruning) against full inference.
+For every image and ROI margin the segmentation time, the Dice and the volume differences of the bulbs are reported.
+
+Example: python -m ob_pipeline.benchmarks.bench_roi -in_img sub1_T2.nii.gz sub2_T2.nii.gz -margins 4 8 16
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from collections import namedtuple
+
+
+def segment(img, flags, logger):
+    import numpy as np
+    from ob_pipeline.models.OBNet import OBNet
+
+    args = namedtuple('ArgNamespace', ['no_cuda', 'save_logits'])
+    args.no_cuda = True
+    args.save_logits = False
+
+    save_dir = tempfile.mkdtemp()
+    try:
+        start = time.time()
+        pred_img, _, _, coords, _ = OBNet(args, flags, logger).eval(img, save_dir)
+        elapsed = time.time() - start
+    finally:
+        shutil.rmtree(save_dir)
+
+    if not coords:
+        return None, elapsed
+
+    return np.asarray(pred_img.dataobj), elapsed
+
+
+def main():
+    import numpy as np
+    import nibabel as nib
+    from ob_pipeline.configoptions import seg_dir, loc_dir
+    from ob_pipeline.ob_pipeline import set_up_model
+    from ob_pipeline.utils import conform, misc
+    from ob_pipeline.utils.validation import compare_segmentations
+
+    parser = argparse.ArgumentParser(description='Compare ROI-aware segmentation with full inference',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-in_img', '--in_img', nargs='+', required=True, help='T2 images')
+    parser.add_argument('-margins', '--margins', type=float, nargs='+', default=[4.0, 8.0, 16.0],
+                        help='ROI margins in mm')
+    parser.add_argument('-model', '--model', type=int, default=5, help='model number')
+    parser.add_argument('-batch_size', '--batch_size', type=int, default=8, help='slices per batch')
+    parser.add_argument('-seg_dir', '--seg_dir', default=seg_dir, help='Segmentation weights directory')
+    parser.add_argument('-loc_dir', '--loc_dir', default=loc_dir, help='Localization weights directory')
+    args = parser.parse_args()
+
+    logger = misc.setup_logger(os.path.join(tempfile.gettempdir(), 'ob_bench_roi.txt'))
+    flags = set_up_model(model=args.model, batch_size=args.batch_size, seg_dir=args.seg_dir,
+                         seg_arc='AttFastSurferCNN', loc_dir=args.loc_dir, loc_arc='FastSurferCNN')
+
+    rows = []
+    for in_img in args.in_img:
+        img = conform.conform(nib.load(in_img), flags, logger)
+        voxel_volume = float(np.prod(img.header.get_zooms()[:3]))
+
+        reference, ref_time = segment(img, dict(flags, roi_pruning=False), logger)
+        if reference is None:
+            logger.info('{}: no olfactory bulb localized, skipped'.format(in_img))
+            continue
+
+        for margin in args.margins:
+            prediction, roi_time = segment(img, dict(flags, roi_pruning=True, roi_margin=margin), logger)
+            measures = compare_segmentations(reference, prediction, voxel_volume=voxel_volume)
+            rows.append((os.path.basename(in_img), margin, ref_time, roi_time, measures))
+
+    print('{:>24} {:>8} {:>10} {:>10} {:>8} {:>8} {:>8} {:>12}'.format('image', 'margin', 'full [s]', 'roi [s]',
+                                                                      'dice L', 'dice R', 'dice T',
+                                                                      'vol diff T'))
+    for name, margin, ref_time, roi_time, measures in rows:
+        print('{:>24} {:>8.1f} {:>10.2f} {:>10.2f} {:>8.4f} {:>8.4f} {:>8.4f} {:>12.2%}'.format(
+            name[-24:], margin, ref_time, roi_time, measures['left']['dice'], measures['right']['dice'],
+            measures['total']['dice'], measures['total']['volume_diff']))
+
+
+if __name__ == '__main__':
+    main()
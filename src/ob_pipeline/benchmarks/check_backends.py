@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+# Copyright 2023 Population Health Sciences and AI in Medical Imaging, German Center for Neurodegenerative Diseases (DZNE)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Equivalence of the exported backends (ob_export_models) with the eager networks on random-weight checkpoints, no
+trained weights needed: the checkpoints of both architectures are exported to a temporary directory and the logits
+of every artifact are compared with the eager network on random batches (see export_models.check_equivalence).
+The int8 models change the logits by design, only their labels are compared (random weights quantize worse than
+trained ones, a broken graph agrees on about half of the pixels). stacked compares the vmapped ensemble of the
+checkpoints of a plane (--stacked_ensemble) with the networks evaluated one after the other. Exits with an error if a
+backend differs by more than the tolerance.
+
+Example: python -m ob_pipeline.benchmarks.check_backends -backends torchscript onnx onnx_int8 stacked
+"""
+
+import argparse
+import shutil
+import sys
+import tempfile
+
+BACKENDS = ('torchscript', 'onnx', 'onnx_int8', 'stacked')
+
+
+def main():
+    import torch
+    from ob_pipeline.benchmarks.synthetic import random_checkpoints
+    from ob_pipeline.export_models import compare_logits, export_models, load_artifact
+    from ob_pipeline.models.OBNet import OBNet, artifact_path, load_model
+    from ob_pipeline.models.stacked_ensemble import StackedEnsemble, compare_members, stacking_available
+
+    parser = argparse.ArgumentParser(description='Equivalence of the exported backends with the eager networks',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-backends', '--backends', nargs='+', choices=BACKENDS, default=list(BACKENDS),
+                        help='exported backends to check')
+    parser.add_argument('-size', '--size', type=int, nargs='+', default=[64, 96],
+                        help='slice sizes of the checks, the first one is the export example')
+    parser.add_argument('-atol', '--atol', type=float, default=1e-3,
+                        help='largest median absolute logit difference to the eager network allowed')
+    parser.add_argument('-agreement', '--agreement', type=float, default=0.999,
+                        help='lowest fraction of pixels with the label of the eager network (or of the networks '\
+                        'evaluated one after the other for stacked)')
+    parser.add_argument('-int8_agreement', '--int8_agreement', type=float, default=0.7,
+                        help='lowest fraction of pixels with the label of the eager network for onnx_int8')
+    args = parser.parse_args()
+
+    model_dir = tempfile.mkdtemp()
+    failures = []
+    try:
+        stages = [('localization', 'FastSurferCNN', OBNet.loc_params_network),
+                  ('segmentation', 'AttFastSurferCNN', OBNet.seg_params_network)]
+        flags = {}
+        for stage, arc, params in stages:
+            # random BatchNorm statistics, so that the folding of the export is checked too
+            models = random_checkpoints(model_dir, arc, params.copy(), bn_stats=True)
+            flags[stage[:3] + '_arc'] = arc
+            flags[stage] = {'imgSize': [args.size[0]] * 2, 'models': models}
+
+        print('{:>12} {:>18} {:>12} {:>6} {:>12} {:>10} {:>10}'.format('backend', 'arc', 'checkpoint', 'size',
+                                                                       'median diff', 'max diff', 'agreement'))
+        for backend in args.backends:
+            if backend == 'stacked':
+                continue
+            export_models(flags, backend=backend, atol=args.atol, overwrite=True)
+
+            for stage, arc, params in stages:
+                for name, checkpoint in sorted(flags[stage]['models'].items()):
+                    model = load_model(arc, params, checkpoint, torch.device('cpu'))
+                    exported = load_artifact(artifact_path(checkpoint, backend), backend)
+
+                    for size in args.size:
+                        measures = compare_logits(model, exported, (size, size))
+                        print('{:>12} {:>18} {:>12} {:>6} {:>12.2e} {:>10.2e} {:>10.4%}'.format(
+                            backend, arc, name, size, measures['median_diff'], measures['max_diff'],
+                            measures['agreement']))
+                        if backend == 'onnx_int8':
+                            passed = measures['agreement'] >= args.int8_agreement
+                        else:
+                            passed = measures['median_diff'] <= args.atol and measures['agreement'] >= args.agreement
+                        if not passed:
+                            failures.append((backend, arc, name, size, measures))
+
+        if 'stacked' in args.backends and not stacking_available():
+            print('stacked: torch.func not available (torch >= 2.0), skipped')
+        elif 'stacked' in args.backends:
+            for stage, arc, params in stages:
+                # three checkpoints per plane, stacked like the splits of the released models
+                models = random_checkpoints(model_dir, arc, params.copy(), num_splits=3, seed=1, bn_stats=True)
+                for plane in ('axial', 'coronal', 'sagittal'):
+                    names = sorted(name for name in models if name.startswith(plane))
+                    members = [load_model(arc, params, models[name], torch.device('cpu')) for name in names]
+                    stacked = StackedEnsemble(members)
+
+                    for size in args.size:
+                        # one slice per forward pass, the stacked attention holds the maps of every member
+                        images = torch.rand(3, params['num_channels'], size, size,
+                                            generator=torch.Generator().manual_seed(0))
+                        for name, measures in zip(names, compare_members(stacked, members, images)):
+                            print('{:>12} {:>18} {:>12} {:>6} {:>12.2e} {:>10.2e} {:>10.4%}'.format(
+                                'stacked', arc, name, size, measures['median_diff'], measures['max_diff'],
+                                measures['agreement']))
+                            if measures['median_diff'] > args.atol or measures['agreement'] < args.agreement:
+                                failures.append(('stacked', arc, name, size, measures))
+    finally:
+        shutil.rmtree(model_dir)
+
+    for backend, arc, name, size, measures in failures:
+        print('EQUIVALENCE {} {} {} ({}x{}): median difference {:.2e}, label agreement {:.4%} to the eager '
+              'network'.format(backend, arc, name, size, size, measures['median_diff'], measures['agreement']))
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+# Copyright 2023 Population Health Sciences and AI in Medical Imaging, German Center for Neurodegenerative Diseases (DZNE)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Synthetic inputs for the benchmarks: random-weight checkpoints laid out like the released models and T2-like volumes,
+so the benchmarks run without the (git-LFS) weights
+"""
+
+import os
+
+import numpy as np
+
+PLANES = ('axial', 'coronal', 'sagittal')
+
+
+def random_checkpoints(out_dir, arc, params, num_splits=1, seed=0, bn_stats=False):
+    """
+    Save random-weight checkpoints and their weights yml as <out_dir>/<arc>/ (same layout as the model directories)
+    :param str out_dir: model directory (seg_dir or loc_dir of set_up_model)
+    :param str arc: FastSurferCNN or AttFastSurferCNN
+    :param dict params: network parameters
+    :param int num_splits: checkpoints per plane
+    :param int seed: torch seed
+    :param bool bn_stats: random BatchNorm statistics and affine parameters, as trained networks have (the initial
+                          ones make BatchNorm an identity in eval mode)
+    :return dict: checkpoints {name: path}
+    """
+    import torch
+    import yaml
+    from ob_pipeline.models.OBNet import select_model
+
+    arc_dir = os.path.join(out_dir, arc)
+    if not os.path.isdir(arc_dir):
+        os.makedirs(arc_dir)
+
+    torch.manual_seed(seed)
+    models = {}
+    weights = {}
+
+    for split in range(1, num_splits + 1):
+        for plane in PLANES:
+            model = select_model(arc, params)
+            if bn_stats:
+                randomize_batchnorm(model)
+            filename = 'v1_split_{}_{}_{}.pkl'.format(split, arc, plane)
+            path = os.path.join(arc_dir, filename)
+            torch.save({'model_state_dict': model.state_dict()}, path)
+
+            name = '{}_{}'.format(plane, split)
+            weights[name] = filename
+            models[name] = path
+
+    with open(os.path.join(arc_dir, arc + '_weights.yml'), 'w') as f:
+        yaml.dump(weights, f)
+
+    return models
+
+
+def randomize_batchnorm(model):
+    """
+    Draw the statistics and affine parameters of the BatchNorm layers of a network (in place)
+    """
+    import torch
+    import torch.nn as nn
+
+    with torch.no_grad():
+        for m in model.modules():
+            if isinstance(m, nn.BatchNorm2d):
+                m.running_mean.uniform_(-0.5, 0.5)
+                m.running_var.uniform_(0.5, 2.0)
+                if m.affine:
+                    m.weight.uniform_(0.5, 1.5)
+                    m.bias.uniform_(-0.5, 0.5)
+
+
+def synthetic_volume(shape, seed=0):
+    """
+    T2-like volume: smooth background with two bright ellipsoids (bulb-like) and noise, values in 0-255
+    :param tuple shape: volume shape
+    :return np.ndarray: float64 volume
+    """
+    rng = np.random.RandomState(seed)
+    grid = np.meshgrid(*[np.linspace(-1, 1, n) for n in shape], indexing='ij')
+
+    arr = 60 + 40 * np.exp(-(grid[0] ** 2 + grid[1] ** 2 + grid[2] ** 2))
+    for side in (-0.15, 0.15):
+        blob = ((grid[0] - side) / 0.08) ** 2 + (grid[1] / 0.25) ** 2 + (grid[2] / 0.1) ** 2
+        arr[blob < 1] = 200
+
+    arr += rng.normal(0, 5, size=shape)
+    return np.clip(arr, 0, 255)
+
+
+def synthetic_image(shape, zooms=(0.8, 0.8, 0.8), seed=0):
+    """
+    :return nib.Nifti1Image: synthetic_volume with an axis aligned affine of voxel size zooms
+    """
+    import nibabel as nib
+
+    affine = np.diag(list(zooms) + [1.0])
+    affine[:3, 3] = -np.array(shape) * np.array(zooms) / 2.0
+
+    img = nib.Nifti1Image(synthetic_volume(shape, seed).astype(np.float32), affine)
+    img.header.set_zooms(zooms)
+    return img
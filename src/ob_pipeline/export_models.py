@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+
+# Copyright 2023 Population Health Sciences and AI in Medical Imaging, German Center for Neurodegenerative Diseases (DZNE)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Export the localization and segmentation checkpoints (.pkl) into inference only artifacts that OBNet can load
+directly (--backend option of run_ob_pipeline). Every exported model is checked against the eager network,
+the int8 quantized models are validated against the fp32 ensemble on reference images instead.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import inspect
+import argparse
+
+import numpy as np
+import torch
+
+from ob_pipeline.configoptions import seg_dir, loc_dir
+from ob_pipeline.models.OBNet import OBNet, load_model, artifact_path, validation_path
+from ob_pipeline.models.onnx_model import OnnxModel
+from ob_pipeline.models.optimize import make_traceable
+
+
+def export_torchscript(model, example, path):
+    """
+    Trace a network and save it as a TorchScript module, frozen when supported by torch (>= 1.8)
+    :param nn.Module model: eager network in eval mode, BatchNorm already folded (see export_models)
+    :param tensor example: example input batch
+    :param str path: output file
+    """
+    with torch.no_grad():
+        traced = torch.jit.trace(model, example)
+
+        # freezing inlines the weights; optimize_for_inference is applied at load time only, its prepacked ops can
+        # not be serialized
+        if hasattr(torch.jit, 'freeze'):
+            traced = torch.jit.freeze(traced)
+
+    traced.save(path)
+
+
+def export_onnx(model, example, path, opset_version=11):
+    """
+    Export a network to ONNX with dynamic batch and image dimensions
+    :param nn.Module model: eager network in eval mode
+    :param tensor example: example input batch
+    :param str path: output file
+    :param int opset_version: ONNX opset (11 is the lowest with ScatterElements, used by the unpooling)
+    """
+    kwargs = {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        # keep the TorchScript based exporter, the models are traced like for the torchscript backend
+        kwargs['dynamo'] = False
+
+    dynamic_axes = {'input': {0: 'batch', 2: 'height', 3: 'width'},
+                    'logits': {0: 'batch', 2: 'height', 3: 'width'}}
+
+    with torch.no_grad():
+        torch.onnx.export(model, example, path, input_names=['input'], output_names=['logits'],
+                          dynamic_axes=dynamic_axes, opset_version=opset_version, **kwargs)
+
+
+def quantize_onnx(path, quantized_path):
+    """
+    Dynamic int8 quantization of the convolution weights of an exported ONNX model (activations are quantized
+    on the fly, no calibration data needed)
+    :param str path: fp32 .onnx model
+    :param str quantized_path: output file
+    """
+    try:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+    except ImportError:
+        raise ImportError('The onnx_int8 backend requires onnxruntime (pip install onnxruntime)')
+
+    # the CPU ConvInteger kernel is only implemented for uint8 weights
+    quantize_dynamic(path, quantized_path, weight_type=QuantType.QUInt8)
+
+
+def load_artifact(path, backend):
+    if backend == 'torchscript':
+        return torch.jit.load(path, map_location='cpu')
+    elif backend in ('onnx', 'onnx_int8'):
+        return OnnxModel(path)
+    raise ValueError('Backend {} not supported'.format(backend))
+
+
+def compare_logits(model, exported, img_size, num_slices=3, seed=0):
+    """
+    Logits of the exported and the eager network on a random batch (of a different size than the export example)
+    :return dict: max_diff and median_diff (absolute logit differences), agreement (fraction of pixels with the
+                  same label)
+    """
+    example = torch.rand(num_slices, 3, img_size[0], img_size[1], generator=torch.Generator().manual_seed(seed))
+
+    with torch.no_grad():
+        reference = model(example)
+        output = exported(example)
+
+    diff = torch.abs(reference - output)
+    return {'max_diff': float(torch.max(diff)), 'median_diff': float(torch.median(diff)),
+            'agreement': float(torch.mean((reference.argmax(1) == output.argmax(1)).float()))}
+
+
+def check_equivalence(model, exported, img_size, atol, min_agreement=0.999):
+    """
+    Compare the exported network with the eager one. Float rounding (BatchNorm folding, other kernels) can flip the
+    max pooling indices of near ties, which moves single logits by a lot, so the median difference and the labels
+    are checked instead of the largest difference.
+    :param float atol: largest median absolute logit difference
+    :param float min_agreement: lowest fraction of pixels with the same label
+    :return dict: see compare_logits
+    """
+    measures = compare_logits(model, exported, img_size)
+
+    if measures['median_diff'] > atol or measures['agreement'] < min_agreement:
+        raise RuntimeError('Exported model differs from the eager network (median abs diff {:.2e}, max {:.2e}, '
+                           'label agreement {:.4%})'.format(measures['median_diff'], measures['max_diff'],
+                                                           measures['agreement']))
+
+    return measures
+
+
+def export_models(flags, backend='torchscript', atol=1e-3, overwrite=False):
+    """
+    Export all the localization and segmentation checkpoints listed in the model flags
+    :param dict flags: flags from set_up_model
+    :param str backend: artifact format
+    :param float atol: tolerance of the equivalence check (median absolute logit difference)
+    :param bool overwrite: re-export existing artifacts
+    :return list: exported artifact paths
+    """
+    stages = [(flags['loc_arc'], OBNet.loc_params_network, flags['localization']),
+              (flags['seg_arc'], OBNet.seg_params_network, flags['segmentation'])]
+
+    exported = []
+
+    for arc, params, stage in stages:
+        img_size = stage['imgSize']
+
+        for checkpoint in stage['models'].values():
+            path = artifact_path(checkpoint, backend)
+
+            if os.path.isfile(path) and not overwrite:
+                print('{} exists, skipping (use --overwrite to export again)'.format(path))
+                continue
+
+            model = load_model(arc, params, checkpoint, torch.device('cpu'))
+            example = torch.rand(2, 3, img_size[0], img_size[1])
+
+            # the reference stays the unmodified eager network; the BatchNorm layers are folded on the eager copy,
+            # so the artifacts are folded with every torch version (torch.jit.freeze needs torch >= 1.8)
+            traceable = make_traceable(load_model(arc, params, checkpoint, torch.device('cpu'), fold_bn=True))
+
+            if backend == 'torchscript':
+                export_torchscript(traceable, example, path)
+            elif backend == 'onnx':
+                export_onnx(traceable, example, path)
+            elif backend == 'onnx_int8':
+                fp32_path = artifact_path(checkpoint, 'onnx')
+                if overwrite or not os.path.isfile(fp32_path):
+                    export_onnx(traceable, example, fp32_path)
+                quantize_onnx(fp32_path, path)
+            else:
+                raise ValueError('Backend {} not supported'.format(backend))
+
+            if backend == 'onnx_int8':
+                # quantization changes the logits by design, its accuracy is checked by validate_backend
+                print('Exported {} -> {}'.format(checkpoint, path))
+            else:
+                measures = check_equivalence(model, load_artifact(path, backend), img_size, atol)
+                print('Exported {} -> {} (median abs diff {:.2e}, max {:.2e})'.format(
+                    checkpoint, path, measures['median_diff'], measures['max_diff']))
+            exported.append(path)
+
+    return exported
+
+
+def full_volume_prediction(pred_img, coords, shape):
+    """
+    Place the cropped prediction of OBNet.eval back into the grid of the conformed input image
+    """
+    arr = np.zeros(shape, dtype=np.int16)
+    if coords:
+        crop = np.asarray(pred_img.dataobj).astype(np.int16)
+        x, y, z = coords['zero_xyz'][:3]
+        arr[x:x + crop.shape[0], y:y + crop.shape[1], z:z + crop.shape[2]] = crop
+    return arr
+
+
+def validate_backend(flags, backend, references, min_dice=0.95, max_volume_diff=0.05, logger=None):
+    """
+    Segment reference images with the fp32 torch ensemble and with the exported backend, compare the Dice and
+    volumes of the bulbs and store the outcome next to every artifact (OBNet refuses artifacts that did not pass)
+    :param dict flags: flags from set_up_model
+    :param str backend: exported backend to validate
+    :param list references: paths of the reference T2 images
+    :param float min_dice: lowest Dice accepted per structure and image
+    :param float max_volume_diff: largest relative volume difference accepted per structure and image
+    :return dict: validation report
+    """
+    import json
+    import shutil
+    import tempfile
+    from collections import namedtuple
+    import nibabel as nib
+    from ob_pipeline.utils import conform as conform
+    from ob_pipeline.utils import misc as misc
+    from ob_pipeline.utils.validation import compare_segmentations, agreement_failures
+
+    if logger is None:
+        logger = misc.setup_logger(os.path.join(tempfile.gettempdir(), 'ob_export_validation.txt'))
+
+    args = namedtuple('ArgNamespace', ['no_cuda', 'save_logits'])
+    args.no_cuda = True
+    args.save_logits = False
+
+    results = {}
+    failures = []
+    min_observed_dice = 1.0
+
+    for reference in references:
+        t2_img = conform.conform(nib.load(reference), flags, logger)
+        voxel_volume = float(np.prod(t2_img.header.get_zooms()[:3]))
+
+        predictions = []
+        for run_backend in ('torch', backend):
+            # the artifacts being validated have no report yet
+            run_flags = dict(flags, backend=run_backend, require_validation=False)
+            save_dir = tempfile.mkdtemp()
+            try:
+                pred_img, _, _, coords, _ = OBNet(args, run_flags, logger).eval(t2_img, save_dir)
+                predictions.append(full_volume_prediction(pred_img, coords, t2_img.shape))
+            finally:
+                shutil.rmtree(save_dir)
+
+        measures = compare_segmentations(predictions[0], predictions[1], voxel_volume=voxel_volume)
+        results[reference] = measures
+        min_observed_dice = min([min_observed_dice] + [m['dice'] for m in measures.values()])
+
+        for failure in agreement_failures(measures, min_dice, max_volume_diff):
+            failures.append('{}: {}'.format(os.path.basename(reference), failure))
+
+        logger.info('{}: {}'.format(reference, ', '.join('{} dice {:.4f} volume diff {:.2%}'.format(
+            name, m['dice'], m['volume_diff']) for name, m in measures.items())))
+
+    report = {'backend': backend, 'references': list(references), 'min_dice': min_dice,
+              'max_volume_diff': max_volume_diff, 'min_observed_dice': min_observed_dice,
+              'failures': failures, 'passed': not failures, 'results': results}
+
+    for stage in ('localization', 'segmentation'):
+        for checkpoint in flags[stage]['models'].values():
+            report['artifact_mtime'] = os.path.getmtime(artifact_path(checkpoint, backend))
+            with open(validation_path(checkpoint, backend), 'w') as f:
+                json.dump(report, f, indent=2)
+
+    if failures:
+        logger.info('Validation of the {} backend FAILED, OBNet will refuse it:\n  {}'.format(backend,
+                                                                                             '\n  '.join(failures)))
+    else:
+        logger.info('Validation of the {} backend passed (min dice {:.4f})'.format(backend, min_observed_dice))
+
+    return report
+
+
+def main():
+    from ob_pipeline.ob_pipeline import set_up_model
+
+    parser = argparse.ArgumentParser(description='Export the olfactory bulb models for inference',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('-backend', '--backend', choices=['torchscript', 'onnx', 'onnx_int8'],
+                        default='torchscript',
+                        help='Artifact format (onnx_int8: dynamic int8 quantization, requires --reference)')
+    parser.add_argument('-seg_dir', '--seg_dir', help='Segmentation weights directory', default=seg_dir)
+    parser.add_argument('-loc_dir', '--loc_dir', help='Localization weights directory', default=loc_dir)
+    parser.add_argument('-loc_arc', '--loc_arc', help='Localization architecture', default='FastSurferCNN')
+    parser.add_argument('-seg_arc', '--seg_arc', help='Segmentation architecture', default='AttFastSurferCNN')
+    parser.add_argument('-atol', '--atol', type=float, default=1e-3,
+                        help='Largest median absolute logit difference allowed between exported and eager models')
+    parser.add_argument('-overwrite', '--overwrite', action='store_true', help='Overwrite existing artifacts')
+    parser.add_argument('-reference', '--reference', nargs='+', default=[],
+                        help='Reference T2 images used to validate the onnx_int8 models against the fp32 ensemble')
+    parser.add_argument('-min_dice', '--min_dice', type=float, default=0.95,
+                        help='Lowest Dice (left, right and total bulb) accepted by the validation')
+    parser.add_argument('-max_volume_diff', '--max_volume_diff', type=float, default=0.05,
+                        help='Largest relative volume difference accepted by the validation')
+
+    args = parser.parse_args()
+
+    if args.backend == 'onnx_int8' and not args.reference:
+        parser.error('--backend onnx_int8 requires --reference images for the accuracy validation')
+
+    flags = set_up_model(model=5, batch_size=1, seg_dir=args.seg_dir, seg_arc=args.seg_arc, loc_dir=args.loc_dir,
+                         loc_arc=args.loc_arc)
+
+    export_models(flags, backend=args.backend, atol=args.atol, overwrite=args.overwrite)
+
+    if args.reference:
+        report = validate_backend(flags, args.backend, args.reference, min_dice=args.min_dice,
+                                  max_volume_diff=args.max_volume_diff)
+        if not report['passed']:
+            return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -97,6 +97,9 @@ class Self_Attn(nn.Module):
 
         self.softmax = nn.Softmax(dim=-1)  #
 
+        # Number of query positions processed at once during inference (None = full N x N attention)
+        self.chunk_size = None
+
     def forward(self, x):
         """
             inputs :
@@ -108,16 +111,56 @@ class Self_Attn(nn.Module):
         m_batchsize, C, width, height = x.size()
         proj_query = self.query_conv(x).view(m_batchsize, -1, width * height).permute(0, 2, 1)  # B X CX(N)
         proj_key = self.key_conv(x).view(m_batchsize, -1, width * height)  # B X C x (*W*H)
-        energy = torch.bmm(proj_query, proj_key)  # transpose check
-        attention = self.softmax(energy)  # BX (N) X (N)
         proj_value = self.value_conv(x).view(m_batchsize, -1, width * height)  # B X C X N
 
-        out = torch.bmm(proj_value, attention.permute(0, 2, 1))
+        if self.chunk_size and not self.training:
+            out = self.chunked_attention(proj_query, proj_key, proj_value)
+        else:
+            energy = torch.bmm(proj_query, proj_key)  # transpose check
+            attention = self.softmax(energy)  # BX (N) X (N)
+            out = torch.bmm(proj_value, attention.permute(0, 2, 1))
+
         out = out.view(m_batchsize, C, width, height)
 
         out = self.gamma * out + x
         return out
 
+    def chunked_attention(self, proj_query, proj_key, proj_value):
+        """
+        Memory bounded attention: the softmax rows are independent, so the N x N attention map is computed for
+        one sample and chunk_size query positions at a time (peak memory chunk_size x N instead of B x N x N)
+        :param tensor proj_query: B X N X C'
+        :param tensor proj_key: B X C' X N
+        :param tensor proj_value: B X C X N
+        :return tensor out: B X C X N
+        """
+        m_batchsize, num_pos, _ = proj_query.size()
+        out = proj_value.new_empty((m_batchsize, proj_value.size(1), num_pos))
+
+        for b in range(m_batchsize):
+            for start in range(0, num_pos, self.chunk_size):
+                stop = min(start + self.chunk_size, num_pos)
+                energy = torch.mm(proj_query[b, start:stop], proj_key[b])  # n X N
+                attention = self.softmax(energy)
+                out[b, :, start:stop] = torch.mm(proj_value[b], attention.t())
+
+        return out
+
+
+def set_attention_chunk_size(model, chunk_size):
+    """
+    Enable (chunk_size > 0) or disable (None/0) the memory bounded attention path of every Self_Attn layer
+    :param nn.Module model: network
+    :param int chunk_size: number of query positions per attention block
+    :return: number of updated attention layers
+    """
+    count = 0
+    for m in model.modules():
+        if isinstance(m, Self_Attn):
+            m.chunk_size = chunk_size if chunk_size else None
+            count += 1
+    return count
+
 
 # Building Blocks
 class CompetitiveDenseBlock(nn.Module):
@@ -202,19 +245,13 @@ class CompetitiveDenseBlock(nn.Module):
         # Convolution block 1
         x0 = self.conv0(x0)
         x1_bn = self.bn1(x0)
-        x0_bn = torch.unsqueeze(x, 4)
-        x1_bn = torch.unsqueeze(x1_bn, 4)
-        x1 = torch.cat((x1_bn, x0_bn), dim=4)  # Concatenate along the 5th dimension NB x C x H x W x F
-        x1_max, _ = torch.max(x1, 4)
+        x1_max = torch.max(x1_bn, x)  # Maxout as elementwise max, no concatenated NB x C x H x W x F temporary
         x1 = self.prelu(x1_max)
 
         # Convolution block 2
         x1 = self.conv1(x1)
         x2_bn = self.bn2(x1)
-        x2_bn = torch.unsqueeze(x2_bn, 4)
-        x1_max = torch.unsqueeze(x1_max, 4)
-        x2 = torch.cat((x2_bn, x1_max), dim=4)  # Concatenating along the 5th dimension
-        x2_max, _ = torch.max(x2, 4)
+        x2_max = torch.max(x2_bn, x1_max)  # Maxout
         x2 = self.prelu(x2_max)
 
         # Convolution block 3 (end with batch-normed output to allow maxout across skip-connections)
@@ -314,10 +351,7 @@ class CompetitiveDenseBlockInput(nn.Module):
         x1 = self.conv1(x1)
         x2_bn = self.bn2(x1)
         # First Maxout
-        x1_bn = torch.unsqueeze(x1_bn, 4)
-        x2_bn = torch.unsqueeze(x2_bn, 4)  # Add Singleton Dimension along 5th
-        x2 = torch.cat((x2_bn, x1_bn), dim=4)  # Concatenating along the 5th dimension
-        x2_max, _ = torch.max(x2, 4)
+        x2_max = torch.max(x2_bn, x1_bn)
         x2 = self.prelu(x2_max)
 
         # Convolution block 3
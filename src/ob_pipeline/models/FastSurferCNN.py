@@ -157,19 +157,13 @@ class CompetitiveDenseBlock(nn.Module):
         # Convolution block 1
         x0 = self.conv0(x0)
         x1_bn = self.bn1(x0)
-        x0_bn = torch.unsqueeze(x, 4)
-        x1_bn = torch.unsqueeze(x1_bn, 4)
-        x1 = torch.cat((x1_bn, x0_bn), dim=4)  # Concatenate along the 5th dimension NB x C x H x W x F
-        x1_max, _ = torch.max(x1, 4)
+        x1_max = torch.max(x1_bn, x)  # Maxout as elementwise max, no concatenated NB x C x H x W x F temporary
         x1 = self.prelu(x1_max)
 
         # Convolution block 2
         x1 = self.conv1(x1)
         x2_bn = self.bn2(x1)
-        x2_bn = torch.unsqueeze(x2_bn, 4)
-        x1_max = torch.unsqueeze(x1_max, 4)
-        x2 = torch.cat((x2_bn, x1_max), dim=4)  # Concatenating along the 5th dimension
-        x2_max, _ = torch.max(x2, 4)
+        x2_max = torch.max(x2_bn, x1_max)  # Maxout
         x2 = self.prelu(x2_max)
 
         # Convolution block 3 (end with batch-normed output to allow maxout across skip-connections)
@@ -260,10 +254,7 @@ class CompetitiveDenseBlockInput(nn.Module):
         x2_bn = self.bn2(x1)
 
         # First Maxout
-        x1_bn = torch.unsqueeze(x1_bn, 4)
-        x2_bn = torch.unsqueeze(x2_bn, 4)  # Add Singleton Dimension along 5th
-        x2 = torch.cat((x2_bn, x1_bn), dim=4)  # Concatenating along the 5th dimension
-        x2_max, _ = torch.max(x2, 4)
+        x2_max = torch.max(x2_bn, x1_bn)
 
         x2 = self.prelu(x2_max)
         # Convolution block 3
@@ -357,11 +348,7 @@ class CompetitiveDecoderBlock(CompetitiveDenseBlock):
         :return: processed feature maps
         """
         unpool = self.unpool(x, indices)
-        unpool = torch.unsqueeze(unpool, 4)
-
-        out_block = torch.unsqueeze(out_block, 4)
-        concat = torch.cat((unpool, out_block), dim=4)  # Competitive Concatenation
-        concat_max, _ = torch.max(concat, 4)
+        concat_max = torch.max(unpool, out_block)  # Competitive Concatenation (maxout)
         out_block = super(CompetitiveDecoderBlock, self).forward(concat_max)
 
         return out_block
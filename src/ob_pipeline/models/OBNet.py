@@ -21,12 +21,22 @@ import torch
 import torch.nn as nn
 import numpy as np
 import time
-from torchvision import transforms
-from torch.utils.data.dataloader import DataLoader
-from ob_pipeline.utils.datasetUtils import testDataset
-from ob_pipeline.utils.transformUtils import ToTensorTest
-from ob_pipeline.utils.image_utils import plane_swap, map_size , get_thick_slices, clean_seg
+from ob_pipeline.utils.transformUtils import to_tensor_volume
+from ob_pipeline.utils.image_utils import plane_swap, map_size , get_thick_slices, clean_seg, heatmap_roi
 from ob_pipeline.utils import misc as misc
+from ob_pipeline.utils.ensemble import EnsembleAccumulator
+from ob_pipeline.utils.lazy_volume import ArrayVolume, BlockVolume
+from ob_pipeline.utils.resample import resample_to_output
+from ob_pipeline.utils.stats import UncertaintyAccumulator
+from ob_pipeline.utils.timing import StageTimer
+from ob_pipeline.models.model_cache import MODEL_CACHE
+from ob_pipeline.models.AttFastSurferCNN import set_attention_chunk_size
+from ob_pipeline.models.onnx_model import OnnxModel
+from ob_pipeline.models.profiling import OperatorProfiler
+from ob_pipeline.models.batch_tuner import TUNED_BATCH_SIZES, available_memory, tune_batch_size
+from ob_pipeline.models.stacked_ensemble import REJECTED_STACKS, StackedEnsemble, compare_members, \
+    stacking_available, same_structure
+from ob_pipeline.models.optimize import fold_batchnorm, prune_attention
 from scipy.special import softmax
 import os
 
@@ -49,6 +59,95 @@ def select_plane(value,planes):
         if str(plane) in str(value):
             return plane
 
+def artifact_path(checkpoint,backend):
+    """
+    Path of the exported (inference only) version of a checkpoint, stored next to the .pkl file
+    :param str checkpoint: path to the model weights (.pkl)
+    :param str backend: torchscript, onnx or onnx_int8
+    :return str: artifact path
+    """
+    extensions = {'torchscript': '.pt', 'onnx': '.onnx', 'onnx_int8': '.int8.onnx'}
+    return os.path.splitext(checkpoint)[0] + extensions[backend]
+
+def validation_path(checkpoint,backend):
+    """
+    Path of the accuracy validation report of an exported checkpoint (see export_models.validate_backend)
+    """
+    return artifact_path(checkpoint, backend) + '.validation.json'
+
+def check_validation(checkpoint,backend):
+    """
+    Refuse exported models that were not validated against the fp32 ensemble, failed the validation
+    or were exported again after it
+    :raise RuntimeError: if the artifact has no passing validation report
+    :return dict: validation report
+    """
+    import json
+
+    path = artifact_path(checkpoint, backend)
+    report_path = validation_path(checkpoint, backend)
+
+    if not os.path.isfile(report_path):
+        raise RuntimeError('{} has not been validated, run ob_export_models --backend {} --reference ... '
+                           'first'.format(path, backend))
+
+    with open(report_path) as f:
+        report = json.load(f)
+
+    if report['artifact_mtime'] != os.path.getmtime(path):
+        raise RuntimeError('{} changed after its validation, run ob_export_models --backend {} --reference ... '
+                           'again'.format(path, backend))
+
+    if not report['passed']:
+        raise RuntimeError('{} failed the validation against the fp32 ensemble ({}), refusing to run '
+                           'it'.format(path, '; '.join(report['failures'])))
+
+    return report
+
+def load_state(checkpoint,device,model_parallel=False):
+    """
+    Load the state dict of a checkpoint, adding or removing the DataParallel "module." prefix as needed
+    """
+    from collections import OrderedDict
+
+    model_state = torch.load(checkpoint, map_location=device)
+
+    new_state_dict = OrderedDict()
+
+    for k, v in model_state["model_state_dict"].items():
+
+        if k[:7] == "module." and not model_parallel:
+            new_state_dict[k[7:]] = v
+
+        elif k[:7] != "module." and model_parallel:
+            new_state_dict["module." + k] = v
+
+        else:
+            new_state_dict[k] = v
+
+    return new_state_dict
+
+def load_model(arc,params,checkpoint,device,model_parallel=False,fold_bn=False):
+    """
+    Build an eager network and load the checkpoint weights
+    :param bool fold_bn: fold the BatchNorm layers into the preceding convolutions (inference only)
+    :return: network in eval mode on device
+    """
+    model = select_model(arc, params.copy())
+
+    if model_parallel:
+        model = nn.DataParallel(model)
+
+    model.to(device)
+
+    model.load_state_dict(load_state(checkpoint, device, model_parallel))
+    model.eval()
+
+    if fold_bn:
+        fold_batchnorm(model)
+
+    return model
+
 class OBNet(object):
 
     seg_params_network = {'num_channels': 3, 'num_filters': 64,
@@ -61,16 +160,27 @@ class OBNet(object):
                           'pool': 2, 'stride_pool': 2, 'num_classes': 2,
                           'kernel_c': 1, 'kernel_d': 1, 'dilation': 1}
 
+    # axis of the input volume along which plane_swap stacks the slices of every plane
+    slice_axis = {'axial': 2, 'coronal': 1, 'sagittal': 0}
 
 
-    def __init__(self,args,flags,logger):
+    def __init__(self,args,flags,logger,timer=None):
 
         self.args = args
         self.flags = flags
         self.logger=logger
+        # per-stage wall time, CPU time and peak RSS of the subject (timings.json)
+        self.timer = timer if timer is not None else StageTimer()
         self.seg_params_network = OBNet.seg_params_network.copy()
         self.loc_params_network = OBNet.loc_params_network.copy()
         self.device,self.model_parallel=self.check_device()
+        # start of the current subject (time budget of the adaptive ensemble) and ensemble members used
+        self.start_time = None
+        self.num_models_used = None
+        # --profile: output directory of the subject and (stage, plane) already profiled
+        self.profile_dir = os.path.join(os.getcwd(), 'profile')
+        self.profiled = set()
+        MODEL_CACHE.resize(self.flags.get('model_cache_size', MODEL_CACHE.max_size))
 
     def check_device(self):
         # Put it onto the GPU or CPU
@@ -91,113 +201,700 @@ class OBNet(object):
         return device,model_parallel
 
     def load_weights(self,current_model):
-        from collections import OrderedDict
-
-        model_state = torch.load(current_model, map_location=self.device)
-
-        new_state_dict = OrderedDict()
-
-        for k, v in model_state["model_state_dict"].items():
-
-            if k[:7] == "module." and not self.model_parallel:
-                new_state_dict[k[7:]] = v
-
-            elif k[:7] != "module." and self.model_parallel:
-                new_state_dict["module." + k] = v
-
+        return load_state(current_model, self.device, self.model_parallel)
+
+    def get_model(self,arc,params,checkpoint,example=None):
+        """
+        Return a network with the checkpoint weights loaded, reusing the process-level model cache
+        :param str arc: network architecture
+        :param dict params: network parameters
+        :param str checkpoint: path to the model weights
+        :param example: network input of the current plane (checks the attention pruning on the first load)
+        :return: network in eval mode on self.device
+        """
+        backend = self.flags.get('backend', 'torch')
+        fold_bn = self.flags.get('fold_batchnorm', False)
+        gamma_threshold = self.flags.get('attention_gamma_threshold', 0)
+        key = (arc, os.path.abspath(checkpoint), str(self.device), self.model_parallel, backend, fold_bn,
+               gamma_threshold)
+
+        model = MODEL_CACHE.get(key)
+        if model is not None:
+            self.logger.info('Model cache hit for {} (hits: {}, misses: {})'.format(checkpoint, MODEL_CACHE.hits,
+                                                                                   MODEL_CACHE.misses))
+        else:
+            if backend in ('torchscript', 'onnx', 'onnx_int8'):
+                model = self.load_exported(checkpoint, backend)
             else:
-                new_state_dict[k] = v
-
-        return new_state_dict
-
-    def predict(self,img,batch_size,model):
-        transform_test = transforms.Compose([ToTensorTest()])
-        test_dataset = testDataset(img, transforms=transform_test)
-        test_loader = DataLoader(dataset=test_dataset, batch_size=batch_size)
-
-        pred_logits = []
+                model = self.load_network(arc, params, checkpoint, example)
+
+            MODEL_CACHE.put(key, model)
+
+        if backend == 'torch' and arc == 'AttFastSurferCNN':
+            set_attention_chunk_size(model, self.flags.get('attention_chunk'))
+
+        return model
+
+    def load_network(self,arc,params,checkpoint,example=None):
+        """
+        Load a torch network (batch norm folded and attention pruned as configured in the flags)
+        :return: network in eval mode on self.device
+        """
+        model = load_model(arc, params, checkpoint, self.device, self.model_parallel,
+                           fold_bn=self.flags.get('fold_batchnorm', False))
+        self.logger.info('Model weights loaded from {}'.format(checkpoint))
+
+        gamma_threshold = self.flags.get('attention_gamma_threshold', 0)
+        if arc == 'AttFastSurferCNN' and gamma_threshold:
+            model = self.prune_attention(model, gamma_threshold, example)
+
+        return model
+
+    def prune_attention(self,model,threshold,example=None):
+        """
+        Skip the Self_Attn blocks with |gamma| <= threshold. The pruned network is compared with the full one on
+        the central slices of example, the full network is kept if any predicted label changes.
+        :param model: AttFastSurferCNN in eval mode
+        :param float threshold: largest |gamma| pruned
+        :param example: network input (thick slices) used for the check
+        :return: pruned or original network
+        """
+        import copy
+
+        reference = copy.deepcopy(model) if example is not None else None
+        pruned = prune_attention(model, threshold)
+
+        if not pruned:
+            self.logger.info('No attention block with |gamma| <= {}'.format(threshold))
+            return model
+
+        self.logger.info('Attention pruned (|gamma| <= {}) in blocks: {}'.format(
+            threshold, ', '.join('{} ({:.2e})'.format(name, gamma) for name, gamma in pruned)))
+
+        if example is None:
+            return model
+
+        # 0: check every slice
+        num_slices = self.flags.get('prune_check_slices', 8) or example.shape[0]
+        num_slices = min(example.shape[0], num_slices)
+        start = (example.shape[0] - num_slices) // 2
+        sample = example[start:start + num_slices]
+
+        ref_probs = softmax(self.predict(sample, self.flags['batch_size'], reference).astype(np.float64), axis=-1)
+        probs = softmax(self.predict(sample, self.flags['batch_size'], model).astype(np.float64), axis=-1)
+
+        changed = np.count_nonzero(np.argmax(ref_probs, axis=-1) != np.argmax(probs, axis=-1))
+        if changed:
+            self.logger.info('Attention pruning changes {} predicted voxels, keeping the full '
+                             'network'.format(changed))
+            return reference
+
+        self.logger.info('Attention pruning check passed on {} slices, prediction unchanged '
+                         '(max probability difference {:.2e})'.format(num_slices, np.max(np.abs(ref_probs - probs))))
+        return model
+
+    def load_exported(self,checkpoint,backend):
+        """
+        Load the exported version of a checkpoint (see export_models)
+        :param str checkpoint: path to the model weights (.pkl)
+        :param str backend: torchscript (frozen TorchScript module), onnx or onnx_int8 (ONNX Runtime CPU session)
+        """
+        path = artifact_path(checkpoint, backend)
+
+        if not os.path.isfile(path):
+            raise IOError('{} model {} not found, run ob_export_models --backend {} first'.format(backend, path,
+                                                                                                  backend))
+
+        if backend in ('onnx', 'onnx_int8'):
+            if backend == 'onnx_int8' and self.flags.get('require_validation', True):
+                report = check_validation(checkpoint, backend)
+                self.logger.info('{} validated on {} reference images (min dice {:.4f})'.format(
+                    path, len(report['references']), report['min_observed_dice']))
+            if self.device.type != 'cpu':
+                self.logger.info('The {} backend runs on CPU only'.format(backend))
+            model = OnnxModel(path, intra_op_threads=self.flags.get('intra_op_threads', 0),
+                              inter_op_threads=self.flags.get('inter_op_threads', 0))
+        else:
+            model = torch.jit.load(path, map_location=self.device)
+            model.eval()
+
+        self.logger.info('{} model loaded from {}'.format(backend, path))
+
+        return model
+
+    def predict(self,img,batch_size,model,profile_name=None):
+        """
+        Run a network over all slices of a plane
+        :param img: thick slices N x C x H x W (np.ndarray view, normalized batch by batch) or an already normalized
+                    N x C x H x W tensor
+        :param int batch_size: number of slices per forward pass
+        :param model: network
+        :param str profile_name: run the first profile_batches batches under the operator profiler, the outputs are
+                                 written to profile_dir with this prefix
+        :return np.ndarray: logits N x H x W x num_classes
+        """
+        pred_logits = None
+
+        profiler = None
+        profiled_batches = 0
+        if profile_name is not None:
+            profiler = OperatorProfiler(model, self.profile_dir, profile_name, logger=self.logger)
+            profiler.start()
 
         model.eval()
         with torch.no_grad():
-            for batch_idx, sample_batch in enumerate(test_loader):
-                images_batch = sample_batch['image']
+            try:
+                for start in range(0, img.shape[0], batch_size):
+                    if profiler is not None and profiled_batches == self.flags.get('profile_batches', 2):
+                        self.finish_profile(profiler, profiled_batches)
+                        profiler = None
 
-                images_batch = images_batch.to(self.device)
+                    # only the slices of the batch are copied and normalized
+                    images_batch = self.to_tensor(img[start:start + batch_size]).to(self.device)
 
-                temp = model(images_batch)
-                pred_logits.append(temp.cpu())
+                    temp = model(images_batch).cpu()
+                    profiled_batches += 1
 
-            pred_logits = torch.cat(pred_logits, axis=0)
+                    if pred_logits is None:
+                        pred_logits = torch.empty((img.shape[0],) + tuple(temp.shape[1:]), dtype=temp.dtype)
+                    pred_logits[start:start + temp.shape[0]] = temp
+            finally:
+                if profiler is not None:
+                    self.finish_profile(profiler, profiled_batches)
 
         # change from N,C,W,H to view with C in last dimension = N,W,H,C
         pred_logits = pred_logits.permute(0, 2, 3, 1)
         pred_logits = pred_logits.numpy()
 
-        del images_batch
         return pred_logits
 
-    def run_localization(self,t2_img):
-        import nibabel.processing
-        from scipy.ndimage.measurements import center_of_mass
-
-        model = select_model(self.flags['loc_arc'],self.loc_params_network.copy())
-
-        if self.model_parallel:
-            model = nn.DataParallel(model)
-
-        model.to(self.device)
+    @staticmethod
+    def to_tensor(img):
+        """
+        :param img: thick slices N x C x H x W (np.ndarray) or normalized tensor
+        :return: normalized float32 N x C x H x W tensor
+        """
+        return img if torch.is_tensor(img) else to_tensor_volume(img, channels_first=True)
+
+    def profile_name(self,stage,plane,checkpoint):
+        """
+        With --profile the first network of every stage and plane is profiled
+        :return str: output prefix <stage>_<plane>_<checkpoint name>, None if not profiled
+        """
+        if not self.flags.get('profile', False) or (stage, plane) in self.profiled:
+            return None
+
+        self.profiled.add((stage, plane))
+        return '{}_{}_{}'.format(stage, plane, os.path.splitext(os.path.basename(checkpoint))[0])
+
+    def finish_profile(self,profiler,num_batches):
+        files = profiler.stop(num_batches)
+        self.logger.info('Profile of {} batches written to {}'.format(num_batches, ', '.join(files)))
+
+    def stage_batch_size(self,stage,arc,model,example,workers=1):
+        """
+        Batch size of a stage: <stage>_batch_size or batch_size, or with auto_batch_size the largest batch fitting
+        the memory budget (memory_budget in MB, by default 80% of the free memory), measured once per process for
+        every network input shape
+        :param str stage: localization or segmentation
+        :param model: network in eval mode (or StackedEnsemble)
+        :param example: N x C x H x W input of the network (thick slices or tensor)
+        :param int workers: networks evaluated at the same time, the budget is shared between them
+        :return int: slices per forward pass
+        """
+        batch_size = self.flags.get(stage + '_batch_size') or self.flags['batch_size']
+        if not self.flags.get('auto_batch_size', False):
+            return batch_size
+
+        budget = self.flags.get('memory_budget', 0)
+        key = (stage, arc, tuple(example.shape[1:]), getattr(model, 'num_members', 1), str(self.device),
+               self.flags.get('backend', 'torch'), budget, workers)
+
+        if key not in TUNED_BATCH_SIZES:
+            if budget:
+                budget = budget * 2 ** 20
+            else:
+                free = available_memory(self.device)
+                budget = 0.8 * free if free else None
+            # the CPU probes may reset the process peak RSS, the peaks of the open stages are kept first
+            self.timer.update_peaks()
+            # the probes use the first two slices
+            tuned = tune_batch_size(model, self.to_tensor(example[:2]), self.device,
+                                    float(budget) / workers) if budget else None
+
+            if tuned is None:
+                self.logger.warning('auto_batch_size: the {} of the {} network cannot be measured, using the fixed '
+                                    'batch size {}'.format('memory footprint' if budget else 'free memory', stage,
+                                                           batch_size))
+                TUNED_BATCH_SIZES[key] = batch_size
+            else:
+                TUNED_BATCH_SIZES[key] = tuned[0]
+                self.logger.info('Auto batch size for {}: {} ({:.1f} MB per slice, {:.1f} MB fixed, budget '
+                                 '{:.1f} MB)'.format(stage, tuned[0], tuned[1] / 2 ** 20, tuned[2] / 2 ** 20,
+                                                     float(budget) / workers / 2 ** 20))
+
+        return TUNED_BATCH_SIZES[key]
+
+    def group_by_plane(self,models,planes=('axial','coronal','sagittal')):
+        """
+        Group the checkpoints of an ensemble by the plane they were trained on
+        :param dict models: checkpoints {name: path}
+        :return: OrderedDict plane -> list of (member index, checkpoint path)
+        """
+        from collections import OrderedDict
 
+        groups = OrderedDict()
+        for idx, checkpoint in enumerate(models.values()):
+            plane = select_plane(checkpoint, planes)
+            groups.setdefault(plane, []).append((idx, checkpoint))
+
+        return groups
+
+    def prepare_plane(self,arr,plane,img_size):
+        """
+        Swap, pad/crop and thick-slice a volume for the networks of one plane
+        :param np.ndarray arr: input volume
+        :param str plane: axial, coronal or sagittal
+        :param list img_size: in-plane network input size
+        :return: thick slices N x C x H x W, a strided view of the padded volume normalized batch by batch by predict
+        """
+        mod_arr = plane_swap(arr, plane=plane)
+        # get_thick_slices copies the volume, a crop can stay a view
+        mod_arr = map_size(mod_arr, base_shape=(mod_arr.shape[0], img_size[0], img_size[1]), verbose=0, copy=False)
+        mod_arr = get_thick_slices(mod_arr, self.flags['thickness'])
+        self.logger.info('input data transform to {}'.format(mod_arr.shape))
+
+        return mod_arr.transpose((0, 3, 1, 2))
+
+    def restore_plane(self,probs,plane,orig_shape,fill_value=0,copy=True):
+        """
+        Map the output of a plane back to the input volume space
+        :param np.ndarray probs: N x H x W x num_classes network output of one plane
+        :param str plane: axial, coronal or sagittal
+        :param tuple orig_shape: shape of the input volume
+        :param float fill_value: value for the voxels outside of the network field of view
+        :param bool copy: if False and the volume is not larger than the network input, a view of probs is returned
+        :return np.ndarray: orig_shape x num_classes
+        """
+        probs = plane_swap(probs, plane, inverse=True)
+        # remove padding, all classes at once
+        return map_size(probs, base_shape=orig_shape[:3], verbose=0, fill_value=fill_value, copy=copy)
+
+    def predict_probs(self,img,model,num_classes,roi_slices=None,num_members=1,batch_size=None,profile_name=None):
+        """
+        Softmax output of a network over the slices of a plane
+        :param img: thick slices N x C x H x W of the plane (see prepare_plane) or normalized tensor
+        :param model: network
+        :param int num_classes: number of output channels
+        :param tuple roi_slices: (low, high) slice range to evaluate, the other slices are set to background
+        :param int num_members: networks stacked along the channels (StackedEnsemble)
+        :param int batch_size: slices per forward pass (default: batch_size flag)
+        :param str profile_name: profile the forward passes (see predict)
+        :return np.ndarray: probabilities N x H x W x num_classes, num_members x N x H x W x member classes when
+        stacked
+        """
+        if batch_size is None:
+            batch_size = self.flags['batch_size']
+        classes = num_classes // num_members
+        shape = (img.shape[0], img.shape[2], img.shape[3], num_members, classes)
+
+        def member_softmax(logits):
+            return softmax(logits.astype(np.float64).reshape(logits.shape[:3] + (num_members, classes)), axis=-1)
+
+        if roi_slices is None:
+            probs = member_softmax(self.predict(img, batch_size=batch_size, model=model, profile_name=profile_name))
+        else:
+            low, high = roi_slices
+            probs = np.zeros(shape)
+            probs[..., 0] = 1.0
+
+            if high > low:
+                probs[low:high] = member_softmax(self.predict(img[low:high], batch_size=batch_size, model=model,
+                                                              profile_name=profile_name))
+
+        if num_members == 1:
+            return probs[..., 0, :]
+        return np.moveaxis(probs, 3, 0)
+
+    def run_ensemble(self,arr,models,arc,params,img_size,ensemble,uncertainty=None,stage='segmentation',roi=None):
+        """
+        Run all ensemble members over a volume, the input of every plane is prepared only once and shared by
+        all the checkpoints of that plane. Unless the member outputs are kept (ensemble.members), the probabilities
+        of a plane are fused before being mapped back (once per plane); the uncertainty gets a view of every member
+        output in the volume space instead (a copy only when the network input is smaller than the volume).
+        :param np.ndarray arr: input volume
+        :param dict models: checkpoints {name: path}
+        :param str arc: network architecture
+        :param dict params: network parameters
+        :param list img_size: in-plane network input size
+        :param EnsembleAccumulator ensemble: fused output
+        :param UncertaintyAccumulator uncertainty: updated with the output of every member
+        :param str stage: name used in the log
+        :param list roi: (low, high) voxel range per axis of arr, only the slices crossing it are evaluated
+        """
+        workers = min(self.flags.get('ensemble_workers', 1), len(models))
+        if workers > 1:
+            if self.flags.get('profile', False):
+                self.logger.info('Operator profiling is not done for the concurrent {} ensemble'.format(stage))
+            return self.run_ensemble_concurrent(arr, models, arc, params, img_size, ensemble, workers,
+                                                uncertainty=uncertainty, stage=stage, roi=roi)
+
+        num_classes = params['num_classes']
+        keep_members = ensemble.members is not None
+
+        for plane, plane_models in self.group_by_plane(models).items():
+            mod_arr = self.prepare_plane(arr, plane, img_size)
+            plane_sum = None
+
+            roi_slices = None
+            if roi is not None:
+                roi_slices = roi[self.slice_axis[plane]]
+                self.logger.info('{} slices {} to {} of {} inside the ROI'.format(plane, roi_slices[0], roi_slices[1],
+                                                                                  mod_arr.shape[0]))
+
+            for idx, probs in self.plane_outputs(mod_arr, plane, plane_models, arc, params, roi_slices, stage):
+                # outside of the field of view the networks output zero logits (equal class probabilities)
+                if keep_members:
+                    probs = self.restore_plane(probs, plane, arr.shape, fill_value=1.0 / num_classes)
+                    ensemble.add(probs, index=idx)
+                    if uncertainty is not None:
+                        uncertainty.update(probs)
+                    continue
+
+                if uncertainty is not None:
+                    # before probs is summed into
+                    uncertainty.update(self.restore_plane(probs, plane, arr.shape, fill_value=1.0 / num_classes,
+                                                          copy=False))
+                if plane_sum is None:
+                    plane_sum = probs
+                else:
+                    plane_sum += probs
+
+            if plane_sum is not None:
+                ensemble.add(self.restore_plane(plane_sum, plane, arr.shape,
+                                                fill_value=float(len(plane_models)) / num_classes),
+                             count=len(plane_models))
+
+    def plane_outputs(self,mod_arr,plane,plane_models,arc,params,roi_slices=None,stage='segmentation'):
+        """
+        Probabilities of the checkpoints of one plane, evaluated one after the other or, with stacked_ensemble,
+        in a single vmapped forward pass
+        :param mod_arr: prepared input of the plane
+        :param list plane_models: (index, checkpoint) of the plane
+        :return: generator of (index, probabilities N x H x W x num_classes)
+        """
+        num_classes = params['num_classes']
+
+        stacked = self.get_stacked_model(arc, params, plane_models, mod_arr)
+        if stacked is not None:
+            self.logger.info("--->Testing {} {} models stacked ({})".format(plane, stage, len(plane_models)))
+            start_model = time.time()
+            with self.timer.stage(stage + '_model', plane=plane,
+                                  model=[os.path.basename(checkpoint) for _, checkpoint in plane_models]):
+                batch_size = self.stage_batch_size(stage, arc, stacked, mod_arr)
+                probs = self.predict_probs(mod_arr, stacked, num_classes * len(plane_models), roi_slices,
+                                           num_members=len(plane_models), batch_size=batch_size,
+                                           profile_name=self.profile_name(stage, plane, plane_models[0][1]))
+            self.logger.info("Models Done in {:0.4f} seconds".format(time.time() - start_model))
+
+            for member, (idx, _) in enumerate(plane_models):
+                yield idx, probs[member]
+            return
+
+        for idx, checkpoint in plane_models:
+            self.logger.info("--->Testing {} {} model".format(plane, stage))
+            with self.timer.stage(stage + '_model', plane=plane, model=os.path.basename(checkpoint)):
+                # load model
+                model = self.get_model(arc, params, checkpoint, example=mod_arr)
+
+                start_model = time.time()
+
+                # evaluate
+                batch_size = self.stage_batch_size(stage, arc, model, mod_arr)
+                probs = self.predict_probs(mod_arr, model, num_classes, roi_slices, batch_size=batch_size,
+                                           profile_name=self.profile_name(stage, plane, checkpoint))
 
-        resampled_img = nibabel.processing.resample_to_output(t2_img, self.flags['localization']['spacing'],order=1)
+            end_model = time.time() - start_model
+            self.logger.info("Model Done in {:0.4f} seconds".format(end_model))
 
-        orig_arr= resampled_img.get_fdata()
-        orig_shape = orig_arr.shape
+            yield idx, probs
+
+    def get_stacked_model(self,arc,params,plane_models,example=None):
+        """
+        StackedEnsemble of the checkpoints of a plane (cached like the single networks), None when stacking does
+        not apply: stacked_ensemble off, a single checkpoint, non-torch backend, model parallelism, torch without
+        torch.func, chunked attention (attention_chunk), members with a different structure (e.g. attention pruned
+        differently) or stacked logits that differ from the members evaluated on their own (see check_stacked)
+        :param list plane_models: (index, checkpoint) of the plane
+        :param example: network input of the plane (checks the attention pruning and the stacked ensemble)
+        :return StackedEnsemble: or None
+        """
+        if not self.flags.get('stacked_ensemble', False) or len(plane_models) < 2:
+            return None
+
+        backend = self.flags.get('backend', 'torch')
+        if backend != 'torch' or self.model_parallel:
+            self.logger.info('Stacked ensemble needs the torch backend on a single device, running sequentially')
+            return None
+        if not stacking_available():
+            self.logger.info('Stacked ensemble needs torch.func (torch >= 2.0), running sequentially')
+            return None
+        if arc == 'AttFastSurferCNN' and self.flags.get('attention_chunk'):
+            # vmap cannot run the chunked attention, stacking would build the full attention of every member
+            self.logger.warning('Stacked ensemble cannot use the chunked attention (attention_chunk {}), running '
+                                'sequentially'.format(self.flags.get('attention_chunk')))
+            return None
+
+        fold_bn = self.flags.get('fold_batchnorm', False)
+        gamma_threshold = self.flags.get('attention_gamma_threshold', 0)
+        key = ('stacked', arc, tuple(os.path.abspath(checkpoint) for _, checkpoint in plane_models),
+               str(self.device), fold_bn, gamma_threshold)
+
+        if key in REJECTED_STACKS:
+            return None
+
+        stacked = MODEL_CACHE.get(key)
+        if stacked is not None:
+            return stacked
+
+        # the members are not cached on their own, their weights are copied into the stacked parameters
+        members = [self.load_network(arc, params, checkpoint, example) for _, checkpoint in plane_models]
+        if not same_structure(members):
+            self.logger.info('Stacked ensemble members differ in structure, running sequentially')
+            return None
+
+        stacked = StackedEnsemble(members)
+        if example is not None and not self.check_stacked(stacked, members, example):
+            REJECTED_STACKS.add(key)
+            return None
+
+        MODEL_CACHE.put(key, stacked)
+        return stacked
+
+    def check_stacked(self,stacked,members,example):
+        """
+        Compare the stacked ensemble with its members evaluated one after the other on the central slices of
+        example, with the criteria of the exported backends (median absolute logit difference and label agreement)
+        :param StackedEnsemble stacked: ensemble of the members
+        :param list members: networks in eval mode, in the order they were stacked
+        :param example: network input (thick slices) used for the check
+        :return bool: the stacked ensemble gives the logits of the members
+        """
+        # 0: check every slice
+        num_slices = self.flags.get('stacked_check_slices', 8) or example.shape[0]
+        num_slices = min(example.shape[0], num_slices)
+        start = (example.shape[0] - num_slices) // 2
+        images = self.to_tensor(example[start:start + num_slices]).to(self.device)
+
+        # the stacked forward holds the activations of every member
+        batch_size = max(1, self.flags['batch_size'] // len(members))
+        measures = compare_members(stacked, members, images, batch_size=batch_size)
+
+        atol = self.flags.get('stacked_atol', 1e-3)
+        min_agreement = self.flags.get('stacked_agreement', 0.999)
+        failed = [(member, m) for member, m in enumerate(measures)
+                  if m['median_diff'] > atol or m['agreement'] < min_agreement]
+
+        if failed:
+            self.logger.warning('Stacked ensemble differs from its members (median abs diff > {:.0e} or label '
+                                'agreement < {:.2%}): {}, running sequentially'.format(
+                                    atol, min_agreement, ', '.join(
+                                        'member {} median {:.2e} max {:.2e} agreement {:.4%}'.format(
+                                            member, m['median_diff'], m['max_diff'], m['agreement'])
+                                        for member, m in failed)))
+            return False
+
+        self.logger.info('Stacked ensemble check passed on {} slices (max median abs diff {:.2e}, min label '
+                         'agreement {:.4%})'.format(num_slices, max(m['median_diff'] for m in measures),
+                                                   min(m['agreement'] for m in measures)))
+        return True
+
+    def run_ensemble_concurrent(self,arr,models,arc,params,img_size,ensemble,workers,uncertainty=None,
+                                stage='segmentation',roi=None):
+        """
+        run_ensemble with the members evaluated concurrently in a thread pool. The intra-op threads are split
+        between the workers (torch.set_num_threads applies to the calling thread) and the outputs are fused in the
+        main thread as the members complete.
+        :param int workers: number of members evaluated at the same time
+        """
+        from collections import OrderedDict
+        from concurrent.futures import ThreadPoolExecutor, as_completed
 
-        planes = ['axial','coronal', 'sagittal']
-        sub_logits=[]
+        num_classes = params['num_classes']
+        keep_members = ensemble.members is not None
 
-        start_loc=time.time()
+        total_threads = torch.get_num_threads()
+        worker_threads = max(1, total_threads // workers)
+        self.logger.info('Running {} {} models with {} workers x {} threads'.format(len(models), stage, workers,
+                                                                                 worker_threads))
 
-        for key,seg_loc in self.flags['localization']['models'].items():
-            plane = select_plane(seg_loc,planes)
-            self.logger.info("--->Testing {} localization model".format(plane))
-            # load model
-            model_state = self.load_weights(seg_loc)
-            model.load_state_dict(model_state)
-            self.logger.info('Model weights loaded from {}'.format(seg_loc))
-            # organize data
-            self.logger.info('Input data shape {}'.format(orig_shape))
-            mod_arr = plane_swap(orig_arr, plane=plane)
-            mod_arr = map_size(mod_arr, base_shape=(
-            mod_arr.shape[0], self.flags['localization']['imgSize'][0], self.flags['localization']['imgSize'][1]), verbose=0)
-            mod_arr = get_thick_slices(mod_arr,self.flags['thickness'])
-            self.logger.info('input data transform to {}'.format(mod_arr.shape))
+        groups = self.group_by_plane(models)
+        inputs = OrderedDict((plane, self.prepare_plane(arr, plane, img_size)) for plane in groups)
 
+        # the memory is measured before the workers start, the budget is shared between them
+        batch_sizes = dict((plane, self.stage_batch_size(stage, arc, self.get_model(arc, params, plane_models[0][1],
+                                                                                    example=inputs[plane]),
+                                                         inputs[plane], workers=workers))
+                           for plane, plane_models in groups.items())
 
+        def run_member(plane, checkpoint):
+            torch.set_num_threads(worker_threads)
             start_model = time.time()
+            # CPU time and RSS are per process, only the wall time of the concurrent members is recorded
+            with self.timer.stage(stage + '_model', resources=False, plane=plane, model=os.path.basename(checkpoint)):
+                model = self.get_model(arc, params, checkpoint, example=inputs[plane])
+                roi_slices = roi[self.slice_axis[plane]] if roi is not None else None
+                probs = self.predict_probs(inputs[plane], model, num_classes, roi_slices,
+                                           batch_size=batch_sizes[plane])
+            self.logger.info("{} {} model done in {:0.4f} seconds".format(plane, stage, time.time() - start_model))
+            return probs
+
+        plane_sums = {}
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = dict((pool.submit(run_member, plane, checkpoint), (plane, idx))
+                               for plane, plane_models in groups.items() for idx, checkpoint in plane_models)
+
+                for future in as_completed(futures):
+                    plane, idx = futures[future]
+                    probs = future.result()
+
+                    if keep_members:
+                        probs = self.restore_plane(probs, plane, arr.shape, fill_value=1.0 / num_classes)
+                        ensemble.add(probs, index=idx)
+                        if uncertainty is not None:
+                            uncertainty.update(probs)
+                        continue
+
+                    if uncertainty is not None:
+                        uncertainty.update(self.restore_plane(probs, plane, arr.shape,
+                                                              fill_value=1.0 / num_classes, copy=False))
+                    if plane in plane_sums:
+                        plane_sums[plane] += probs
+                    else:
+                        plane_sums[plane] = probs
+        finally:
+            torch.set_num_threads(total_threads)
+
+        for plane, plane_sum in plane_sums.items():
+            ensemble.add(self.restore_plane(plane_sum, plane, arr.shape,
+                                            fill_value=float(len(groups[plane])) / num_classes),
+                         count=len(groups[plane]))
+
+    def ensemble_order(self,models,order=None):
+        """
+        Evaluation order of the adaptive ensemble
+        :param dict models: checkpoints {name: path}
+        :param list order: checkpoint names in the order to evaluate (names not listed are left out), by default
+                           the splits are evaluated one after the other with their axial, coronal and sagittal model
+        :return list: (member index, checkpoint path)
+        """
+        import re
+
+        planes = ['axial', 'coronal', 'sagittal']
+        members = [(idx, name, path) for idx, (name, path) in enumerate(models.items())]
+
+        if order:
+            unknown = [name for name in order if name not in models]
+            if unknown:
+                self.logger.info('Unknown models in the adaptive order ignored: {}'.format(', '.join(unknown)))
+            position = dict((name, i) for i, name in enumerate(order))
+            members = sorted([m for m in members if m[1] in position], key=lambda m: position[m[1]])
+        else:
+            def split_key(member):
+                idx, name, path = member
+                match = re.search(r'split_(\d+)', os.path.basename(path))
+                plane = select_plane(path, planes)
+                return (int(match.group(1)) if match else 0, planes.index(plane) if plane in planes else 0, idx)
+
+            members = sorted(members, key=split_key)
+
+        return [(idx, path) for idx, name, path in members]
+
+    def run_adaptive_ensemble(self,arr,models,arc,params,img_size,ensemble,uncertainty=None,roi=None):
+        """
+        Evaluate the ensemble members one at a time (see ensemble_order) and stop once the fused label map no longer
+        changes (foreground Dice between successive partial ensembles >= adaptive_threshold, after at least
+        adaptive_min_models members) or once the time budget of the subject is spent
+        :return int: number of ensemble members used
+        """
+        from ob_pipeline.utils.validation import dice_score
+
+        num_classes = params['num_classes']
+        threshold = self.flags.get('adaptive_threshold', 0.99)
+        min_models = self.flags.get('adaptive_min_models', 3)
+        budget = self.flags.get('time_budget', 0)
+        start = self.start_time if self.start_time is not None else time.time()
+
+        order = self.ensemble_order(models, self.flags.get('adaptive_order'))
+        inputs = {}
+        prediction = None
+        stop_reason = 'all models evaluated'
+
+        for used, (idx, checkpoint) in enumerate(order, 1):
+            plane = select_plane(checkpoint, ['axial', 'coronal', 'sagittal'])
+            if plane not in inputs:
+                inputs[plane] = self.prepare_plane(arr, plane, img_size)
+
+            self.logger.info("--->Testing {} segmentation model {} of {}".format(plane, used, len(order)))
+            with self.timer.stage('segmentation_model', plane=plane, model=os.path.basename(checkpoint)):
+                model = self.get_model(arc, params, checkpoint, example=inputs[plane])
+
+                roi_slices = roi[self.slice_axis[plane]] if roi is not None else None
+                batch_size = self.stage_batch_size('segmentation', arc, model, inputs[plane])
+                probs = self.predict_probs(inputs[plane], model, num_classes, roi_slices, batch_size=batch_size,
+                                           profile_name=self.profile_name('segmentation', plane, checkpoint))
+            probs = self.restore_plane(probs, plane, arr.shape, fill_value=1.0 / num_classes)
+
+            # members are stored in evaluation order
+            ensemble.add(probs)
+            if uncertainty is not None:
+                uncertainty.update(probs)
+
+            current = ensemble.prediction()
+            if prediction is not None:
+                agreement = dice_score(prediction > 0, current > 0)
+                self.logger.info('Agreement with the previous partial ensemble: dice {:.4f}'.format(agreement))
+                if used >= min_models and agreement >= threshold:
+                    stop_reason = 'converged (dice {:.4f} >= {})'.format(agreement, threshold)
+                    break
+            prediction = current
+
+            if budget and time.time() - start > budget and used < len(order):
+                stop_reason = 'time budget of {} s spent'.format(budget)
+                break
+
+        self.logger.info('Adaptive ensemble used {} of {} models: {}'.format(ensemble.count, len(models),
+                                                                              stop_reason))
+
+        return ensemble.count
 
-            # evaluate
-            logits = self.predict(mod_arr, batch_size=self.flags['batch_size'], model=model)
+    def run_localization(self,t2_img):
+        from scipy.ndimage.measurements import center_of_mass
 
-            #organice data
-            logits = plane_swap(logits,plane,inverse=True)
-            # remove padding
-            temp_logits = np.zeros((orig_shape[0], orig_shape[1], orig_shape[2], logits.shape[3]))
-            for i in range(logits.shape[3]):
-                temp_logits[:, :, :, i] = map_size(logits[:, :, :, i],
-                                                   base_shape=(orig_shape[0], orig_shape[1], orig_shape[2]), verbose=0)
+        with self.timer.stage('resample', spacing=self.flags['localization']['spacing']):
+            engine = self.flags.get('resample_engine', 'nibabel')
+            if isinstance(t2_img, BlockVolume):
+                # read block by block (--lazy_io), only the localization grid is held in memory
+                resampled_img = t2_img.resampled(self.flags['localization']['spacing'], engine=engine).to_image()
+            else:
+                resampled_img = resample_to_output(t2_img, self.flags['localization']['spacing'], order=1,
+                                                   engine=engine)
+            orig_arr= resampled_img.get_fdata()
+        orig_shape = orig_arr.shape
+        self.logger.info('Input data shape {}'.format(orig_shape))
 
-            logits = softmax(temp_logits, axis=-1)
-            self.logger.info('output data shape {}'.format(logits.shape))
-            logits = logits[..., np.newaxis]
+        planes = ['axial','coronal', 'sagittal']
+        num_classes = self.loc_params_network['num_classes']
+        ensemble = EnsembleAccumulator(orig_shape + (num_classes,), len(self.flags['localization']['models']))
 
-            sub_logits.append(logits)
+        start_loc=time.time()
 
-            model_end = time.time() - start_model
-            self.logger.info("Model Done in {:0.4f} seconds".format(model_end))
+        self.run_ensemble(orig_arr, self.flags['localization']['models'], self.flags['loc_arc'],
+                          self.loc_params_network, self.flags['localization']['imgSize'], ensemble,
+                          stage='localization')
 
-        sub_logits = np.concatenate(sub_logits, axis=-1)
-        sub_arr = np.sum(sub_logits, axis=-1) / len(planes)
+        sub_arr = ensemble.fused() / len(planes)
         pred_arr = np.argmax(sub_arr, axis=-1)
 
         loc_end = time.time() - start_loc
@@ -210,26 +907,21 @@ class OBNet(object):
             self.logger.info('ERROR: localization network cannot detect the region of interest. Please check image quality')
             pred_cm = None
 
-        del model
-
         return pred_cm,sub_arr[:,:,:,1],resampled_img
 
 
-    def run_segmentation(self,t2_arr,orig_coord):
-
-
-        model = select_model(self.flags['seg_arc'],self.seg_params_network.copy())
-
+    def run_segmentation(self,t2_arr,orig_coord,uncertainty=None,roi=None):
+        """
+        Run the segmentation ensemble on the region around orig_coord
+        :param t2_arr: conformed T2 volume (np.ndarray, or BlockVolume of which only the region is read)
+        :param np.ndarray orig_coord: voxel coordinate of the region center
+        :param UncertaintyAccumulator uncertainty: updated with the output of every ensemble member
+        :param list roi: (low, high) voxel range per axis of the cropped region, slices outside are background
+        :return: label map and the per-model probabilities (only kept with --save_logits, otherwise None)
+        """
 
         num_classes=self.seg_params_network['num_classes']
 
-        if self.model_parallel:
-            model = nn.DataParallel(model)
-
-        model.to(self.device)
-
-        planes = ['axial','coronal','sagittal']
-
         padding =  self.flags['segmentation']['imgSize'][0] // 2
 
         new_t2_arr = t2_arr[orig_coord[0] - padding:orig_coord[0] + padding,
@@ -239,144 +931,157 @@ class OBNet(object):
 
         orig_shape = new_t2_arr.shape
 
-        sub_logits = np.ndarray((orig_shape[0], orig_shape[1], orig_shape[2],num_classes,0), dtype=np.uint8)
+        ensemble = EnsembleAccumulator(orig_shape + (num_classes,), len(self.flags['segmentation']['models']),
+                                       keep_members=self.args.save_logits)
+        self.logger.info('Ensemble buffers: {:0.1f} MB'.format(ensemble.nbytes() / 1024.0 ** 2))
 
         start_seg=time.time()
 
-        for key,seg_model in self.flags['segmentation']['models'].items():
-            plane = select_plane(seg_model,planes)
-            self.logger.info("--->Testing {} segmentation model".format(plane))
-            #load model
-            model_state = self.load_weights(seg_model)
-            model.load_state_dict(model_state)
-            self.logger.info('Model weights loaded from {}'.format(seg_model))
-
-            # organize data
-            mod_arr = plane_swap(new_t2_arr, plane=plane)
-            mod_arr = map_size(mod_arr, base_shape=(mod_arr.shape[0], self.flags['segmentation']['imgSize'][0],
-                                                    self.flags['segmentation']['imgSize'][1]),verbose=0)
-
-            start_model = time.time()
-            # evaluate
-
-            mod_arr = get_thick_slices(mod_arr, self.flags['thickness'])
-            logits = self.predict(mod_arr, batch_size=self.flags['batch_size'], model=model)
-
-            # organice data
-            logits = plane_swap(logits, plane, inverse=True)
-            # remove padding
-            temp_logits = np.zeros((orig_shape[0], orig_shape[1], orig_shape[2], logits.shape[3]))
-            for i in range(logits.shape[3]):
-                temp_logits[:, :, :, i] = map_size(logits[:, :, :, i],
-                                                   base_shape=(orig_shape[0], orig_shape[1], orig_shape[2]),
-                                                   verbose=0)
-
-            logits = softmax(temp_logits, axis=-1)
-
-            logits = logits[..., np.newaxis]
-
-            sub_logits=np.append(sub_logits,logits,axis=-1)
-
-            end_model = time.time() - start_model
-            self.logger.info("Model Done in {:0.4f} seconds".format(end_model))
+        if self.flags.get('adaptive_ensemble', False):
+            self.num_models_used = self.run_adaptive_ensemble(new_t2_arr, self.flags['segmentation']['models'],
+                                                              self.flags['seg_arc'], self.seg_params_network,
+                                                              self.flags['segmentation']['imgSize'], ensemble,
+                                                              uncertainty=uncertainty, roi=roi)
+        else:
+            self.run_ensemble(new_t2_arr, self.flags['segmentation']['models'], self.flags['seg_arc'],
+                              self.seg_params_network, self.flags['segmentation']['imgSize'], ensemble,
+                              uncertainty=uncertainty, stage='segmentation', roi=roi)
+            self.num_models_used = len(self.flags['segmentation']['models'])
 
-        sub_arr = np.sum(sub_logits, axis=-1)
-        pred_arr = np.argmax(sub_arr, axis=-1)
+        pred_arr = ensemble.prediction()
 
         end_seg = time.time() - start_seg
         self.logger.info("---> Finish segmentation models in {:0.4f} seconds".format(end_seg))
 
-        del model
-        return pred_arr,sub_logits
+        return pred_arr,ensemble.member_probs()
 
 
     def eval(self, t2_img,save_dir):
         import nibabel as nib
-        import nibabel.processing
         import h5py
         import os
 
+        self.start_time = time.time()
+
         mri_folder=os.path.join(save_dir,'mri')
         misc.create_exp_directory(mri_folder)
 
+        self.profile_dir = os.path.join(save_dir, 'profile')
+        self.profiled = set()
+
+        # a BlockVolume (--lazy_io) is resampled and read block by block when regions of it are sliced
+        lazy = isinstance(t2_img, BlockVolume)
+        if not lazy:
+            # the interpolation keeps the data type, resample in float32 (the type of conform)
+            t2_img = nib.Nifti1Image(np.asanyarray(t2_img.dataobj).astype(np.float32, copy=False), t2_img.affine,
+                                     t2_img.header)
+
+        # with two_step_localization off the localization is resampled from the conformed image, without the
+        # intermediate grid at flags['spacing']; for inputs not at flags['spacing'] this is one interpolation instead
+        # of two, the heatmap (and the crop) can differ slightly from the two-step localization of previous releases
+        loc_img = t2_img
+
         i_zoom = t2_img.header.get_zooms()
         if not np.allclose(np.array(i_zoom), np.array(self.flags['spacing']), rtol=0.05):
-            self.logger.info('Interpolating image from resolution {} to {}'.format(i_zoom,self.flags['spacing']))
-            t2_img = nibabel.processing.resample_to_output(t2_img, self.flags['spacing'],order=1)
-
-        t2_img.set_data_dtype(np.uint8)
+            # crop-first: the volume at flags['spacing'] is only a grid, the segmentation region of it is
+            # interpolated when it is cropped
+            engine = self.flags.get('resample_engine', 'nibabel')
+            self.logger.info('Interpolating the segmentation region from resolution {} to {} ({} engine)'.format(
+                i_zoom, self.flags['spacing'], engine))
+            t2_img = (t2_img if lazy else ArrayVolume(t2_img)).resampled(self.flags['spacing'], engine=engine)
+            if self.flags.get('two_step_localization', True):
+                # localization grid interpolated from the one at flags['spacing'] (slab by slab), as before crop-first
+                loc_img = t2_img
+
+        t2_img.header.set_data_dtype(np.uint8)
 
         #do not need to save orig.nii.gz
         ##nib.save(t2_img,os.path.join(mri_folder,'orig.nii.gz'))
 
-        t2_arr = t2_img.get_fdata()
+        t2_arr = t2_img if isinstance(t2_img, BlockVolume) else t2_img.get_fdata()
 
         self.logger.info(30 * '-')
         self.logger.info('Running localization models')
-        t2_cm, cm_logits, resampled_img= self.run_localization(t2_img)
+        with self.timer.stage('localization'):
+            t2_cm, cm_logits, resampled_img= self.run_localization(loc_img)
 
         if np.any(t2_cm):
             cm_logits[cm_logits<0.5]= 0
 
-            loc_pred = nib.Nifti1Image(cm_logits, resampled_img.affine, resampled_img.header)
-            loc_pred.set_data_dtype(np.float32)
-            nib.save(loc_pred, os.path.join(mri_folder, 'loc_heatmap.nii.gz'))
+            with self.timer.stage('write', output='loc_heatmap.nii.gz'):
+                loc_pred = nib.Nifti1Image(cm_logits, resampled_img.affine, resampled_img.header)
+                loc_pred.set_data_dtype(np.float32)
+                nib.save(loc_pred, os.path.join(mri_folder, 'loc_heatmap.nii.gz'))
 
-            #transform coordinates
-            coord = np.array((t2_cm[0], t2_cm[1], t2_cm[2], 1))
+            with self.timer.stage('crop'):
+                #transform coordinates
+                coord = np.array((t2_cm[0], t2_cm[1], t2_cm[2], 1))
 
-            orig_coord={}
+                orig_coord={}
 
-            orig_coord['ras'] = np.dot(resampled_img.affine, coord)
+                orig_coord['ras'] = np.dot(resampled_img.affine, coord)
 
-            orig_coord['xyz'] = np.dot(np.linalg.inv(t2_img.affine), orig_coord['ras'])
-            orig_coord['xyz'] = orig_coord['xyz'].astype(np.int)
+                orig_coord['xyz'] = np.dot(np.linalg.inv(t2_img.affine), orig_coord['ras'])
+                orig_coord['xyz'] = orig_coord['xyz'].astype(np.int)
 
-            self.logger.info(30 * '-')
-            self.logger.info('Crop image from coordinate % d, %d , %d' %(orig_coord['xyz'][0],orig_coord['xyz'][1],orig_coord['xyz'][2]))
-            self.logger.info(30 * '-')
+                self.logger.info(30 * '-')
+                self.logger.info('Crop image from coordinate % d, %d , %d' %(orig_coord['xyz'][0],orig_coord['xyz'][1],orig_coord['xyz'][2]))
+                self.logger.info(30 * '-')
 
-            #----------Segmentation----------
-            self.logger.info(30 * '-')
-            self.logger.info('Running segmentation models')
-            prediction, logits = self.run_segmentation(t2_arr,orig_coord['xyz'])
+                padding=self.flags['segmentation']['imgSize'][0] // 2
+                zero_coordinate = np.array([orig_coord['xyz'][0] - padding, orig_coord['xyz'][1] - padding,
+                                            orig_coord['xyz'][2] - padding, 1])
 
+                orig_coord['zero_xyz']=zero_coordinate
 
-            padding=self.flags['segmentation']['imgSize'][0] // 2
-            zero_coordinate = np.array([orig_coord['xyz'][0] - padding, orig_coord['xyz'][1] - padding,
-                                        orig_coord['xyz'][2] - padding, 1])
+                self.logger.info(30 * '-')
+                self.logger.info('zero coordinate')
+                self.logger.info(zero_coordinate)
+                translationRAS = np.dot(t2_img.affine, zero_coordinate)
 
-            orig_coord['zero_xyz']=zero_coordinate
+                vox2RAS = t2_img.affine.copy()
 
-            crop_t2_arr = t2_arr[orig_coord['xyz'][0] - padding:orig_coord['xyz'][0] + padding,
-                         orig_coord['xyz'][1] - padding:orig_coord['xyz'][1] + padding,
-                         orig_coord['xyz'][2] - padding:orig_coord['xyz'][2] + padding]
+                vox2RAS[0, 3] = translationRAS[0]
+                vox2RAS[1, 3] = translationRAS[1]
+                vox2RAS[2, 3] = translationRAS[2]
 
-            self.logger.info(30 * '-')
-            self.logger.info('zero coordinate')
-            self.logger.info(zero_coordinate)
-            translationRAS = np.dot(t2_img.affine, zero_coordinate)
-
-            vox2RAS = t2_img.affine[:]
+                roi = None
+                if self.flags.get('roi_pruning', False):
+                    roi = heatmap_roi(cm_logits, resampled_img.affine, t2_img.affine, zero_coordinate,
+                                      (2 * padding,) * 3, margin=self.flags.get('roi_margin', 8.0))
+                    self.logger.info('Segmentation ROI {} (margin {} mm)'.format(roi,
+                                                                                 self.flags.get('roi_margin', 8.0)))
 
-            vox2RAS[0, 3] = translationRAS[0]
-            vox2RAS[1, 3] = translationRAS[1]
-            vox2RAS[2, 3] = translationRAS[2]
+                crop_t2_arr = t2_arr[orig_coord['xyz'][0] - padding:orig_coord['xyz'][0] + padding,
+                             orig_coord['xyz'][1] - padding:orig_coord['xyz'][1] + padding,
+                             orig_coord['xyz'][2] - padding:orig_coord['xyz'][2] + padding]
 
+                crop_t2=nib.Nifti1Image(crop_t2_arr,vox2RAS, t2_img.header)
 
-            crop_t2=nib.Nifti1Image(crop_t2_arr,vox2RAS, t2_img.header)
+            #----------Segmentation----------
+            self.logger.info(30 * '-')
+            self.logger.info('Running segmentation models')
+            uncertainty = UncertaintyAccumulator(vox2RAS, t2_img.header, orig_coord['ras'])
+            with self.timer.stage('segmentation'):
+                # the region is already cropped (and interpolated), its center is the center of the crop
+                prediction, logits = self.run_segmentation(crop_t2_arr,np.array([padding] * 3),
+                                                           uncertainty=uncertainty,roi=roi)
+            orig_coord['num_models'] = self.num_models_used
 
-            pred_img = nib.MGHImage(prediction, vox2RAS, t2_img.header)
-            pred_img=clean_seg(pred_img,orig_coord['ras'])
-            pred_img.set_data_dtype(np.int16)
-            nib.save(pred_img,os.path.join(mri_folder,'ob_seg.mgz'))
+            with self.timer.stage('clean_seg'):
+                pred_img = nib.MGHImage(prediction, vox2RAS, t2_img.header)
+                pred_img=clean_seg(pred_img,orig_coord['ras'])
+                pred_img.set_data_dtype(np.int16)
 
+            with self.timer.stage('write', output='ob_seg.mgz'):
+                nib.save(pred_img,os.path.join(mri_folder,'ob_seg.mgz'))
 
             if self.args.save_logits:
-                logit_file=os.path.join(mri_folder,'ob_seg_logits.h5')
-                hf = h5py.File(logit_file, 'w')
-                hf.create_dataset('Data', data=logits.astype(np.float32), compression='gzip')
-                hf.close()
-            return pred_img,crop_t2, logits ,orig_coord,cm_logits
+                with self.timer.stage('write', output='ob_seg_logits.h5'):
+                    logit_file=os.path.join(mri_folder,'ob_seg_logits.h5')
+                    hf = h5py.File(logit_file, 'w')
+                    hf.create_dataset('Data', data=logits.astype(np.float32), compression='gzip')
+                    hf.close()
+            return pred_img,crop_t2, uncertainty ,orig_coord,cm_logits
         else:
             return None,None,None,None,None
@@ -0,0 +1,158 @@
+# Copyright 2023 Population Health Sciences and AI in Medical Imaging, German Center for Neurodegenerative Diseases (DZNE)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Batch size selection from the measured memory footprint of a network: the peak memory of a forward pass is measured
+for one and for a few slices, which gives the memory per slice and the fixed cost, and the largest batch fitting the
+memory budget is used
+"""
+
+import ctypes
+import os
+
+import torch
+
+from ob_pipeline.utils import misc
+
+# Batch sizes tuned in this process {(stage, arc, slice shape, members, device, backend, budget, workers): size}
+TUNED_BATCH_SIZES = {}
+
+
+def available_memory(device):
+    """
+    :param device: torch device
+    :return int: free memory of the device in bytes (CPU: available physical memory), None if unknown
+    """
+    device = torch.device(device)
+    if device.type == 'cuda':
+        if hasattr(torch.cuda, 'mem_get_info'):
+            return torch.cuda.mem_get_info(device)[0]
+        reserved = getattr(torch.cuda, 'memory_reserved', None) or torch.cuda.memory_cached
+        return torch.cuda.get_device_properties(device).total_memory - reserved(device)
+
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def peak_memory(model, batch, device):
+    """
+    Peak memory allocated during the forward pass of a batch, input included
+    :param model: network in eval mode
+    :param batch: N x C x H x W tensor
+    :param device: torch device the network runs on
+    :return int: bytes, None if the memory cannot be measured (CPU outside of linux without torch >= 1.6)
+    """
+    device = torch.device(device)
+    batch = batch.to(device)
+    input_bytes = batch.element_size() * batch.nelement()
+
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        if hasattr(torch.cuda, 'reset_peak_memory_stats'):
+            torch.cuda.reset_peak_memory_stats(device)
+        else:
+            torch.cuda.reset_max_memory_allocated(device)
+        base = torch.cuda.memory_allocated(device)
+
+        with torch.no_grad():
+            model(batch)
+        torch.cuda.synchronize(device)
+
+        return torch.cuda.max_memory_allocated(device) - base + input_bytes
+
+    with torch.no_grad():
+        peak = cpu_peak_memory(lambda: model(batch))
+        if not peak:
+            # torch < 1.6 or nothing seen by the torch allocator (e.g. ONNX Runtime)
+            peak = rss_peak_memory(lambda: model(batch))
+
+    return peak + input_bytes if peak else None
+
+
+def cpu_peak_memory(fn):
+    """
+    Peak of the CPU memory allocated by torch while fn runs (autograd profiler memory events)
+    :param fn: function without arguments
+    :return int: bytes, None with torch < 1.6
+    """
+    try:
+        profiler = torch.autograd.profiler.profile(profile_memory=True)
+    except TypeError:
+        return None
+
+    with profiler:
+        fn()
+
+    # allocations are reported by the allocating operators, releases by [memory] events
+    events = sorted((event for event in profiler.function_events if event.self_cpu_memory_usage),
+                    key=lambda event: event.time_range.start)
+    current = peak = 0
+    for event in events:
+        current += event.self_cpu_memory_usage
+        peak = max(peak, current)
+
+    return peak
+
+
+def rss_peak_memory(fn):
+    """
+    Peak increase of the resident set size of the process while fn runs (VmHWM reset before fn, linux), measures
+    any torch version and allocations outside of torch. Resets the process peak, see misc.reset_peak_rss.
+    :param fn: function without arguments, called twice
+    :return int: bytes, None if the peak cannot be reset
+    """
+    # the first call also allocates what stays for the process (thread pools, kernel caches)
+    fn()
+
+    # free heap pages still resident would be reused by fn without raising the peak (glibc only)
+    try:
+        ctypes.CDLL('libc.so.6').malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+    if not misc.reset_peak_rss():
+        return None
+
+    # right after the reset the peak is the current resident set size
+    base = misc.get_current_peak_rss()
+    fn()
+    return int((misc.get_current_peak_rss() - base) * 2 ** 20)
+
+
+def tune_batch_size(model, example, device, budget, probe_slices=2):
+    """
+    Largest batch whose forward pass fits the memory budget
+    :param model: network in eval mode
+    :param example: N x C x H x W input of the network (the first slices are used for the probes)
+    :param device: torch device the network runs on
+    :param float budget: memory budget in bytes
+    :param int probe_slices: slices of the second probe
+    :return tuple: (batch size, bytes per slice, fixed bytes), None if the memory cannot be measured
+    """
+    single = peak_memory(model, example[:1], device)
+    if not single or single <= 0:
+        return None
+
+    per_slice = single
+    probe_slices = min(probe_slices, example.shape[0])
+    if probe_slices > 1:
+        multiple = peak_memory(model, example[:probe_slices], device)
+        per_slice = float(multiple - single) / (probe_slices - 1)
+        if per_slice <= 0:
+            per_slice = single
+
+    fixed = max(single - per_slice, 0)
+    return max(1, int((budget - fixed) // per_slice)), per_slice, fixed
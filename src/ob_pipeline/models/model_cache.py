@@ -0,0 +1,77 @@
+# Copyright 2023 Population Health Sciences and AI in Medical Imaging, German Center for Neurodegenerative Diseases (DZNE)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+from collections import OrderedDict
+import threading
+
+
+class ModelCache(object):
+    """
+    Process-level LRU registry of ready-to-run networks.
+    Entries are keyed by (architecture, checkpoint path, device, ...) so that a worker processing many subjects
+    only unpickles and remaps every checkpoint once.
+    """
+
+    def __init__(self, max_size=15):
+        """
+        :param int max_size: maximum number of networks kept in memory (0 disables caching)
+        """
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._models = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Return the cached network for key (marking it as most recently used) or None
+        """
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                self.hits += 1
+                return self._models[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, model):
+        """
+        Insert a network, evicting the least recently used entries above max_size
+        """
+        with self._lock:
+            if self.max_size <= 0:
+                return
+            self._models[key] = model
+            self._models.move_to_end(key)
+            while len(self._models) > self.max_size:
+                self._models.popitem(last=False)
+
+    def resize(self, max_size):
+        with self._lock:
+            self.max_size = max_size
+            while len(self._models) > max(self.max_size, 0):
+                self._models.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._models.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._models)
+
+
+# One registry per (worker) process, shared by every OBNet instance
+MODEL_CACHE = ModelCache()
@@ -0,0 +1,51 @@
+# Copyright 2023 Population Health Sciences and AI in Medical Imaging, German Center for Neurodegenerative Diseases (DZNE)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import torch
+
+
+class OnnxModel(object):
+    """
+    ONNX Runtime (CPU) session wrapped with the calling convention of the torch networks,
+    so it can be used by OBNet.predict in place of a model: tensor N x C x H x W in, logits tensor out.
+    """
+
+    def __init__(self, path, intra_op_threads=0, inter_op_threads=0):
+        """
+        :param str path: exported .onnx model (see export_models)
+        :param int intra_op_threads: threads used inside one operator (0: onnxruntime default)
+        :param int inter_op_threads: threads used across independent operators (0: onnxruntime default)
+        """
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError('The onnx backend requires onnxruntime (pip install onnxruntime)')
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if intra_op_threads:
+            options.intra_op_num_threads = intra_op_threads
+        if inter_op_threads:
+            options.inter_op_num_threads = inter_op_threads
+
+        self.path = path
+        self.session = onnxruntime.InferenceSession(path, sess_options=options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, x):
+        logits = self.session.run(None, {self.input_name: x.detach().cpu().numpy()})[0]
+        return torch.from_numpy(logits)
+
+    def eval(self):
+        return self
@@ -0,0 +1,145 @@
+# Copyright 2023 Population Health Sciences and AI in Medical Imaging, German Center for Neurodegenerative Diseases (DZNE)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Inference-time transformations of the FastSurferCNN / AttFastSurferCNN networks (applied after the weights are loaded)
+"""
+
+import torch
+import torch.nn as nn
+
+from ob_pipeline.models import FastSurferCNN, AttFastSurferCNN
+from ob_pipeline.models.AttFastSurferCNN import Self_Attn
+
+
+class ScatterMaxUnpool2d(nn.Module):
+    """
+    MaxUnpool2d written as a scatter into the flattened output plane.
+    Gives the same result as nn.MaxUnpool2d but can be traced for any input size and exported to ONNX.
+    """
+
+    def __init__(self, kernel_size, stride):
+        super(ScatterMaxUnpool2d, self).__init__()
+        self.kernel_size = kernel_size
+        self.stride = stride
+
+    def forward(self, x, indices):
+        m_batchsize, C, height, width = x.size()
+        out_height = (height - 1) * self.stride + self.kernel_size
+        out_width = (width - 1) * self.stride + self.kernel_size
+
+        out = x.new_zeros((m_batchsize, C, out_height * out_width))
+        out = out.scatter(2, indices.reshape(m_batchsize, C, -1), x.reshape(m_batchsize, C, -1))
+
+        return out.view(m_batchsize, C, out_height, out_width)
+
+
+def make_traceable(model):
+    """
+    Replace the unpooling layers of a network by their scatter version (required to trace/export the networks)
+    :param nn.Module model: network
+    :return: the network (modified in place)
+    """
+    for m in model.modules():
+        if isinstance(getattr(m, 'unpool', None), nn.MaxUnpool2d):
+            unpool = m.unpool
+            kernel_size = unpool.kernel_size[0] if isinstance(unpool.kernel_size, tuple) else unpool.kernel_size
+            stride = unpool.stride[0] if isinstance(unpool.stride, tuple) else unpool.stride
+            m.unpool = ScatterMaxUnpool2d(kernel_size, stride)
+
+    return model
+
+
+def fold_conv_bn(conv, bn):
+    """
+    Fold an eval mode BatchNorm into the convolution that precedes it (computed in float64)
+    :param nn.Conv2d conv: convolution, updated in place
+    :param nn.BatchNorm2d bn: batch normalization applied to the convolution output
+    """
+    with torch.no_grad():
+        scale = bn.weight.double() / torch.sqrt(bn.running_var.double() + bn.eps)
+        bias = conv.bias.double() if conv.bias is not None else torch.zeros_like(scale)
+
+        weight = conv.weight.double() * scale.reshape(-1, 1, 1, 1)
+        bias = (bias - bn.running_mean.double()) * scale + bn.bias.double()
+
+        conv.weight.copy_(weight.to(conv.weight.dtype))
+        if conv.bias is None:
+            conv.bias = nn.Parameter(bias.to(conv.weight.dtype))
+        else:
+            conv.bias.copy_(bias.to(conv.bias.dtype))
+
+
+def folded_pairs(block):
+    """
+    (conv, bn) attribute pairs of a CompetitiveDenseBlock where the BN only normalizes that conv output.
+    bn0 (input normalization, before a zero padded conv) and bn4 (after the attention) cannot be folded.
+    """
+    pairs = [('conv0', 'bn1'), ('conv1', 'bn2')]
+
+    # the last FastSurferCNN block skips bn3
+    if not (isinstance(block, FastSurferCNN.CompetitiveDenseBlock) and block.outblock):
+        pairs.append(('conv2', 'bn3'))
+
+    return pairs
+
+
+def fold_batchnorm(model):
+    """
+    Fold the BatchNorm layers of the competitive dense blocks into their convolutions and replace them
+    by identities (inference only, the model must be in eval mode). Exact in float64 only: the float32 folded
+    weights round differently, which can move maxout and max pooling near ties, so OBNet folds only with the
+    fold_batchnorm flag.
+    :param nn.Module model: FastSurferCNN or AttFastSurferCNN
+    :return int: number of folded BatchNorm layers
+    """
+    if model.training:
+        raise ValueError('BatchNorm folding requires a model in eval mode')
+
+    blocks = (FastSurferCNN.CompetitiveDenseBlock, FastSurferCNN.CompetitiveDenseBlockInput,
+              AttFastSurferCNN.CompetitiveDenseBlock, AttFastSurferCNN.CompetitiveDenseBlockInput)
+
+    folded = 0
+    for m in model.modules():
+        if not isinstance(m, blocks):
+            continue
+        for conv_name, bn_name in folded_pairs(m):
+            bn = getattr(m, bn_name)
+            if isinstance(bn, nn.BatchNorm2d):
+                fold_conv_bn(getattr(m, conv_name), bn)
+                setattr(m, bn_name, nn.Identity())
+                folded += 1
+
+    return folded
+
+
+def prune_attention(model, threshold):
+    """
+    Replace the Self_Attn layers whose learned |gamma| is at most threshold by identities. Their output is
+    gamma * attention + x, so the N x N attention contributes (almost) nothing when gamma is negligible.
+    :param nn.Module model: AttFastSurferCNN in eval mode
+    :param float threshold: largest |gamma| pruned
+    :return list: (block name, gamma) of the pruned layers
+    """
+    candidates = [(name, m) for name, m in model.named_modules()
+                  if isinstance(getattr(m, 'att_conv', None), Self_Attn)]
+
+    pruned = []
+    for name, m in candidates:
+        gamma = float(m.att_conv.gamma.detach().abs().max())
+        if gamma <= threshold:
+            m.att_conv = nn.Identity()
+            pruned.append((name, gamma))
+
+    return pruned
@@ -0,0 +1,176 @@
+# Copyright 2023 Population Health Sciences and AI in Medical Imaging, German Center for Neurodegenerative Diseases (DZNE)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Operator-level profiling of the networks (--profile): the first batches of a forward pass run under the torch
+profiler and the blocks of the network are annotated, so the time can be attributed to encode1..4, bottleneck,
+decode1..4, the self-attention and the classifier
+"""
+
+import os
+import time
+
+import torch
+import torch.nn as nn
+
+from ob_pipeline.models.AttFastSurferCNN import Self_Attn
+
+MODULE_GROUPS = ('encode1', 'encode2', 'encode3', 'encode4', 'bottleneck',
+                 'decode4', 'decode3', 'decode2', 'decode1', 'classifier')
+
+ANNOTATION_PREFIX = 'module::'
+
+
+def annotation_target(model):
+    """
+    :param model: network
+    :return: the module whose blocks can be annotated, None if the blocks cannot be annotated (TorchScript, ONNX,
+             stacked models, or DataParallel on several devices: the replicas made on every forward pass do not
+             carry the annotated forwards)
+    """
+    if not isinstance(model, nn.Module) or isinstance(model, torch.jit.ScriptModule):
+        return None
+    if isinstance(model, nn.DataParallel):
+        # on one device DataParallel calls the wrapped module itself
+        return model.module if len(model.device_ids or []) <= 1 else None
+    return model
+
+
+def annotated_modules(model):
+    """
+    :param model: FastSurferCNN or AttFastSurferCNN
+    :return list: (annotation, module) of the blocks of the network, the Self_Attn blocks are also annotated on their
+                  own (their time is also included in the one of the block they belong to)
+    """
+    modules = [(ANNOTATION_PREFIX + name, getattr(model, name)) for name in MODULE_GROUPS if hasattr(model, name)]
+    modules += [(ANNOTATION_PREFIX + 'Self_Attn', m) for m in model.modules() if isinstance(m, Self_Attn)]
+    return modules
+
+
+class OperatorProfiler(object):
+    """
+    Profile of the forward passes of one network, written as a Chrome trace (<name>.trace.json), the per-operator
+    summary (<name>.operators.txt) and the per-block summary (<name>.modules.txt)
+    """
+
+    def __init__(self, model, out_dir, name, row_limit=40, logger=None):
+        """
+        :param model: network (blocks annotated only for torch modules, see annotation_target)
+        :param str out_dir: output directory (created if needed)
+        :param str name: file prefix, e.g. segmentation_axial_<checkpoint>
+        :param int row_limit: rows of the per-operator table
+        :param logger: logs when the blocks cannot be annotated
+        """
+        self.model = model
+        self.out_dir = out_dir
+        self.name = name
+        self.row_limit = row_limit
+        self.logger = logger
+        self.use_cuda = torch.cuda.is_available() and any(p.is_cuda for p in self.parameters())
+        self.profiler = None
+        self.wrapped = []
+        self.start_time = None
+
+    def parameters(self):
+        return self.model.parameters() if isinstance(self.model, nn.Module) else []
+
+    def annotate(self):
+        target = annotation_target(self.model)
+        if target is None:
+            if isinstance(self.model, nn.DataParallel) and self.logger is not None:
+                self.logger.info('Profile {}: block annotation is unavailable with DataParallel on {} devices, only '
+                                 'the per-operator profile is written'.format(self.name, len(self.model.device_ids)))
+            return
+
+        def annotated(annotation, original):
+            def forward(*args, **kwargs):
+                with torch.autograd.profiler.record_function(annotation):
+                    return original(*args, **kwargs)
+            return forward
+
+        for annotation, module in annotated_modules(target):
+            # the networks call the blocks through .forward, module hooks would not see them
+            module.forward = annotated(annotation, module.forward)
+            self.wrapped.append(module)
+
+    def restore(self):
+        for module in self.wrapped:
+            del module.forward
+        self.wrapped = []
+
+    def start(self):
+        if hasattr(torch, 'profiler') and hasattr(torch.profiler, 'profile'):
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.use_cuda:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profiler = torch.profiler.profile(activities=activities)
+        else:
+            self.profiler = torch.autograd.profiler.profile(use_cuda=self.use_cuda)
+
+        self.annotate()
+        self.profiler.__enter__()
+        self.start_time = time.time()
+
+    def stop(self, num_batches):
+        """
+        Stop profiling and write the outputs
+        :param int num_batches: batches run under the profiler
+        :return list: written files
+        """
+        if self.use_cuda:
+            torch.cuda.synchronize()
+        wall = time.time() - self.start_time
+        try:
+            self.profiler.__exit__(None, None, None)
+        finally:
+            self.restore()
+
+        if not os.path.isdir(self.out_dir):
+            os.makedirs(self.out_dir)
+        prefix = os.path.join(self.out_dir, self.name)
+
+        files = [prefix + '.trace.json', prefix + '.operators.txt', prefix + '.modules.txt']
+        self.profiler.export_chrome_trace(files[0])
+
+        averages = self.profiler.key_averages()
+        with open(files[1], 'w') as f:
+            f.write('{} batches, {:.4f} s\n'.format(num_batches, wall))
+            f.write(averages.table(sort_by='self_cpu_time_total', row_limit=self.row_limit))
+
+        with open(files[2], 'w') as f:
+            f.write(self.module_table(averages, wall, num_batches))
+
+        return files
+
+    def module_table(self, averages, wall, num_batches):
+        """
+        :return str: CPU time per annotated block and its share of the profiled wall time
+        """
+        blocks = dict((event.key, event) for event in averages if event.key.startswith(ANNOTATION_PREFIX))
+        order = [ANNOTATION_PREFIX + name for name in MODULE_GROUPS + ('Self_Attn',)]
+
+        lines = ['{} batches, {:.4f} s'.format(num_batches, wall),
+                 '{:>12} {:>8} {:>14} {:>8}'.format('block', 'calls', 'CPU total [ms]', 'share')]
+        for key in order:
+            if key in blocks:
+                event = blocks[key]
+                total = event.cpu_time_total / 1000.0
+                lines.append('{:>12} {:>8} {:>14.2f} {:>8.1%}'.format(key[len(ANNOTATION_PREFIX):], event.count,
+                                                                      total, total / 1000.0 / wall))
+        if len(lines) == 2:
+            lines.append('no annotated blocks (TorchScript, ONNX, stacked networks or DataParallel on several '
+                         'devices)')
+        else:
+            lines.append('Self_Attn is also included in the time of the blocks containing it')
+        return '\n'.join(lines) + '\n'
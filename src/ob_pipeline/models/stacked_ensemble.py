@@ -0,0 +1,113 @@
+# Copyright 2023 Population Health Sciences and AI in Medical Imaging, German Center for Neurodegenerative Diseases (DZNE)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import copy
+
+import torch
+
+from ob_pipeline.models.optimize import make_traceable
+
+# Stacked ensembles that failed the equivalence check in this process (their planes run one model after the other)
+REJECTED_STACKS = set()
+
+
+def stacking_available():
+    """
+    :return bool: torch provides torch.func (torch >= 2.0)
+    """
+    try:
+        from torch.func import stack_module_state, functional_call, vmap
+    except ImportError:
+        return False
+    return True
+
+
+def same_structure(models):
+    """
+    :return bool: the networks have the same modules and parameter/buffer names (e.g. same attention pruning)
+    """
+    def signature(model):
+        return ([type(m) for m in model.modules()], list(model.state_dict().keys()))
+
+    reference = signature(models[0])
+    return all(signature(model) == reference for model in models[1:])
+
+
+class StackedEnsemble(object):
+    """
+    Several checkpoints of one architecture evaluated in a single forward pass: their parameters are stacked and the
+    network is vmapped over the model dimension. The logits of the members are concatenated along the channel
+    dimension (member major), so the output of a B x C x H x W batch is B x (num_members * num_classes) x H x W.
+    """
+
+    def __init__(self, models):
+        """
+        :param list models: networks in eval mode with the same structure
+        """
+        from torch.func import stack_module_state, functional_call, vmap
+
+        for model in models:
+            # MaxUnpool2d has no batching rule, the scatter version has
+            make_traceable(model)
+            for m in model.modules():
+                # the chunked attention writes into a preallocated output, which vmap does not support
+                if getattr(m, 'chunk_size', None):
+                    raise ValueError('StackedEnsemble cannot run the chunked attention (chunk_size {})'
+                                     .format(m.chunk_size))
+
+        self.num_members = len(models)
+        self.params, self.buffers = stack_module_state(models)
+
+        base = copy.deepcopy(models[0]).to('meta')
+
+        def forward(params, buffers, x):
+            return functional_call(base, (params, buffers), (x,))
+
+        self.forward = vmap(forward, in_dims=(0, 0, None))
+
+    def __call__(self, x):
+        logits = self.forward(self.params, self.buffers, x)  # M x B x C x H x W
+        return logits.transpose(0, 1).reshape(x.shape[0], -1, logits.shape[3], logits.shape[4])
+
+    def eval(self):
+        return self
+
+
+def compare_members(stacked, members, images, batch_size=1):
+    """
+    Logits of the stacked ensemble and of its members evaluated one after the other on the same images. vmap runs
+    other kernels (summation order) than the single networks, which badly conditioned networks amplify.
+    :param StackedEnsemble stacked: ensemble of the members
+    :param list members: networks in eval mode, in the order they were stacked
+    :param tensor images: normalized N x C x H x W network input
+    :param int batch_size: number of slices per forward pass
+    :return list: per member max_diff and median_diff (absolute logit differences) and agreement (fraction of pixels
+                  with the same label), see export_models.compare_logits
+    """
+    def run(model):
+        return torch.cat([model(images[start:start + batch_size]) for start in range(0, images.shape[0], batch_size)])
+
+    measures = []
+    with torch.no_grad():
+        stacked_logits = run(stacked)
+        num_classes = stacked_logits.shape[1] // len(members)
+
+        for member, model in enumerate(members):
+            reference = run(model)
+            output = stacked_logits[:, member * num_classes:(member + 1) * num_classes]
+            diff = torch.abs(reference - output)
+            measures.append({'max_diff': float(torch.max(diff)), 'median_diff': float(torch.median(diff)),
+                             'agreement': float(torch.mean((reference.argmax(1) == output.argmax(1)).float()))})
+
+    return measures
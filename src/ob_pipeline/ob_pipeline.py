@@ -71,12 +71,15 @@ def ob_segment(sub_id, in_img, batch_size, rs, model,no_cuda,save_logits, flags)
 
     import os
     import time
+    import numpy as np
     import nibabel as nib
     from ob_pipeline.utils import conform as conform
+    from ob_pipeline.utils.lazy_volume import ConformedVolume, lazy_readable
     from ob_pipeline.models.OBNet import OBNet
     from ob_pipeline.utils import stats
     from ob_pipeline.utils import visualization
     from ob_pipeline.utils import misc
+    from ob_pipeline.utils.timing import StageTimer
     from collections import namedtuple
     import glob
 
@@ -96,18 +99,34 @@ def ob_segment(sub_id, in_img, batch_size, rs, model,no_cuda,save_logits, flags)
     logger = misc.setup_logger("log.txt")
 
     start = time.time()
+    misc.reset_peak_rss()
+    timer = StageTimer()
 
 
     if os.path.isfile(args.in_img):
 
         logger.info('Reading file {}'.format(in_img))
         #load t2 image
-        t2_orig_img=nib.load(args.in_img)
-        t2_img=conform.conform(t2_orig_img,flags,logger)
+        with timer.stage('load'):
+            t2_orig_img=nib.load(args.in_img)
+            lazy_io = flags.get('lazy_io', False) and lazy_readable(t2_orig_img)
+            if lazy_io:
+                logger.info('Uncompressed input, the T2 is read block by block')
+            else:
+                if flags.get('lazy_io', False):
+                    logger.info('Compressed input, the whole T2 is read')
+                # read the data here, in its stored type (conform converts it to float32)
+                t2_orig_img=t2_orig_img.__class__(np.asanyarray(t2_orig_img.dataobj), t2_orig_img.affine,
+                                                  t2_orig_img.header)
+        with timer.stage('conform'):
+            if lazy_io:
+                t2_img=ConformedVolume(t2_orig_img,flags,logger)
+            else:
+                t2_img=conform.conform(t2_orig_img,flags,logger)
 
 
         #Prediction
-        pipeline= OBNet(args,flags,logger)
+        pipeline= OBNet(args,flags,logger,timer=timer)
 
         pred_img,t2_crop, logits,coords,cm_logits= pipeline.eval(t2_img,save_dir)
 
@@ -118,19 +137,26 @@ def ob_segment(sub_id, in_img, batch_size, rs, model,no_cuda,save_logits, flags)
 
             misc.create_exp_directory(os.path.join(save_dir,'QC'))
 
-            visualization.plot_qc_images(save_dir=save_dir,image=t2_crop,prediction=pred_img)
+            with timer.stage('qc'):
+                visualization.plot_qc_images(save_dir=save_dir,image=t2_crop,prediction=pred_img)
 
 
-            stats.calculate_stats(args,save_dir,image=t2_crop,prediction=pred_img,logits=logits,cm=coords,cm_logits=cm_logits,logger=logger)
+            with timer.stage('stats'):
+                stats.calculate_stats(args,save_dir,image=t2_crop,prediction=pred_img,logits=logits,cm=coords,cm_logits=cm_logits,logger=logger)
 
             end = time.time() - start
 
             logger.info("Total computation time :  %0.4f seconds." % end)
+            logger.info("Peak memory (RSS) :  %0.1f MB." % timer.peak_rss())
         else:
-            stats.calculate_stats_no_loc(args, save_dir)
+            with timer.stage('stats'):
+                stats.calculate_stats_no_loc(args, save_dir)
+
 
+        with timer.stage('table', table='rs_ob_stats.json'):
+            stats.obstats2tableRS(args, save_dir)
 
-        stats.obstats2tableRS(args, save_dir)
+        timer.save(os.path.join(save_dir, 'stats', 'timings.json'), sub_id=args.sub_id)
 
     else:
         logger.info('ERROR: file {} not found'.format(args.in_img))
@@ -187,7 +213,25 @@ def option_parse():
     return args,FLAGS
 """
 
-def set_up_model(model,batch_size,seg_dir,seg_arc,loc_dir,loc_arc):
+def select_t2(in_files):
+    """
+    Pick the T2 of a subject for --lazy_io: an uncompressed image (.nii, .mgh), read block by block, if there is one,
+    otherwise a compressed one (read whole)
+    :param list in_files: files of the subject matching T2*
+    :return str: path of the T2 image
+    """
+    image_exts = ('.nii', '.mgh', '.nii.gz', '.mgz')
+    images = sorted(f for f in in_files if f.lower().endswith(image_exts))
+    if not images:
+        raise ValueError('No T2 image (.nii, .mgh, .nii.gz, .mgz) in {}'.format(in_files))
+
+    for ext in image_exts:
+        for image in images:
+            if image.lower().endswith(ext):
+                return image
+
+
+def set_up_model(model,batch_size,seg_dir,seg_arc,loc_dir,loc_arc,inference_opts=None):
 
     from ob_pipeline.ob_pipeline import read_config,get_full_paths
     import os
@@ -203,6 +247,9 @@ def set_up_model(model,batch_size,seg_dir,seg_arc,loc_dir,loc_arc):
 
     FLAGS['num_classes'] = 2
 
+    # Networks kept in memory per worker process (3 localization + 12 segmentation models)
+    FLAGS['model_cache_size'] = 15
+
     # Segmenation model
     FLAGS['segmentation'] = {}
 
@@ -248,13 +295,17 @@ def set_up_model(model,batch_size,seg_dir,seg_arc,loc_dir,loc_arc):
     FLAGS.update({'loc_arc':loc_arc})
     FLAGS.update({'seg_arc':seg_arc})
 
+    # inference options from the command line (e.g. attention_chunk)
+    if inference_opts:
+        FLAGS.update(inference_opts)
+
     return FLAGS
 
 
 
 
 def ob_pipeline_workflow(scans_dir, work_dir, outputdir, subject_ids,
-                          batch_size,save_logits,model,rs,no_cuda, loc_arc, seg_arc, wfname):
+                          batch_size,save_logits,model,rs,no_cuda, loc_arc, seg_arc, wfname, inference_opts=None):
 
 
     obwf = pe.Workflow(name=wfname)
@@ -266,14 +317,23 @@ def ob_pipeline_workflow(scans_dir, work_dir, outputdir, subject_ids,
     inputnode.inputs.model=model
     inputnode.inputs.outputdir = outputdir
 
-    #template for input files
-    templates = {"T2": "{subject_id}/T2*.nii.gz"}
+    lazy_io = bool(inference_opts and inference_opts.get('lazy_io', False))
+
+    #template for input files, with --lazy_io all T2 images are selected and select_t2 prefers an uncompressed one
+    if lazy_io:
+        templates = {"T2": "{subject_id}/T2*"}
+    else:
+        templates = {"T2": "{subject_id}/T2*.nii.gz"}
 
-    fileselector = pe.Node(SelectFiles(templates), name='fileselect')
+    fileselector = pe.Node(SelectFiles(templates, force_lists=lazy_io), name='fileselect')
     fileselector.inputs.base_directory = scans_dir
 
+    select_img = pe.Node(interface=util.Function(input_names=['in_files'], output_names=['in_img'],
+                                                 function=select_t2), name='select_t2')
+
     #setup model
-    setup_model=pe.Node(interface=util.Function(input_names=['model','batch_size','seg_dir','seg_arc','loc_dir','loc_arc'],
+    setup_model=pe.Node(interface=util.Function(input_names=['model','batch_size','seg_dir','seg_arc','loc_dir','loc_arc',
+                                                             'inference_opts'],
                                                 output_names=['flags'],
                                                 function=set_up_model),name='setup_model')
 
@@ -282,6 +342,7 @@ def ob_pipeline_workflow(scans_dir, work_dir, outputdir, subject_ids,
     setup_model.inputs.loc_dir=loc_dir
     setup_model.inputs.loc_arc=loc_arc
     setup_model.inputs.batch_size=batch_size
+    setup_model.inputs.inference_opts=inference_opts if inference_opts else {}
 
     segment_ob = pe.Node(interface=util.Function(input_names=['sub_id', 'in_img', 'batch_size','rs','model','no_cuda', 'save_logits','flags'],
                                                  output_names=['mri_files','qc_files','stats_files'],
@@ -303,7 +364,11 @@ def ob_pipeline_workflow(scans_dir, work_dir, outputdir, subject_ids,
     obwf.connect(inputnode        , 'model',            setup_model,    'model')
     obwf.connect(inputnode        , 'subject_ids',      segment_ob,     'sub_id')
     obwf.connect(inputnode        , 'model',            segment_ob,     'model')
-    obwf.connect(fileselector     , 'T2',               segment_ob,     'in_img')
+    if lazy_io:
+        obwf.connect(fileselector , 'T2',               select_img,     'in_files')
+        obwf.connect(select_img   , 'in_img',           segment_ob,     'in_img')
+    else:
+        obwf.connect(fileselector , 'T2',               segment_ob,     'in_img')
     obwf.connect(setup_model      , 'flags',            segment_ob,     'flags')
 
     # outputs
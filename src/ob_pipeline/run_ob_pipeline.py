@@ -10,10 +10,11 @@ import argparse
 from itertools import chain
 
 def ob_wf(scans_dir, work_dir, outputdir, subject_ids,
-          batch_size,save_logits,model, rs,no_cuda, loc_arc, seg_arc, wfname='ob_pipeline'):
+          batch_size,save_logits,model, rs,no_cuda, loc_arc, seg_arc, wfname='ob_pipeline', inference_opts=None):
     
     wf = ob_pipeline_workflow(scans_dir, work_dir, outputdir, subject_ids,
-                              batch_size,save_logits,model, rs,no_cuda, loc_arc, seg_arc,wfname)
+                              batch_size,save_logits,model, rs,no_cuda, loc_arc, seg_arc,wfname,
+                              inference_opts=inference_opts)
     wf.inputs.inputnode.subject_ids = subject_ids
     
     return wf
@@ -53,6 +54,16 @@ def main():
 
     parser.add_argument('-batch', "--batch_size", type=int,
                         help='Batch size for inference by default is 16', required=False, default=16)
+    parser.add_argument('-loc_batch', '--loc_batch_size', type=int,
+                        help='Batch size of the localization networks (default: --batch_size)', required=False)
+    parser.add_argument('-seg_batch', '--seg_batch_size', type=int,
+                        help='Batch size of the segmentation networks (default: --batch_size)', required=False)
+    parser.add_argument('-auto_batch', '--auto_batch_size', action='store_true',
+                        help='Choose the localization and segmentation batch sizes from the peak memory measured '\
+                        'on the first batch', required=False)
+    parser.add_argument('-mem_budget', '--memory_budget', type=float,
+                        help='Memory budget of --auto_batch_size in MB per process (0: 80%% of the free memory, '\
+                        'set it when several processes share a device)', required=False, default=0)
     parser.add_argument('-logits', "--save_logits", action='store_true',
                         help='Save logits', required=False)
     parser.add_argument('-model', "--model", type=int,
@@ -65,6 +76,92 @@ def main():
     parser.add_argument('-loc_arc','--loc_arc',help='Localization architecture',required=False,default='FastSurferCNN')
     parser.add_argument('-seg_arc','--seg_arc',help='Segmentation architecture',required=False,default='AttFastSurferCNN')
 
+    parser.add_argument('-att_chunk', '--attention_chunk', type=int,
+                        help='Number of query positions per self-attention block during inference, bounds the '\
+                        'attention memory (0: full attention)', required=False, default=0)
+
+    parser.add_argument('-att_gamma', '--attention_gamma_threshold', type=float,
+                        help='Skip the self-attention blocks whose learned |gamma| is at most this value (checked '\
+                        'against the full network on the first slices, 0: disabled)', required=False, default=0)
+
+    parser.add_argument('-fold_bn', '--fold_batchnorm', action='store_true',
+                        help='Fold the BatchNorm layers of the torch networks into their convolutions (faster, the '\
+                        'float32 logits change by rounding and some labels can flip)', required=False)
+
+    parser.add_argument('-roi', '--roi_pruning', action='store_true',
+                        help='Run the segmentation models only on the slices crossing the (dilated) bounding box of '\
+                        'the localization heatmap, the other slices are set to background', required=False)
+
+    parser.add_argument('-roi_margin', '--roi_margin', type=float,
+                        help='Dilation of the localization bounding box in mm (with --roi_pruning)',
+                        required=False, default=8.0)
+
+    parser.add_argument('-adaptive', '--adaptive_ensemble', action='store_true',
+                        help='Evaluate the segmentation models one at a time and stop once the fused segmentation '\
+                        'stops changing or the time budget is spent (the number of models used is saved in the stats)',
+                        required=False)
+
+    parser.add_argument('-adaptive_th', '--adaptive_threshold', type=float,
+                        help='Dice between successive partial ensembles at which the adaptive ensemble stops',
+                        required=False, default=0.99)
+
+    parser.add_argument('-adaptive_min', '--adaptive_min_models', type=int,
+                        help='Minimal number of models evaluated by the adaptive ensemble', required=False, default=3)
+
+    parser.add_argument('-adaptive_order', '--adaptive_order', nargs='+',
+                        help='Model names (keys of the weights yml) in evaluation order for the adaptive ensemble, '\
+                        'default: split by split with the axial, coronal and sagittal models', required=False,
+                        default=None)
+
+    parser.add_argument('-time_budget', '--time_budget', type=float,
+                        help='Wall-clock budget per subject in seconds for the adaptive ensemble (0: no budget)',
+                        required=False, default=0)
+
+    parser.add_argument('-workers', '--ensemble_workers', type=int,
+                        help='Number of ensemble models evaluated concurrently (thread pool), the torch threads are '\
+                        'split between them', required=False, default=1)
+
+    parser.add_argument('-stacked', '--stacked_ensemble', action='store_true',
+                        help='Evaluate the checkpoints of a plane in one vmapped forward pass (torch >= 2.0, torch '\
+                        'backend), falls back to one model after the other otherwise and for the attention networks '\
+                        'with --attention_chunk', required=False)
+
+    parser.add_argument('-resample_engine', '--resample_engine', choices=['nibabel', 'separable'],
+                        help='Resampling of the T2 to the segmentation and localization resolutions: nibabel (scipy) '\
+                        'or separable (linear interpolation one axis at a time with torch, multithreaded, float32, '\
+                        'falls back to nibabel for oblique images)', required=False, default='nibabel')
+
+    parser.add_argument('-lazy_io', '--lazy_io', action='store_true',
+                        help='Select the uncompressed T2 (T2*.nii, T2*.mgh) of a subject when there is one and read it '\
+                        'block by block: only the localization input at 1.6 mm and the segmentation region are held '\
+                        'in memory (compressed inputs are read whole)', required=False)
+
+    parser.add_argument('-one_step_loc', '--one_step_localization', action='store_true',
+                        help='For inputs not at 0.8 mm, resample the localization input directly from the input image '\
+                        'instead of from the volume interpolated to 0.8 mm (faster, but the heatmap and the crop can '\
+                        'differ from previous releases, compare them with ob_pipeline.benchmarks.bench_crop_first)',
+                        required=False)
+
+    parser.add_argument('-profile', '--profile', action='store_true',
+                        help='Profile the first batches of the first network of every stage and plane with the torch '\
+                        'profiler, Chrome traces and per-operator and per-block tables are written to the profile '\
+                        'folder of the subject', required=False)
+    parser.add_argument('-profile_batches', '--profile_batches', type=int,
+                        help='Number of batches profiled with --profile', required=False, default=2)
+
+    parser.add_argument('-backend', '--backend', choices=['torch', 'torchscript', 'onnx', 'onnx_int8'],
+                        help='Inference backend, torchscript, onnx and onnx_int8 (ONNX Runtime, CPU) require the '\
+                        'models exported with ob_export_models (onnx_int8 only runs once validated against the '\
+                        'fp32 ensemble)', required=False, default='torch')
+
+    parser.add_argument('-intra_op', '--intra_op_threads', type=int,
+                        help='Threads per operator for the onnx backend (0: onnxruntime default)',
+                        required=False, default=0)
+
+    parser.add_argument('-inter_op', '--inter_op_threads', type=int,
+                        help='Threads across operators for the onnx backend (0: onnxruntime default)',
+                        required=False, default=0)
+
     parser.add_argument('-b', '--debug', help='debug mode', action='store_true')
     
     parser.add_argument('-p', '--processes', help='overall number of parallel processes', \
@@ -110,6 +207,30 @@ def main():
     no_cuda=args.no_cuda
     loc_arc=args.loc_arc
     seg_arc=args.seg_arc
+    inference_opts={'localization_batch_size': args.loc_batch_size,
+                    'segmentation_batch_size': args.seg_batch_size,
+                    'auto_batch_size': args.auto_batch_size,
+                    'memory_budget': args.memory_budget,
+                    'attention_chunk': args.attention_chunk,
+                    'attention_gamma_threshold': args.attention_gamma_threshold,
+                    'fold_batchnorm': args.fold_batchnorm,
+                    'roi_pruning': args.roi_pruning,
+                    'ensemble_workers': args.ensemble_workers,
+                    'stacked_ensemble': args.stacked_ensemble,
+                    'lazy_io': args.lazy_io,
+                    'resample_engine': args.resample_engine,
+                    'two_step_localization': not args.one_step_localization,
+                    'profile': args.profile,
+                    'profile_batches': max(1, args.profile_batches),
+                    'adaptive_ensemble': args.adaptive_ensemble,
+                    'adaptive_threshold': args.adaptive_threshold,
+                    'adaptive_min_models': args.adaptive_min_models,
+                    'adaptive_order': args.adaptive_order,
+                    'time_budget': args.time_budget,
+                    'roi_margin': args.roi_margin,
+                    'backend': args.backend,
+                    'intra_op_threads': args.intra_op_threads,
+                    'inter_op_threads': args.inter_op_threads}
      
     config.update_config({
         'logging': {'log_directory': args.workdir, 'log_to_file': True},
@@ -128,7 +249,8 @@ def main():
 
 
     obwf = ob_wf(scans_dir, work_dir, outputdir, subject_ids,
-                                   batch_size,save_logits,model, rs,no_cuda, loc_arc, seg_arc, wfname=args.name)
+                                   batch_size,save_logits,model, rs,no_cuda, loc_arc, seg_arc, wfname=args.name,
+                                   inference_opts=inference_opts)
         
     # Visualize workflow
     if args.debug:
@@ -42,6 +42,7 @@ def ob_pipeline(args,flags):
     logger = misc.setup_logger(os.path.join(save_dir, "log.txt"))
 
     start = time.time()
+    misc.reset_peak_rss()
 
     if os.path.isfile(args.in_img):
 
@@ -71,6 +72,7 @@ def ob_pipeline(args,flags):
             end = time.time() - start
 
             logger.info("Total computation time :  %0.4f seconds." % end)
+            logger.info("Peak memory (RSS) :  %0.1f MB." % misc.get_current_peak_rss())
         else:
             stats.calculate_stats_no_loc(args, save_dir)
 
@@ -139,6 +141,9 @@ def set_up_model(seg_dir,seg_arc,loc_dir,loc_arc,model):
 
     FLAGS['num_classes'] = 2
 
+    # Networks kept in memory per worker process (3 localization + 12 segmentation models)
+    FLAGS['model_cache_size'] = 15
+
     # Segmenation model
     FLAGS['segmentation'] = {}
 
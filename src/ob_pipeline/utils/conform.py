@@ -48,27 +48,73 @@ def conform(img,flags,logger=None):
         flags: dict : Dictionary containing the image size, spacing and orientation
         order: int : interpolation order (0=nearest,1=linear(default),2=quadratic,3=cubic)
     Returns:
-        new_img: nibabel img : conformed nibabel image
+        new_img: nibabel img : conformed nibabel image, float32 scaled intensities (not rounded, the network input)
+                 stored as uint8
     """
     # check orientation LAS
     img=check_orientation(img,base_ornt=flags['base_ornt'])
 
-    img_arr=img.get_fdata()
+    # float32 is exact for the integer intensities of the scanners and halves the memory of float64
+    img_arr=img.get_fdata(dtype=np.float32)
 
     #Conform intensities
     src_min, scale = getscale(data=img_arr, dst_min=0, dst_max=255,logger=logger)
     img_arr = scalecrop(data=img_arr, dst_min=0, dst_max=255, src_min=src_min, scale=scale,logger=logger)
 
     new_img = nib.Nifti1Image(img_arr, img.affine, img.header)
+    new_img.set_data_dtype(np.uint8)
 
     return new_img
 
 
+def slabs(shape, voxels=2 ** 20, axis=0):
+    """
+    Slices along one axis of blocks of about voxels voxels, the volume is processed block by block so the
+    float64 temporaries stay small
+    :param tuple shape: volume shape
+    :param int axis: slab axis
+    :return: generator of index tuples
+    """
+    step = max(1, voxels // max(1, int(np.prod(shape)) // max(1, shape[axis])))
+    for start in range(0, shape[axis], step):
+        yield (slice(None),) * axis + (slice(start, min(start + step, shape[axis])),)
+
+
+def slab_axis(data):
+    """
+    :param data: np.ndarray or array proxy
+    :return int: axis whose slabs are contiguous in memory or in the file (the last one for Fortran order, the order
+                 of NIfTI and MGH files and of the arrays nibabel reads)
+    """
+    fortran = getattr(data, 'order', None) == 'F' or (isinstance(data, np.ndarray) and np.isfortran(data))
+    return len(data.shape) - 1 if fortran else 0
+
+
+def read_block(data, block):
+    """
+    :param data: np.ndarray or array proxy
+    :param block: slice or tuple of slices
+    :return np.ndarray: float32 values of the block (as get_fdata(dtype=np.float32) of the whole volume)
+    """
+    return np.asarray(data[block], dtype=np.float32)
+
+
+def scale_block(block, dst_min, dst_max, src_min, scale):
+    """
+    Rescaled and clipped intensities of a block (not rounded, the network input)
+    :return np.ndarray: float64 block, the caller casts it to the output type
+    """
+    scaled = dst_min + scale * (block.astype(np.float64) - src_min)
+    np.clip(scaled, dst_min, dst_max, out=scaled)
+    return scaled
+
+
 def getscale(data, dst_min, dst_max, f_low=0.0, f_high=0.999,logger=None):
     """
     Function to get offset and scale of image intensities to robustly rescale to range dst_min..dst_max.
     Equivalent to how mri_convert conforms images.
-    :param np.ndarray data: Image data (intensity values)
+    :param np.ndarray data: Image data (intensity values), or an array proxy (nibabel dataobj) read block by block
+                            as float32
     :param float dst_min: future minimal intensity value
     :param float dst_max: future maximal intensity value
     :param f_low: robust cropping at low end (0.0 no cropping)
@@ -76,8 +122,11 @@ def getscale(data, dst_min, dst_max, f_low=0.0, f_high=0.999,logger=None):
     :return: returns (adjusted) src_min and scale factor
     """
     # get min and max from source
-    src_min = np.min(data)
-    src_max = np.max(data)
+    src_min = src_max = None
+    for block in slabs(data.shape, axis=slab_axis(data)):
+        block = read_block(data, block)
+        src_min = float(block.min()) if src_min is None else min(src_min, float(block.min()))
+        src_max = float(block.max()) if src_max is None else max(src_max, float(block.max()))
 
     if src_min < 0.0:
         sys.exit('ERROR: Min value in input is below 0.0!')
@@ -90,14 +139,18 @@ def getscale(data, dst_min, dst_max, f_low=0.0, f_high=0.999,logger=None):
     if f_low == 0.0 and f_high == 1.0:
         return src_min, 1.0
 
-    # compute non-zeros and total vox num
-    nz = (np.abs(data) >= 1e-15).sum()
-    voxnum = data.shape[0] * data.shape[1] * data.shape[2]
-
-    # compute histogram
+    # compute non-zeros, total vox num and histogram in one pass over blocks (np.histogram over the whole
+    # volume range, the blocks in float64 as the bins are computed for the full float64 volume)
     histosize = 1000
     bin_size = (src_max - src_min) / histosize
-    hist, bin_edges = np.histogram(data, histosize)
+    voxnum = data.shape[0] * data.shape[1] * data.shape[2]
+
+    nz = 0
+    hist = np.zeros(histosize, dtype=np.int64)
+    for block in slabs(data.shape, axis=slab_axis(data)):
+        block = read_block(data, block).astype(np.float64)
+        nz += np.count_nonzero(np.abs(block) >= 1e-15)
+        hist += np.histogram(block, histosize, range=(src_min, src_max))[0]
 
     # compute cummulative sum
     cs = np.concatenate(([0], np.cumsum(hist)))
@@ -154,12 +207,12 @@ def scalecrop(data, dst_min, dst_max, src_min, scale,logger=None):
     :param float dst_max: future maximal intensity value
     :param float src_min: minimal value to consider from source (crops below)
     :param float scale: scale value by which source will be shifted
-    :return: scaled Image data array
+    :return: scaled Image data array, float32 (written block by block, the float64 temporaries stay small)
     """
-    data_new = dst_min + scale * (data - src_min)
+    data_new = np.empty(data.shape, dtype=np.float32)
+    for block in slabs(data.shape):
+        data_new[block] = scale_block(data[block], dst_min, dst_max, src_min, scale)
 
-    # clip
-    data_new = np.clip(data_new, dst_min, dst_max)
     if logger:
         logger.info("Output:   min: " + format(data_new.min()) + "  max: " + format(data_new.max()))
     else:
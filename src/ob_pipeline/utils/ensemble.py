@@ -0,0 +1,85 @@
+# Copyright 2023 Population Health Sciences and AI in Medical Imaging, German Center for Neurodegenerative Diseases (DZNE)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import numpy as np
+
+
+class EnsembleAccumulator(object):
+    """
+    Running fusion of the softmax probabilities of the ensemble members.
+    The sum is updated in place as every model finishes; the per-model probabilities are only stored
+    (in a preallocated float32 buffer) when keep_members is set.
+    """
+
+    def __init__(self, shape, num_models, keep_members=False):
+        """
+        :param tuple shape: shape of one model output (X, Y, Z, num_classes)
+        :param int num_models: number of ensemble members
+        :param bool keep_members: store every member's probabilities
+        """
+        self.shape = tuple(shape)
+        self.num_models = num_models
+        self.count = 0
+
+        self.prob_sum = np.zeros(self.shape, dtype=np.float64)
+
+        if keep_members:
+            self.members = np.empty(self.shape + (num_models,), dtype=np.float32)
+        else:
+            self.members = None
+
+    def add(self, probs, index=None, count=1):
+        """
+        Fuse the probabilities of one ensemble member (or the sum of several members)
+        :param np.ndarray probs: softmax output with shape self.shape
+        :param int index: position of the member in the ensemble (default: order of arrival)
+        :param int count: number of members already summed in probs (members are not stored then)
+        """
+        self.prob_sum += probs
+
+        if self.members is not None:
+            if count != 1:
+                raise ValueError('Summed probabilities cannot be stored as ensemble members')
+            self.members[..., self.count if index is None else index] = probs
+
+        self.count += count
+
+    def fused(self):
+        """
+        :return np.ndarray: sum of the member probabilities
+        """
+        return self.prob_sum
+
+    def prediction(self):
+        """
+        :return np.ndarray: label map of the fused probabilities
+        """
+        return np.argmax(self.prob_sum, axis=-1)
+
+    def member_probs(self):
+        """
+        :return np.ndarray: probabilities of the members (X, Y, Z, num_classes, count) or None
+        """
+        if self.members is None:
+            return None
+        return self.members[..., :self.count]
+
+    def nbytes(self):
+        """
+        :return int: memory held by the accumulator buffers
+        """
+        nbytes = self.prob_sum.nbytes
+        if self.members is not None:
+            nbytes += self.members.nbytes
+        return nbytes
@@ -52,32 +52,38 @@ def define_size(mov_dim,ref_dim):
 
     return list(new_dim),borders
 
-def map_size(arr,base_shape,verbose=1):
-    """Padd or crop the size of an input volume to a reference shape
+def map_size(arr,base_shape,verbose=1,fill_value=0,copy=True):
+    """Padd or crop the size of an input volume to a reference shape, keeping it centered
+    Only the overlap of the input and output volumes is copied, trailing dimensions not in base_shape (e.g. channels)
+    are kept and the output has the dtype of the input
     Args:
-        arr (3D array array):  array to be map
-        base_shape (3D ref size) : 3D size of the reference size
+        arr (array) : array to be map, its first len(base_shape) dimensions are padded or cropped
+        base_shape (ref size) : size of the reference size
+        fill_value (float) : value of the padded voxels
+        copy (bool) : if False and no padding is needed, the crop is returned as a view of arr
     Returns:
-        final_arr (3D array) : 3D array containing with a shape defined by base_shape
+        final_arr (array) : array with a shape defined by base_shape (+ the trailing dimensions of arr)
     """
     if verbose >0:
         print('Volume will be resize from %s to %s ' % (arr.shape, base_shape))
 
-    new_shape,borders=define_size(np.array(arr.shape),np.array(base_shape))
-    new_arr=np.zeros(new_shape)
-    final_arr=np.zeros(base_shape)
+    base_shape = tuple(int(dim) for dim in base_shape)
+    src_slices = []
+    dst_slices = []
+    for mov_dim, ref_dim in zip(arr.shape, base_shape):
+        # same centering as define_size: voxel i of arr goes to i + ref_dim // 2 - mov_dim // 2
+        offset = ref_dim // 2 - mov_dim // 2
+        low = max(offset, 0)
+        high = min(mov_dim + offset, ref_dim)
+        src_slices.append(slice(low - offset, max(high, low) - offset))
+        dst_slices.append(slice(low, max(high, low)))
 
-    new_arr[borders[0,0]:borders[0,1],borders[1,0]:borders[1,1],borders[2,0]:borders[2,1]]= arr[:]
+    src_slices = tuple(src_slices)
+    if not copy and all(s.stop - s.start == dim for s, dim in zip(dst_slices, base_shape)):
+        return arr[src_slices]
 
-    middle_point = [int(new_arr.shape[0] // 2), int(new_arr.shape[1] // 2), int(new_arr.shape[2] // 2)]
-    padd = [int(base_shape[0]/2), int(base_shape[1]/2), int(base_shape[2]/2)]
-
-    low_border=np.array((np.array(middle_point)-np.array(padd)),dtype=int)
-    high_border=np.array(np.array(low_border)+np.array(base_shape),dtype=int)
-
-    final_arr[:,:,:]= new_arr[low_border[0]:high_border[0],
-                   low_border[1]:high_border[1],
-                   low_border[2]:high_border[2]]
+    final_arr = np.full(base_shape + arr.shape[len(base_shape):], fill_value, dtype=arr.dtype)
+    final_arr[tuple(dst_slices)] = arr[src_slices]
 
     return final_arr
 
@@ -87,19 +93,57 @@ def get_thick_slices(img_data, slice_thickness=3):
     Function to extract thick slices from the image
     (feed slice_thickness preceeding and suceeding slices to network,
     label only middle one)
+    The thick slices are a read-only strided view of the edge padded volume, nothing is copied per slice and the
+    dtype of img_data is kept
     :param np.ndarray img_data: 3D MRI image read in with nibabel
     :param int slice_thickness: number of slices to stack on top and below slice of interest (default=3)
-    :return:
+    :return np.ndarray: d x h x w x (2 * slice_thickness + 1) view, slice i + k - slice_thickness in channel k
     """
     d ,h, w  = img_data.shape
-    img_data_pad = np.expand_dims(np.pad(img_data, ((slice_thickness, slice_thickness),(0, 0), (0, 0)), mode='edge'),
-                                  axis=3)
-    img_data_thick = np.ndarray((d, h, w, 0), dtype=np.uint8)
+    img_data_pad = np.pad(img_data, ((slice_thickness, slice_thickness),(0, 0), (0, 0)), mode='edge')
+    window = 2 * slice_thickness + 1
+
+    if hasattr(np.lib.stride_tricks, 'sliding_window_view'):
+        return np.lib.stride_tricks.sliding_window_view(img_data_pad, window, axis=0)
+
+    return np.lib.stride_tricks.as_strided(img_data_pad, shape=(d, h, w, window),
+                                           strides=img_data_pad.strides + img_data_pad.strides[:1], writeable=False)
+
+
+def heatmap_roi(heatmap, heatmap_affine, target_affine, zero_xyz, shape, margin=0.0, threshold=0.5):
+    """Bounding box of a localization heatmap in the voxel grid of a cropped volume
+    Args:
+        heatmap (3D array) : localization probabilities
+        heatmap_affine (4x4 array) : vox2ras of the heatmap
+        target_affine (4x4 array) : vox2ras of the full volume the crop was taken from
+        zero_xyz (array) : voxel coordinate of the first crop voxel in the full volume
+        shape (tuple) : shape of the crop
+        margin (float) : dilation of the box in mm
+        threshold (float) : heatmap voxels above this value belong to the ROI
+    Returns:
+        roi (list) : (low, high) voxel range of the box along every crop axis, None if the heatmap is empty
+    """
+    coords = np.argwhere(heatmap >= threshold)
+    if coords.shape[0] == 0:
+        return None
+
+    # all corners of the box (voxel edges) of the heatmap voxels
+    low = coords.min(axis=0) - 0.5
+    high = coords.max(axis=0) + 0.5
+    corners = np.array([[x, y, z, 1] for x in (low[0], high[0]) for y in (low[1], high[1]) for z in (low[2], high[2])])
+
+    vox2vox = np.dot(np.linalg.inv(target_affine), heatmap_affine)
+    corners = np.dot(vox2vox, corners.T)[:3].T - np.array(zero_xyz[:3])
+
+    zooms = np.sqrt(np.sum(target_affine[:3, :3] ** 2, axis=0))
+    low = np.floor(corners.min(axis=0) - margin / zooms).astype(int)
+    high = np.ceil(corners.max(axis=0) + margin / zooms).astype(int) + 1
 
-    for slice_idx in range(2 * slice_thickness + 1):
-        img_data_thick = np.append(img_data_thick, img_data_pad[slice_idx:d + slice_idx,:, :, :], axis=3)
+    roi = []
+    for axis in range(3):
+        roi.append((int(np.clip(low[axis], 0, shape[axis])), int(np.clip(high[axis], 0, shape[axis]))))
 
-    return img_data_thick
+    return roi
 
 
 def clean_seg(label_img,ras_cm):
@@ -0,0 +1,217 @@
+# Copyright 2023 Population Health Sciences and AI in Medical Imaging, German Center for Neurodegenerative Diseases (DZNE)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Block-wise reading of the T2. With --lazy_io the conformed volume of uncompressed inputs is never loaded as a whole:
+the intensity scaling is computed block by block from the file, the localization input is resampled slab by slab and
+only the segmentation region is read at full resolution. Inputs whose voxel size differs from the segmentation
+spacing are resampled the same way (crop-first), only the segmentation region is interpolated.
+"""
+
+import itertools
+from abc import ABCMeta, abstractmethod
+
+import numpy as np
+import nibabel as nib
+from nibabel.affines import to_matvec
+from nibabel.orientations import apply_orientation, io_orientation
+
+from ob_pipeline.utils.conform import calculated_new_ornt, check_orientation, getscale, read_block, scale_block, \
+    slab_axis, slabs
+from ob_pipeline.utils.resample import affine_resample, output_grid
+
+COMPRESSED_EXTENSIONS = ('.gz', '.bz2', '.zst', '.mgz')
+
+
+def lazy_readable(img):
+    """
+    :param img: image returned by nib.load
+    :return bool: the data is read from an uncompressed file, so a block can be read without decompressing the
+                  volume
+    """
+    filename = img.get_filename()
+    return nib.is_proxy(img.dataobj) and filename is not None and \
+        not filename.lower().endswith(COMPRESSED_EXTENSIONS)
+
+
+def template_image(img_class, shape, affine, header):
+    """
+    :return: image of the grid whose data is a broadcast scalar (no memory), gives the affine and header the pipeline
+             would have after processing the whole volume
+    """
+    return img_class(np.broadcast_to(np.float32(0), tuple(shape)), affine, header)
+
+
+class BlockVolume(metaclass=ABCMeta):
+    """
+    Volume on a voxel grid whose float32 data is computed block by block. Slicing it (basic slices, step 1) returns
+    the float64 data of the region like get_fdata()[key] of the whole image would. Subclasses implement read.
+    """
+
+    def __init__(self, template):
+        """
+        :param template: image of the grid (see template_image)
+        """
+        self.template = template
+        self.shape = template.shape
+        self.affine = template.affine
+        self.header = template.header
+        # voxels read from the file per voxel of the volume and axis of the slabs contiguous in the file
+        self.density = 1.0
+        self.slab_axis = 0
+
+    @abstractmethod
+    def read(self, bounds):
+        """
+        :param list bounds: (start, stop) voxel range per axis
+        :return np.ndarray: float32 data of the block
+        """
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (len(self.shape) - len(key))
+
+        bounds = []
+        for s, dim in zip(key, self.shape):
+            if not isinstance(s, slice) or s.step not in (None, 1):
+                raise IndexError('Only slices with step 1 can be read from a {}'.format(self.__class__.__name__))
+            indices = range(dim)[s]
+            bounds.append((indices.start, max(indices.start, indices.stop)))
+
+        return self.read(bounds).astype(np.float64)
+
+    def resampled(self, voxel_sizes, order=1, engine='nibabel'):
+        """
+        :return ResampledVolume: the volume resampled as nibabel.processing.resample_to_output
+        """
+        return ResampledVolume(self, voxel_sizes, order=order, engine=engine)
+
+    def to_image(self):
+        """
+        :return nib.Nifti1Image: whole volume (float32), computed slab by slab (about 2**20 voxels read per slab)
+        """
+        data = np.empty(self.shape, dtype=np.float32)
+        for block in slabs(self.shape, voxels=int(2 ** 20 / max(1.0, self.density)), axis=self.slab_axis):
+            bounds = [(0, dim) for dim in self.shape]
+            bounds[self.slab_axis] = (block[-1].start, block[-1].stop)
+            data[block] = self.read(bounds)
+        return nib.Nifti1Image(data, self.affine, self.header)
+
+
+class ArrayVolume(BlockVolume):
+    """
+    Image held in memory as a BlockVolume, so that regions of a resampled grid of it can be computed alone
+    """
+
+    def __init__(self, img):
+        """
+        :param img: 3D image
+        """
+        BlockVolume.__init__(self, img)
+        self.data = np.asanyarray(img.dataobj)
+
+    def read(self, bounds):
+        return np.asarray(self.data[tuple(slice(low, high) for low, high in bounds)], dtype=np.float32)
+
+
+class ConformedVolume(BlockVolume):
+    """
+    Conformed T2 (orientation of flags['base_ornt'], intensities scaled to 0..255 as conform) read from
+    the array proxy of an uncompressed image. The orientation, affine and header are the ones of conform followed by
+    the float32 conversion of OBNet.eval.
+    """
+
+    def __init__(self, img, flags, logger=None):
+        """
+        :param img: image returned by nib.load (see lazy_readable)
+        :param dict flags: pipeline flags (base_ornt)
+        :param logger: logger of the intensity scaling
+        """
+        self.dataobj = img.dataobj
+
+        base_ornt = flags['base_ornt']
+        ornt = io_orientation(img.affine)
+        self.ornt = np.array([[0, 1], [1, 1], [2, 1]]) if np.array_equal(ornt, base_ornt) else \
+            calculated_new_ornt(ornt, base_ornt)
+
+        oriented = check_orientation(template_image(img.__class__, img.shape, img.affine, img.header), base_ornt)
+        template = template_image(nib.Nifti1Image, oriented.shape, oriented.affine, oriented.header)
+        template.set_data_dtype(np.uint8)
+        BlockVolume.__init__(self, template)
+        self.slab_axis = int(np.argsort(self.ornt[:, 0]).tolist().index(slab_axis(self.dataobj)))
+
+        self.src_min, self.scale = getscale(data=self.dataobj, dst_min=0, dst_max=255, logger=logger)
+
+    def read(self, bounds):
+        shape = tuple(int(high - low) for low, high in bounds)
+        if not all(shape):
+            return np.zeros(shape, dtype=np.float32)
+
+        # the block of the file flipped and transposed as check_orientation does for the whole volume
+        axes = np.argsort(self.ornt[:, 0])
+        stored = [None] * len(bounds)
+        for axis, (start, stop) in zip(axes, bounds):
+            dim = self.dataobj.shape[axis]
+            stored[axis] = slice(dim - stop, dim - start) if self.ornt[axis, 1] == -1 else slice(start, stop)
+
+        block = scale_block(read_block(self.dataobj, tuple(stored)), 0, 255, self.src_min, self.scale)
+        return np.ascontiguousarray(apply_orientation(block, self.ornt), dtype=np.float32)
+
+
+class ResampledVolume(BlockVolume):
+    """
+    Volume resampled to an isotropic or anisotropic voxel size, same grid, header and interpolation as
+    nibabel.processing.resample_to_output (constant mode, cval 0), every block is interpolated from the block of the
+    source volume it needs
+    """
+
+    def __init__(self, source, voxel_sizes, order=1, engine='nibabel'):
+        """
+        :param BlockVolume source: volume to resample
+        :param voxel_sizes: output voxel size in mm
+        :param int order: spline interpolation order (0 or 1, higher orders would need the whole volume prefiltered)
+        :param str engine: resampling engine of every block (see resample.ENGINES)
+        """
+        if order > 1:
+            raise ValueError('Block-wise resampling supports interpolation orders 0 and 1, got {}'.format(order))
+
+        self.source = source
+        self.order = order
+        self.engine = engine
+
+        shape, affine = output_grid(source.shape, source.affine, voxel_sizes)
+        BlockVolume.__init__(self, template_image(nib.Nifti1Image, shape, affine, source.header))
+
+        self.rzs, self.trans = to_matvec(np.linalg.inv(source.affine).dot(affine))
+        self.density = source.density * abs(np.linalg.det(self.rzs))
+        self.slab_axis = source.slab_axis
+
+    def read(self, bounds):
+        start = np.array([low for low, _ in bounds])
+        shape = tuple(int(high - low) for low, high in bounds)
+        if not all(shape):
+            return np.zeros(shape, dtype=np.float32)
+
+        # source voxels around the corners of the block, one voxel of margin for the interpolation
+        corners = np.array(list(itertools.product(*[(low, high - 1) for low, high in bounds])))
+        coords = corners.dot(self.rzs.T) + self.trans
+        low = np.clip(np.floor(coords.min(axis=0)).astype(int) - 1, 0, self.source.shape)
+        high = np.clip(np.floor(coords.max(axis=0)).astype(int) + 2, 0, self.source.shape)
+        if np.any(high <= low):
+            return np.zeros(shape, dtype=np.float32)
+
+        block = self.source.read(list(zip(low, high)))
+        return affine_resample(block, self.rzs, self.rzs.dot(start) + self.trans - low, shape, order=self.order,
+                               engine=self.engine)
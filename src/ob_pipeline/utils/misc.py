@@ -65,3 +65,50 @@ def setup_logger(filename="log.txt"):
     return logger
 
 
+def get_peak_rss():
+    """
+    Peak resident set size of the current process (ru_maxrss). It does not reliably follow reset_peak_rss (it is
+    never reset on macOS and keeps the peak from before the exec on linux), see get_current_peak_rss for the peak
+    since a reset.
+    :return float: peak memory in MB
+    """
+    import sys
+    import resource
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # ru_maxrss is reported in bytes on macOS and in kilobytes on linux
+        peak = peak / 1024.0
+
+    return peak / 1024.0
+
+
+def reset_peak_rss():
+    """
+    Reset the peak resident set size of the current process (VmHWM, linux only), so that get_current_peak_rss
+    reports the peak of the following work (e.g. one subject in a long-lived worker). Read the peak with
+    get_current_peak_rss, get_peak_rss (ru_maxrss) does not reliably follow the reset.
+    :return bool: True if the peak was reset
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def get_current_peak_rss():
+    """
+    Peak resident set size since the last reset_peak_rss (VmHWM, linux), falls back to the process peak
+    :return float: peak memory in MB
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except (IOError, OSError):
+        pass
+
+    return get_peak_rss()
@@ -0,0 +1,118 @@
+# Copyright 2023 Population Health Sciences and AI in Medical Imaging, German Center for Neurodegenerative Diseases (DZNE)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Resampling engines of the pipeline (--resample_engine):
+nibabel: nibabel.processing.resample_to_output (scipy affine_transform, one thread, any affine)
+separable: linear interpolation one axis at a time with torch (multithreaded, float32), used when the voxel axes of
+           the input and output grids are aligned, the case after check_orientation for non-oblique acquisitions,
+           the nibabel engine is used otherwise
+"""
+
+import numpy as np
+import nibabel.processing
+import torch
+from nibabel.affines import to_matvec
+from scipy.ndimage import affine_transform
+
+ENGINES = ('nibabel', 'separable')
+
+
+def axis_aligned(rzs, tol=1e-6):
+    """
+    :param np.ndarray rzs: rotation / zoom part of an output to input voxel mapping
+    :return bool: every output axis maps to the same input axis (diagonal rzs)
+    """
+    off_diagonal = rzs - np.diag(np.diag(rzs))
+    return np.max(np.abs(off_diagonal)) <= tol * np.max(np.abs(np.diag(rzs)))
+
+
+def separable_linear(data, rzs, trans, out_shape):
+    """
+    Trilinear interpolation as scipy.ndimage.affine_transform (order 1, constant mode, cval 0) for a diagonal rzs,
+    computed as one linear interpolation per axis
+    :param np.ndarray data: input volume
+    :param np.ndarray rzs: diagonal output to input voxel scaling
+    :param np.ndarray trans: output to input voxel translation
+    :param tuple out_shape: output shape
+    :return np.ndarray: float32 output volume
+    """
+    out = torch.from_numpy(np.ascontiguousarray(data, dtype=np.float32))
+
+    # axes reducing the volume the most first, the intermediate volumes stay small when downsampling
+    for axis in np.argsort(np.array(out_shape, dtype=float) / np.array(data.shape)):
+        size = data.shape[axis]
+        coords = rzs[axis, axis] * np.arange(out_shape[axis]) + trans[axis]
+        low = np.clip(np.floor(coords), 0, max(size - 2, 0)).astype(np.int64)
+        high = np.minimum(low + 1, size - 1)
+
+        # samples outside of the input are set to cval (0) like scipy's constant mode
+        inside = (coords >= 0) & (coords <= size - 1)
+        weight = np.where(inside, coords - low, 0.0)
+        view = [1] * out.dim()
+        view[axis] = -1
+
+        low_weight = torch.from_numpy((inside - weight).astype(np.float32)).view(view)
+        high_weight = torch.from_numpy(weight.astype(np.float32)).view(view)
+        out = out.index_select(axis, torch.from_numpy(low)) * low_weight + \
+            out.index_select(axis, torch.from_numpy(high)) * high_weight
+
+    return out.numpy()
+
+
+def output_grid(shape, affine, voxel_sizes):
+    """
+    :param voxel_sizes: output voxel size in mm (scalar or one per axis)
+    :return tuple: shape and affine of the grid of nibabel.processing.resample_to_output
+    """
+    voxel_sizes = np.asarray(voxel_sizes)
+    if voxel_sizes.ndim == 0:
+        voxel_sizes = np.repeat(voxel_sizes, len(shape))
+    return nibabel.processing.vox2out_vox((shape, affine), voxel_sizes)
+
+
+def affine_resample(data, rzs, trans, out_shape, order=1, engine='nibabel'):
+    """
+    Output volume of the voxel mapping out -> rzs * out + trans of the input (as nibabel.processing.resample_from_to)
+    :param np.ndarray data: input volume
+    :param int order: spline interpolation order
+    :param str engine: nibabel or separable (order 1 and diagonal rzs only, nibabel is used otherwise)
+    :return np.ndarray: output volume (float32 with the separable engine, the dtype of data otherwise)
+    """
+    if engine not in ENGINES:
+        raise ValueError('Unknown resampling engine {}, available: {}'.format(engine, ', '.join(ENGINES)))
+
+    if engine == 'separable' and order == 1 and axis_aligned(rzs):
+        return separable_linear(data, rzs, trans, out_shape)
+
+    return affine_transform(data, rzs, trans, out_shape, order=order, mode='constant', cval=0.0)
+
+
+def resample_to_output(img, voxel_sizes, order=1, engine='nibabel'):
+    """
+    nibabel.processing.resample_to_output (constant mode, cval 0) with a choice of engine
+    :param img: 3D image
+    :param voxel_sizes: output voxel size in mm (scalar or one per axis)
+    :param int order: spline interpolation order
+    :param str engine: see ENGINES
+    :return: image of the class of img on the output grid, with the header of img
+    """
+    if engine == 'nibabel':
+        return nibabel.processing.resample_to_output(img, voxel_sizes, order=order)
+
+    shape, affine = output_grid(img.shape, img.affine, voxel_sizes)
+    rzs, trans = to_matvec(np.linalg.inv(img.affine).dot(affine))
+
+    data = affine_resample(np.asanyarray(img.dataobj), rzs, trans, shape, order=order, engine=engine)
+    return img.__class__(data, affine, img.header)
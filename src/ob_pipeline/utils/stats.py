@@ -72,6 +72,68 @@ def calculate_uncertainty(logits,label,pred_img,cm):
     return uncertainty_values
 
 
+class UncertaintyAccumulator(object):
+    """
+    Incremental version of calculate_uncertainty: the per-model Entropy and voxel count of every structure
+    are computed as soon as an ensemble member finishes, so the per-model probabilities never need to be kept.
+    """
+
+    labels = [1, 2, 3]
+
+    def __init__(self, affine, header, ras_cm):
+        """
+        :param np.ndarray affine: vox2ras of the segmentation crop
+        :param header: image header of the segmentation crop
+        :param np.ndarray ras_cm: RAS coordinate of the OB center (used for the left/right assignment)
+        """
+        self.affine = affine
+        self.header = header
+        self.ras_cm = ras_cm
+        # one row per model, one [Entropy, NVoxels] pair per label
+        self.measures = []
+
+    def update(self, probs):
+        """
+        Add the measures of one ensemble member (same computation as uncertainty_measures for every label)
+        :param np.ndarray probs: softmax output of the model (X, Y, Z, num_classes)
+        """
+        from ob_pipeline.utils import image_utils
+
+        #prevents log 0
+        data = np.clip(probs, 0.00001, 1 - 0.00001)
+
+        pred = np.argmax(data, axis=-1)
+        new_pred_img = nib.MGHImage(pred, self.affine, self.header)
+        new_pred_img = image_utils.clean_seg(new_pred_img, self.ras_cm)
+        label_map = new_pred_img.get_fdata()
+
+        entropy_map = data[:, :, :, 1] * np.log(data[:, :, :, 1])
+
+        model_measures = np.zeros((len(self.labels), 2))
+        for idx, label in enumerate(self.labels):
+            temp_label = np.zeros_like(pred)
+            if label in [1, 2]:
+                temp_label[label_map == label] = 1
+            elif label == 3:
+                temp_label[label_map > 0] = 1
+
+            # Entropy
+            num = np.sum(temp_label)
+            if num > 0:
+                model_measures[idx, 0] = (-1 * np.sum(temp_label * entropy_map) / num)
+            model_measures[idx, 1] = num
+
+        self.measures.append(model_measures)
+
+    def summary(self, label):
+        """
+        :param int label: structure label (1: left, 2: right, 3: total)
+        :return np.ndarray: [mean Entropy, CV of the volumes] across the ensemble members, as calculate_uncertainty
+        """
+        matrix = np.array(self.measures)[:, self.labels.index(label), :]
+        return calculate_uncertainty_summary(matrix)
+
+
 
 def extract_stats(prop,uncertain_values,SegID,Structname,col_names,voxel_size,zero_xyz):
 
@@ -108,6 +170,10 @@ def extract_stats(prop,uncertain_values,SegID,Structname,col_names,voxel_size,ze
 
 
 def calculate_stats(args,save_dir,image,prediction,logits,cm,cm_logits,logger):
+    """
+    Write the segmentation and localization stats of a subject
+    logits is either the 5D array of per-model probabilities or an UncertaintyAccumulator filled during inference
+    """
     import os
     import pandas as pd
     from skimage.measure import regionprops
@@ -164,7 +230,10 @@ def calculate_stats(args,save_dir,image,prediction,logits,cm,cm_logits,logger):
     #Segmentation metrics
     for idx,struc in enumerate(structures.keys()):
 
-        uncertain_values = calculate_uncertainty(logits, structures[struc], prediction, cm['ras'])
+        if isinstance(logits, UncertaintyAccumulator):
+            uncertain_values = logits.summary(structures[struc])
+        else:
+            uncertain_values = calculate_uncertainty(logits, structures[struc], prediction, cm['ras'])
         # Entropy
         metrics_matrix[idx, 8] = np.around(uncertain_values[0, 0], decimals=4)
         # CV
@@ -232,6 +301,8 @@ def calculate_stats(args,save_dir,image,prediction,logits,cm,cm_logits,logger):
     #to-do warning flag for litte heat map maybe (1000) as sigma was 10 ,10**3
     loc_df = pd.DataFrame(loc_matrix, columns=col_names)
     loc_df.insert(len(col_names),'Flags',warning_flag)
+    # number of segmentation models in the ensemble (fewer with the adaptive ensemble)
+    loc_df.insert(len(col_names) + 1, 'NModels', cm.get('num_models', np.nan))
     loc_df.to_csv(os.path.join(stats_dir, 'localization_stats.csv'), sep=',', index=False)
 
 
@@ -255,6 +326,7 @@ def calculate_stats_no_loc(args,save_dir):
     loc_matrix[0, 6] = args.in_img.split('/')[-1].split('.')[0]
     loc_df = pd.DataFrame(loc_matrix, columns=col_names)
     loc_df.insert(len(col_names),'Flags',warning_flag)
+    loc_df.insert(len(col_names) + 1, 'NModels', np.nan)
     loc_df.to_csv(os.path.join(stats_dir, 'localization_stats.csv'), sep=',', index=False)
 
 
@@ -265,7 +337,7 @@ def obstats2tableRS(args,save_dir):
     from ob_pipeline.utils import misc
     import os
     import  pandas as pd
-    loc_columns=['loc_cm','seg_cm','dist_mm','mse_px','ROI_NVoxels','in_image','Flags']
+    loc_columns=['loc_cm','seg_cm','dist_mm','mse_px','ROI_NVoxels','in_image','Flags','NModels']
 
     metrics=['NVoxels','Volume_mm3','normMean','normMin','normMax','Entropy','CV','CM']
 
@@ -299,8 +371,9 @@ def obstats2tableRS(args,save_dir):
 
     loc_stats_file = misc.locate_file('*localization_stats.csv', os.path.join(save_dir, 'stats'))
     df_loc=pd.read_csv(loc_stats_file[0])
-    loc_values=df_loc.values
-    table[0,idj:] = loc_values[0,1:]
+    # by column name, stats written before NModels was added get a missing value
+    loc_values=df_loc.reindex(columns=loc_columns).values
+    table[0,idj:] = loc_values[0]
 
 
     final_table=table[:,:]
@@ -319,7 +392,7 @@ def obstats2table(main_dir,sub_list,name='obstats_table.csv'):
     import  pandas as pd
     from ob_pipeline.utils import misc
 
-    loc_columns=['loc_cm','seg_cm','dist_mm','mse_px','ROI_NVoxels','in_image','Flags']
+    loc_columns=['loc_cm','seg_cm','dist_mm','mse_px','ROI_NVoxels','in_image','Flags','NModels']
 
     metrics=['NVoxels','Volume_mm3','normMean','normMin','normMax','Entropy','CV','CM']
 
@@ -355,8 +428,8 @@ def obstats2table(main_dir,sub_list,name='obstats_table.csv'):
 
         loc_stats_file = misc.locate_file('*localization_stats.csv', os.path.join(main_dir, sub, 'stats'))
         df_loc=pd.read_csv(loc_stats_file[0])
-        loc_values=df_loc.values
-        table[idx,idj:] = loc_values[0,1:]
+        loc_values=df_loc.reindex(columns=loc_columns).values
+        table[idx,idj:] = loc_values[0]
 
 
     final_table=table[:idx+1,:]
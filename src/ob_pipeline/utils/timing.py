@@ -0,0 +1,105 @@
+# Copyright 2023 Population Health Sciences and AI in Medical Imaging, German Center for Neurodegenerative Diseases (DZNE)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import json
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from ob_pipeline.utils import misc
+
+
+class StageTimer(object):
+    """
+    Wall time, CPU time and peak RSS of the processing stages of a subject, written as timings.json.
+    Stages can be nested (e.g. the models of the segmentation stage), the peak RSS of a stage includes the peaks of
+    its nested stages. The CPU time is the one of the whole process (all threads).
+    """
+
+    def __init__(self):
+        self.records = []
+        self.start_wall = time.time()
+        self.start_cpu = time.process_time()
+        # [record, peak RSS so far] of the stages being measured, innermost last
+        self.open = []
+        self.lock = threading.Lock()
+
+    def update_peaks(self):
+        current = misc.get_current_peak_rss()
+        for entry in self.open:
+            entry[1] = max(entry[1], current)
+
+    @contextmanager
+    def stage(self, name, resources=True, **info):
+        """
+        Measure the enclosed block
+        :param str name: stage name
+        :param bool resources: measure CPU time and peak RSS, False for blocks running concurrently in threads
+                               (only the wall time is recorded)
+        :param info: extra fields of the record (e.g. plane, model)
+        """
+        record = OrderedDict([('stage', name), ('parent', self.open[-1][0]['stage'] if self.open else None)])
+        record.update(sorted(info.items()))
+        with self.lock:
+            self.records.append(record)
+
+        entry = [record, 0.0]
+        if resources:
+            # the peaks of the enclosing stages are kept before the process peak is reset for this one
+            self.update_peaks()
+            misc.reset_peak_rss()
+            self.open.append(entry)
+
+        start_wall = time.time()
+        start_cpu = time.process_time()
+        try:
+            yield record
+        finally:
+            record['wall_s'] = round(time.time() - start_wall, 4)
+            if resources:
+                record['cpu_s'] = round(time.process_time() - start_cpu, 4)
+                self.update_peaks()
+                self.open.remove(entry)
+                record['peak_rss_mb'] = round(entry[1], 1)
+                for parent in self.open:
+                    parent[1] = max(parent[1], entry[1])
+
+    def peak_rss(self):
+        """
+        :return float: peak RSS in MB over all measured stages
+        """
+        self.update_peaks()
+        peaks = [record['peak_rss_mb'] for record in self.records if 'peak_rss_mb' in record]
+        return max(peaks + [entry[1] for entry in self.open] + [0.0])
+
+    def summary(self):
+        """
+        :return OrderedDict: totals since the timer was created and the stage records in start order
+        """
+        return OrderedDict([('total_wall_s', round(time.time() - self.start_wall, 4)),
+                            ('total_cpu_s', round(time.process_time() - self.start_cpu, 4)),
+                            ('peak_rss_mb', round(self.peak_rss(), 1)),
+                            ('stages', self.records)])
+
+    def save(self, path, **info):
+        """
+        Write the summary as json
+        :param str path: output file (timings.json)
+        :param info: extra top-level fields (e.g. sub_id)
+        """
+        summary = OrderedDict(sorted(info.items()))
+        summary.update(self.summary())
+        with open(path, 'w') as f:
+            json.dump(summary, f, indent=2)
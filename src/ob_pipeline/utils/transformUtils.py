@@ -18,23 +18,19 @@ import numpy as np
 import torch
 
 
-
-##
-class ToTensorTest(object):
+def to_tensor_volume(img, channels_first=False):
     """
-    Convert np.ndarrays in sample to Tensors.
+    Convert a stack of slices to the network input (intensities / 255 clamped between 0 and 1, channels first).
+    :param np.ndarray img: slices N x H x W x C (any strides, e.g. a batch of a thick slices view)
+    :param bool channels_first: img is already N x C x H x W
+    :return: contiguous float32 tensor N x C x H x W normalized and clamped between 0 and 1
     """
+    if not channels_first:
+        img = img.transpose((0, 3, 1, 2))
+    img = np.ascontiguousarray(img, dtype=np.float32)
+    img = torch.from_numpy(img)
 
-    def __call__(self, img):
-        img = img.astype(np.float32)
-
-        # Normalize and clamp between 0 and 1
-        img = np.clip(img / 255.0, a_min=0.0, a_max=1.0)
-
-        # swap color axis because
-        # numpy image: H x W x C
-        # torch image: C X H X W
-        img = img.transpose((2, 0, 1))
-
-        return torch.from_numpy(img)
+    # Normalize and clamp between 0 and 1 (in place, no extra copies)
+    img.div_(255.0).clamp_(0.0, 1.0)
 
+    return img
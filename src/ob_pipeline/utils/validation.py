@@ -0,0 +1,93 @@
+# Copyright 2023 Population Health Sciences and AI in Medical Imaging, German Center for Neurodegenerative Diseases (DZNE)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Agreement measures between a reference and a test segmentation of the olfactory bulbs
+(used to validate the inference shortcuts against the full fp32 ensemble)
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+
+# label 3 is the union of both bulbs, as in stats.UncertaintyAccumulator
+STRUCTURES = OrderedDict([(1, 'left'), (2, 'right'), (3, 'total')])
+
+
+def structure_mask(arr, label):
+    if label == 3:
+        return arr > 0
+    return arr == label
+
+
+def dice_score(ref_mask, test_mask):
+    """
+    :return float: Dice coefficient of two boolean masks (1 if both are empty)
+    """
+    denominator = np.count_nonzero(ref_mask) + np.count_nonzero(test_mask)
+    if denominator == 0:
+        return 1.0
+    return 2.0 * np.count_nonzero(ref_mask & test_mask) / denominator
+
+
+def compare_segmentations(ref, test, voxel_volume=1.0):
+    """
+    Dice and volumes of the left, right and total olfactory bulb
+    :param np.ndarray ref: reference label map
+    :param np.ndarray test: label map to validate (same grid as ref)
+    :param float voxel_volume: volume of one voxel in mm3
+    :return OrderedDict: structure name -> dice, ref_volume, test_volume, volume_diff (relative to the reference)
+    """
+    if ref.shape != test.shape:
+        raise ValueError('Segmentations have different shapes {} and {}'.format(ref.shape, test.shape))
+
+    results = OrderedDict()
+
+    for label, name in STRUCTURES.items():
+        ref_mask = structure_mask(ref, label)
+        test_mask = structure_mask(test, label)
+
+        ref_volume = np.count_nonzero(ref_mask) * voxel_volume
+        test_volume = np.count_nonzero(test_mask) * voxel_volume
+
+        if ref_volume > 0:
+            volume_diff = abs(test_volume - ref_volume) / ref_volume
+        else:
+            volume_diff = 0.0 if test_volume == 0 else float('inf')
+
+        results[name] = OrderedDict([('dice', dice_score(ref_mask, test_mask)),
+                                     ('ref_volume', float(ref_volume)),
+                                     ('test_volume', float(test_volume)),
+                                     ('volume_diff', float(volume_diff))])
+
+    return results
+
+
+def agreement_failures(results, min_dice, max_volume_diff):
+    """
+    :param OrderedDict results: output of compare_segmentations
+    :param float min_dice: lowest Dice accepted per structure
+    :param float max_volume_diff: largest relative volume difference accepted per structure
+    :return list: description of every structure outside the thresholds (empty if the test segmentation agrees)
+    """
+    failures = []
+
+    for name, measures in results.items():
+        if measures['dice'] < min_dice:
+            failures.append('{} dice {:.4f} < {}'.format(name, measures['dice'], min_dice))
+        if measures['volume_diff'] > max_volume_diff:
+            failures.append('{} volume difference {:.2%} > {:.2%}'.format(name, measures['volume_diff'],
+                                                                         max_volume_diff))
+
+    return failures
@@ -29,10 +29,11 @@ def main(**extra_args):
           author_email='estradae@dzne.de',
           url='http://www.dzne.de/',
           packages = ['ob_pipeline',
-                      'ob_pipeline.utils','ob_pipeline.models'],
+                      'ob_pipeline.utils','ob_pipeline.models','ob_pipeline.benchmarks'],
           entry_points={
             'console_scripts': [
-                             "run_ob_pipeline=ob_pipeline.run_ob_pipeline:main"
+                             "run_ob_pipeline=ob_pipeline.run_ob_pipeline:main",
+                             "ob_export_models=ob_pipeline.export_models:main"
                               ]
                        },
           license='DZNE License',
@@ -48,6 +49,7 @@ def main(**extra_args):
           maintainer_email = 'mohammad.shahid@dzne.de',
           package_data = {'ob_pipeline': extra_files},
           install_requires=["nipype","nibabel"],
+          extras_require={'onnx': ["onnx","onnxruntime"]},
           **extra_args
          )
 